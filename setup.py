@@ -52,6 +52,7 @@ setup(
         "Pillow",
         "django-mptt",
     ],
+    extras_require={"numpy": ["numpy"]},
     classifiers=[
         "Programming Language :: Python",
         "Programming Language :: Python :: 3.6",
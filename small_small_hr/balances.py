@@ -0,0 +1,123 @@
+"""Leave balance cache module for small_small_hr."""
+import zlib
+from decimal import Decimal
+from functools import partial
+from typing import Callable, Iterable, Optional, Set, Tuple
+
+from django.conf import settings
+from django.core.cache import BaseCache
+from django.db import connection
+
+from small_small_hr.caching import PendingCallbacks, get_shared_cache, get_version_stamp
+
+# (staff_id, year, leave_type)
+BalanceKey = Tuple[int, int, str]
+
+GLOBAL_VERSION_KEY = "sshr:balance:version"
+
+
+class BalanceCache:
+    """
+    Cache of leave balances on top of Django's cache framework.
+
+    Balances are cached per (staff_id, year, leave_type).  Every such key has a
+    version number that is part of the cache keys of its balances, and there is
+    one more version number shared by all the keys.  Bumping a version number
+    makes the balances cached under the old one unreachable, so they are left to
+    expire.
+
+    The versions are bumped by the Leave, AnnualLeave and FreeDay signals.
+    Balances are only cached in a cache shared by all processes, otherwise they
+    are always computed.
+    """
+
+    def __init__(self):
+        """Initialize the balance cache."""
+        self._pending = PendingCallbacks()
+
+    @property
+    def cache(self) -> Optional[BaseCache]:
+        """Get the Django cache in which balances are stored, or None."""
+        return get_shared_cache(settings.SSHR_BALANCE_CACHE)
+
+    def _is_pending(self, key: BalanceKey) -> bool:
+        """
+        Check if a key has been invalidated by the current transaction.
+
+        Its balances are not cached until the transaction is committed, so that a
+        rollback cannot leave balances of data that never existed behind.
+        """
+        return any(
+            keys is None or key in keys  # type: ignore
+            for keys, _ in self._pending.get()
+        )
+
+    def _get_version_key(self, key: BalanceKey) -> str:
+        """Get the cache key of the version of a key."""
+        staff_id, year, leave_type = key
+        return f"{GLOBAL_VERSION_KEY}:{staff_id}:{year}:{leave_type}"
+
+    def _get_cache_key(self, cache: BaseCache, key: BalanceKey, name: str) -> str:
+        """Get the cache key of a balance, given the current versions."""
+        version_keys = [GLOBAL_VERSION_KEY, self._get_version_key(key)]
+        versions = cache.get_many(version_keys)
+        for version_key in version_keys:
+            if version_key not in versions:
+                versions[version_key] = cache.get_or_set(
+                    version_key, get_version_stamp(), timeout=None
+                )
+        day_values = [settings.SSHR_DAY_LEAVE_VALUES[_] for _ in range(1, 8)]
+        day_values_hash = zlib.crc32(repr(day_values).encode())
+        staff_id, year, leave_type = key
+        return (
+            f"sshr:balance:{staff_id}:{year}:{leave_type}:{name}:"
+            f"{versions[version_keys[0]]}:{versions[version_keys[1]]}:"
+            f"{day_values_hash}"
+        )
+
+    def get(self, key: BalanceKey, name: str, compute: Callable[[], Decimal]) -> Decimal:
+        """
+        Get a cached balance, computing and caching it if necessary.
+
+        :param key: the (staff_id, year, leave_type) of the balance
+        :param name: the name of the balance, e.g. "approved" or "available"
+        :param compute: a function that computes the balance
+        """
+        cache = self.cache
+        if cache is None or key[0] is None or self._is_pending(key):
+            return compute()
+        cache_key = self._get_cache_key(cache, key, name)
+        value = cache.get(cache_key)
+        if value is None:
+            value = compute()
+            cache.set(cache_key, value, timeout=settings.SSHR_BALANCE_CACHE_TIMEOUT)
+        return value
+
+    def _bump(self, keys: Optional[Set[BalanceKey]] = None):
+        """Bump the versions of the given keys, or the version shared by all."""
+        cache = self.cache
+        if cache is None:
+            return
+        if keys is None:
+            version_keys = [GLOBAL_VERSION_KEY]
+        else:
+            version_keys = [self._get_version_key(key) for key in keys]
+        for version_key in version_keys:
+            try:
+                cache.incr(version_key)
+            except ValueError:
+                # nothing is cached under a version that does not exist
+                pass
+
+    def invalidate(self, keys: Optional[Iterable[BalanceKey]] = None):
+        """Invalidate the balances of the given keys, or all balances."""
+        keys = None if keys is None else set(keys)
+        if keys == set():
+            return
+        self._bump(keys)
+        if connection.in_atomic_block:
+            # other processes may cache balances before this commit
+            self._pending.add(partial(self._bump, keys), value=keys)
+
+
+balance_cache = BalanceCache()  # pylint: disable=invalid-name
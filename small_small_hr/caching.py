@@ -0,0 +1,77 @@
+"""Helpers shared by the leave balance and FreeDay calendar caches."""
+import threading
+import time
+from typing import Callable, List, Optional, Tuple
+
+from django.core.cache import BaseCache, caches
+from django.core.cache.backends.dummy import DummyCache
+from django.core.cache.backends.locmem import LocMemCache
+from django.db import connection, transaction
+
+# errors in the code, as opposed to errors reaching a cache, are never caught
+PROGRAMMING_ERRORS = (AttributeError, ImportError, NameError, TypeError)
+
+
+def get_version_stamp() -> int:
+    """
+    Get the number that a cache version starts from.
+
+    Versions start from the current time in microseconds, so that a version set
+    again after it was evicted does not match values cached under the old one.
+    """
+    return int(time.time() * 10 ** 6)
+
+
+def get_shared_cache(alias: Optional[str]) -> Optional[BaseCache]:
+    """
+    Get the Django cache shared by all processes, or None if there is none.
+
+    Dummy and local memory caches are not shared between processes, so values
+    cached in them could not be invalidated in the other processes.
+    """
+    if alias is None:
+        return None
+    cache = caches[alias]
+    if isinstance(cache, (DummyCache, LocMemCache)):
+        return None
+    return cache
+
+
+class PendingCallbacks:
+    """
+    The on_commit callbacks of the current thread that have not run yet.
+
+    Each callback is kept with a value, e.g. what it invalidates, until its
+    transaction is committed, which runs it, or rolled back, which drops it.
+    """
+
+    def __init__(self):
+        """Initialize the pending callbacks."""
+        self._local = threading.local()
+
+    def add(self, callback: Callable, value: object = None):
+        """Run a callback when the current transaction is committed."""
+        transaction.on_commit(callback)
+        self._local.items = self.get() + [(value, callback)]
+
+    def get(self) -> List[Tuple[object, Callable]]:
+        """Get the (value, callback) pairs of the callbacks that have not run."""
+        items = getattr(self._local, "items", [])
+        if not items:
+            return items
+        if not connection.in_atomic_block:
+            # the transactions were all committed or rolled back
+            items = []
+        else:
+            # Django drops on_commit callbacks when their savepoint is rolled
+            # back, this is the only place that relies on its private list
+            registered = getattr(connection, "run_on_commit", None)
+            if registered is not None:
+                ids = {id(item[1]) for item in registered}
+                items = [item for item in items if id(item[1]) in ids]
+        self._local.items = items
+        return items
+
+    def clear(self):
+        """Forget the pending callbacks."""
+        self._local.items = []
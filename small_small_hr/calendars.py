@@ -0,0 +1,368 @@
+"""Holiday calendar module for small_small_hr."""
+import logging
+import threading
+import time
+from datetime import date
+from decimal import Decimal
+from functools import partial
+from typing import Dict, FrozenSet, Iterable, List, Optional, Sequence, Tuple
+
+from django.apps import apps
+from django.conf import settings
+from django.db import connection
+from django.db.models import Q
+
+from small_small_hr.caching import (
+    PROGRAMMING_ERRORS,
+    PendingCallbacks,
+    get_shared_cache,
+    get_version_stamp,
+)
+
+# (units, bitmap) pairs, see FreeDayCalendar.get_leave_day_bitmaps
+DayBitmaps = Tuple[Tuple[int, int], ...]
+# (HolidayCalendar id, year), the id is None for the default calendar
+CalendarYear = Tuple[Optional[int], int]
+
+VERSION_KEY = "sshr:calendar:version"
+
+LOGGER = logging.getLogger(__name__)
+
+
+class FreeDayCalendar:
+    """
+    In-process cache of FreeDay dates.
+
+    Each year's free days of each HolidayCalendar are loaded once into a
+    frozenset so that leave day calculations get constant-time membership tests
+    without querying FreeDay.  Methods take the id of the calendar, or None for
+    the default calendar of free days and staff members without one.
+
+    For every year the days that count as leave are also kept as bitmaps, one
+    for each value other than zero that a weekday has in SSHR_DAY_LEAVE_VALUES,
+    with the free days left out.  Checking a day is then a bit test and the
+    number of leave days between two dates is a popcount per bitmap, and a year
+    takes a few hundred bytes.  Values are integers counted in units of
+    SSHR_DAY_LEAVE_UNITS and are only turned into a Decimal number of days once,
+    when returned.
+
+    The affected years are cleared by the FreeDay post_save and post_delete
+    signals.  Those also bump a version number kept in the SSHR_CALENDAR_CACHE
+    Django cache once the change is committed, and every process checks it at
+    the start of each request, or once every SSHR_CALENDAR_CHECK_INTERVAL
+    seconds outside requests, and clears its calendar when it changed.  When
+    there is no cache shared between processes the calendar is cleared at each
+    check instead.
+    """
+
+    def __init__(self):
+        """Initialize the calendar."""
+        self._years: Dict[CalendarYear, FrozenSet[date]] = {}
+        self._bitmaps: Dict[CalendarYear, Tuple[tuple, DayBitmaps]] = {}
+        self._local = threading.local()
+        self._pending = PendingCallbacks()
+        self._version: Optional[int] = None
+        self._checked_at: Optional[float] = None
+
+    @property
+    def shared_cache(self):
+        """Get the Django cache shared by all processes, or None if there is none."""
+        return get_shared_cache(settings.SSHR_CALENDAR_CACHE)
+
+    def _get_version(self) -> Optional[int]:
+        """Get the shared calendar version, or None if it is not available."""
+        cache = self.shared_cache
+        if cache is None:
+            return None
+        stamp = get_version_stamp()
+        try:
+            return cache.get_or_set(VERSION_KEY, stamp, timeout=None)
+        except PROGRAMMING_ERRORS:
+            raise
+        except Exception:  # pylint: disable=broad-except
+            # an unreachable cache is treated like having no shared cache
+            LOGGER.warning("Could not get the shared calendar version", exc_info=True)
+            return None
+
+    def _bump(self):
+        """Bump the shared calendar version, telling other processes to reload."""
+        cache = self.shared_cache
+        if cache is None:
+            return
+        try:
+            cache.incr(VERSION_KEY)
+        except ValueError:
+            # a version that does not exist is set when it is next checked
+            pass
+        except PROGRAMMING_ERRORS:
+            raise
+        except Exception:  # pylint: disable=broad-except
+            # other processes clear their calendars while the cache is unreachable
+            LOGGER.warning("Could not bump the shared calendar version", exc_info=True)
+
+    def expire(self):
+        """Check the shared calendar version the next time the calendar is used."""
+        self._checked_at = None
+
+    def check_version(self):
+        """Clear the calendar if another process changed FreeDay records."""
+        self._checked_at = time.monotonic()
+        version = self._get_version()
+        if version is None or version != self._version:
+            self._clear()
+        self._version = version
+
+    def _get_cache(self) -> Tuple[dict, dict]:
+        """
+        Get the dicts that hold the cached free days and bitmaps.
+
+        While the current transaction holds uncommitted FreeDay changes a cache
+        private to the transaction is used, otherwise a rollback would leave
+        phantom holidays behind in the shared cache.
+        """
+        pending = self._pending.get()
+        if len(pending) != getattr(self._local, "pending_count", 0):
+            # a savepoint was rolled back, or the transaction has ended
+            self._local.pending_count = len(pending)
+            self._local.years, self._local.bitmaps = {}, {}
+        if pending:
+            return self._local.years, self._local.bitmaps
+        interval = settings.SSHR_CALENDAR_CHECK_INTERVAL
+        if self._checked_at is None or time.monotonic() - self._checked_at >= interval:
+            self.check_version()
+        return self._years, self._bitmaps
+
+    def _load(
+        self, start_year: int, end_year: int, calendar_ids: Iterable[Optional[int]]
+    ) -> Dict[CalendarYear, FrozenSet[date]]:
+        """Load free days for the given years and calendars from the database."""
+        calendar_ids = set(calendar_ids)
+        free_day_model = apps.get_model("small_small_hr", "FreeDay")
+        query = Q(calendar_id__in=calendar_ids - {None})
+        if None in calendar_ids:
+            query |= Q(calendar__isnull=True)
+        rows = (
+            free_day_model.objects.filter(
+                query,
+                date__gte=date(start_year, 1, 1),
+                date__lte=date(end_year, 12, 31),
+            )
+            .order_by()
+            .values_list("calendar_id", "date")
+        )
+        years: Dict[CalendarYear, set] = {
+            (calendar_id, year): set()
+            for calendar_id in calendar_ids
+            for year in range(start_year, end_year + 1)
+        }
+        for calendar_id, the_date in rows:
+            years[(calendar_id, the_date.year)].add(the_date)
+        return {key: frozenset(value) for key, value in years.items()}
+
+    def load_calendars(
+        self, start_year: int, end_year: int, calendar_ids: Iterable[Optional[int]]
+    ):
+        """
+        Make sure the free days of many calendars are cached.
+
+        The years missing from any of the calendars are loaded in one query.
+        """
+        years = range(start_year, end_year + 1)
+        cache = self._get_cache()[0]
+        missing = {
+            calendar_id
+            for calendar_id in calendar_ids
+            for year in years
+            if (calendar_id, year) not in cache
+        }
+        if missing:
+            cache.update(self._load(start_year, end_year, missing))
+
+    def get_free_days(
+        self,
+        start_year: int,
+        end_year: Optional[int] = None,
+        calendar_id: Optional[int] = None,
+    ) -> FrozenSet[date]:
+        """Get the free days between start_year and end_year, both inclusive."""
+        end_year = start_year if end_year is None else end_year
+        years = range(start_year, end_year + 1)
+        cache = self._get_cache()[0]
+        loaded: Dict[int, FrozenSet[date]] = {}
+        missing = []
+        for year in years:
+            if (calendar_id, year) in cache:
+                loaded[year] = cache[(calendar_id, year)]
+            else:
+                missing.append(year)
+        if missing:
+            fresh = self._load(min(missing), max(missing), [calendar_id])
+            cache.update(fresh)
+            loaded.update({year: fresh[(calendar_id, year)] for year in missing})
+        if start_year == end_year:
+            return loaded[start_year]
+        return frozenset().union(*loaded.values())
+
+    def is_free_day(self, day: date, calendar_id: Optional[int] = None) -> bool:
+        """Check if a day is a free day."""
+        return day in self.get_free_days(day.year, calendar_id=calendar_id)
+
+    def get_leave_day_bitmaps(
+        self, year: int, calendar_id: Optional[int] = None
+    ) -> DayBitmaps:
+        """
+        Get the days of a year that count as leave, as bitmaps.
+
+        Returns a (units, bitmap) pair for every value other than zero that a
+        weekday has, in units.  Bit i of a bitmap is set if the day i days after
+        1 January is worth that many units and is not a free day.
+        """
+        scale, units = get_day_value_units(settings.SSHR_DAY_LEAVE_VALUES)
+        key = (scale, units)
+        cache = self._get_cache()[1]
+        cached = cache.get((calendar_id, year))
+        if cached is not None and cached[0] == key:
+            return cached[1]
+
+        bitmaps = make_leave_day_bitmaps(
+            year, units, self.get_free_days(year, calendar_id=calendar_id)
+        )
+        cache[(calendar_id, year)] = (key, bitmaps)
+        return bitmaps
+
+    def is_leave_day(self, day: date, calendar_id: Optional[int] = None) -> bool:
+        """Check if a day counts as leave, i.e. it has a value and is not free."""
+        bit = 1 << (day.toordinal() - date(day.year, 1, 1).toordinal())
+        bitmaps = self.get_leave_day_bitmaps(day.year, calendar_id=calendar_id)
+        return any(bitmap & bit for _, bitmap in bitmaps)
+
+    def count_leave_units(
+        self, start: date, end: date, calendar_id: Optional[int] = None
+    ) -> int:
+        """Count the leave days between two dates, both inclusive, in units."""
+        count = 0
+        if end < start:
+            return count
+        # load all the free days in one go
+        self.get_free_days(start.year, end.year, calendar_id=calendar_id)
+        for year in range(start.year, end.year + 1):
+            offset = date(year, 1, 1).toordinal()
+            first = max(start, date(year, 1, 1)).toordinal() - offset
+            last = min(end, date(year, 12, 31)).toordinal() - offset
+            mask = (1 << (last + 1)) - (1 << first)
+            for value, bitmap in self.get_leave_day_bitmaps(year, calendar_id):
+                count += value * popcount(bitmap & mask)
+        return count
+
+    def count_leave_days(
+        self, start: date, end: date, calendar_id: Optional[int] = None
+    ) -> Decimal:
+        """
+        Count the leave days between two dates, both inclusive.
+
+        Takes into account public holidays, weekends and weekend policy
+        """
+        return self.count_many_leave_days([(start, end)], calendar_id=calendar_id)[0]
+
+    def count_many_leave_days(
+        self, intervals: Sequence[Tuple[date, date]], calendar_id: Optional[int] = None
+    ) -> List[Decimal]:
+        """Count the leave days in many (start, end) date intervals at once."""
+        scale = get_day_value_units(settings.SSHR_DAY_LEAVE_VALUES)[0]
+        return [
+            units_to_days(self.count_leave_units(start, end, calendar_id), scale)
+            for start, end in intervals
+        ]
+
+    def _clear(self, years: Optional[Iterable[int]] = None):
+        """Clear the given years of all the calendars from the cache, or everything."""
+        if years is None:
+            self._years.clear()
+            self._bitmaps.clear()
+        else:
+            years = set(years)
+            for cache in (self._years, self._bitmaps):
+                # other threads may fill or clear the cache at the same time, so
+                # iterate over a snapshot of its keys
+                for key in list(cache):
+                    if key[1] in years:
+                        cache.pop(key, None)
+
+    def _changed(self, years: Optional[List[int]] = None):
+        """Clear the given years from the cache, and tell other processes."""
+        self._clear(years)
+        self._bump()
+
+    def invalidate(self, years: Optional[Iterable[int]] = None):
+        """Clear the given years from the cache, or everything."""
+        years = None if years is None else list(years)
+        if connection.in_atomic_block:
+            self._clear(years)
+            # other threads may have cached the calendar before this commit
+            self._pending.add(partial(self._changed, years))
+            self._local.pending_count = len(self._pending.get())
+            self._local.years, self._local.bitmaps = {}, {}
+        else:
+            self._changed(years)
+
+
+def make_leave_day_bitmaps(
+    year: int, units: Sequence[int], free_days: Iterable[date]
+) -> DayBitmaps:
+    """
+    Make the (units, bitmap) pairs of FreeDayCalendar.get_leave_day_bitmaps.
+
+    :param year: the year
+    :param units: the value of each weekday in units, from Monday to Sunday
+    :param free_days: the free days of the year
+    """
+    first_day = date(year, 1, 1)
+    days = date(year, 12, 31).toordinal() - first_day.toordinal() + 1
+    free = 0
+    for the_date in free_days:
+        free |= 1 << (the_date.toordinal() - first_day.toordinal())
+    by_units: Dict[int, int] = {}
+    for weekday, value in enumerate(units):
+        if value:
+            bitmap = 0
+            for i in range((weekday - first_day.weekday()) % 7, days, 7):
+                bitmap |= 1 << i
+            by_units[value] = by_units.get(value, 0) | bitmap & ~free
+    return tuple(sorted(by_units.items()))
+
+
+def get_day_value_scale(day_values: Dict[int, object]) -> int:
+    """Get the smallest power of ten that turns all the day values into integers."""
+    exponents = [
+        Decimal(str(value)).normalize().as_tuple().exponent
+        for value in day_values.values()
+    ]
+    return 10 ** max(0, -min(exponents))  # type: ignore
+
+
+def get_day_value_units(day_values: Dict[int, object]) -> Tuple[int, Tuple[int, ...]]:
+    """
+    Get the weekday values as integer units of a day.
+
+    Returns the number of units in a day, which is SSHR_DAY_LEAVE_UNITS unless
+    some value is not a whole number of those, and the value of each weekday in
+    units starting from Monday.
+    """
+    values = [Decimal(str(day_values[isoweekday])) for isoweekday in range(1, 8)]
+    scale = settings.SSHR_DAY_LEAVE_UNITS
+    if any(value * scale % 1 for value in values):
+        scale = get_day_value_scale(day_values)
+    return scale, tuple(int(value * scale) for value in values)
+
+
+def popcount(value: int) -> int:
+    """Count the bits that are set in a non-negative integer."""
+    return bin(value).count("1")
+
+
+def units_to_days(units: int, scale: int) -> Decimal:
+    """Convert a number of units of a day to a Decimal number of days."""
+    return Decimal(units) / scale
+
+
+free_day_calendar = FreeDayCalendar()  # pylint: disable=invalid-name
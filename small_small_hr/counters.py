@@ -0,0 +1,318 @@
+"""
+Leave day counters module for small_small_hr.
+
+Leave.day_count, AnnualLeave.taken_days and the MonthlyLeaveBalance records are
+counted once and stored, instead of being worked out from the leave history
+every time they are needed.  The functions here recompute them, either for the
+records changed by a signal or in bulk for the management commands.
+"""
+from calendar import monthrange
+from datetime import date, timedelta
+from decimal import Decimal
+from typing import Dict, Iterable, List, Optional, Sequence, Set, Tuple
+
+from django.db import models, transaction
+from django.db.models import F, Q
+
+from small_small_hr.balances import BalanceKey, balance_cache
+from small_small_hr.models import (
+    TWOPLACES,
+    AnnualLeave,
+    Leave,
+    MonthlyLeaveBalance,
+    get_calendar_leave_day_counts,
+    get_leave_day_counts,
+    sum_leave_day_counts,
+)
+
+LEAVE_DAY_COUNT_BATCH_SIZE = 500
+# the Leave fields that get_leave_taken_days needs
+LEAVE_TAKEN_DAYS_FIELDS = [
+    "staff_id",
+    "leave_type",
+    "review_status",
+    "start_date",
+    "end_date",
+    "day_count",
+]
+# (staff_id, leave_type, year), the keys of AnnualLeave.taken_days changes
+TakenDaysKey = Tuple[int, str, int]
+
+
+def update_leave_day_counts(queryset: Optional[models.QuerySet] = None) -> int:
+    """
+    Recompute and store the day count of many leave objects.
+
+    Use this after changing SSHR_DAY_LEAVE_VALUES, or after FreeDay records are
+    changed in bulk and free_day_calendar has been invalidated.  Returns the
+    number of leave objects that changed.
+
+    :param queryset: the Leave objects to update, defaults to all of them
+    """
+    if queryset is None:
+        queryset = Leave.objects.all()
+    queryset = (
+        queryset.order_by()
+        .select_related("staff")
+        .only("id", "staff__calendar", *LEAVE_TAKEN_DAYS_FIELDS)
+    )
+    changed = 0
+    batch: List[Leave] = []
+    for leave_obj in queryset.iterator(chunk_size=LEAVE_DAY_COUNT_BATCH_SIZE):
+        batch.append(leave_obj)
+        if len(batch) == LEAVE_DAY_COUNT_BATCH_SIZE:
+            changed += _update_leave_day_count_batch(batch)
+            batch = []
+    return changed + _update_leave_day_count_batch(batch)
+
+
+def _update_leave_day_count_batch(batch: List[Leave]) -> int:
+    """Recompute and store the day count of a batch of leave objects."""
+    counts = get_calendar_leave_day_counts(
+        [(_.start_date, _.end_date) for _ in batch],
+        calendar_ids=[_.staff.calendar_id for _ in batch],
+    )
+    changed = []
+    taken_days_keys: Set[TakenDaysKey] = set()
+    for leave_obj, count in zip(batch, counts):
+        if leave_obj.day_count != count:
+            leave_obj.day_count = count
+            changed.append(leave_obj)
+            taken_days_keys.update(get_leave_taken_days(leave_obj))
+    Leave.objects.bulk_update(changed, ["day_count"])
+    if taken_days_keys:
+        query = Q()
+        for staff_id, leave_type, year in taken_days_keys:
+            query |= Q(staff_id=staff_id, leave_type=leave_type, year=year)
+        reconcile_taken_days(AnnualLeave.objects.filter(query))
+        update_monthly_leave_balances(
+            (staff_id, year, leave_type)
+            for staff_id, leave_type, year in taken_days_keys
+        )
+    return len(changed)
+
+
+def get_leave_taken_days(leave_obj: Leave) -> Dict[TakenDaysKey, Decimal]:
+    """
+    Get the leave days that a leave object adds to AnnualLeave.taken_days.
+
+    Returns a dict keyed by (staff_id, leave_type, year), which is empty unless
+    the leave is approved.  Leave that spans many years is split between them.
+    """
+    if leave_obj.review_status != Leave.APPROVED:
+        return {}
+    years = range(leave_obj.start_date.year, leave_obj.end_date.year + 1)
+    if len(years) == 1:
+        counts = [leave_obj.day_count]
+    else:
+        counts = get_leave_day_counts(
+            [
+                (
+                    max(leave_obj.start_date, date(year, 1, 1)),
+                    min(leave_obj.end_date, date(year, 12, 31)),
+                )
+                for year in years
+            ],
+            calendar_id=leave_obj.staff.calendar_id,
+        )
+    return {
+        (leave_obj.staff_id, leave_obj.leave_type, year): count
+        for year, count in zip(years, counts)
+    }
+
+
+def update_taken_days(
+    previous: Dict[TakenDaysKey, Decimal],
+    current: Dict[TakenDaysKey, Decimal],
+):
+    """
+    Apply a change in leave days taken to the AnnualLeave.taken_days counters.
+
+    The counters are updated in the database with F expressions so that
+    concurrent changes are not lost.
+
+    :param previous: what get_leave_taken_days returned before the change
+    :param current: what get_leave_taken_days returns after the change
+    """
+    for key in set(previous) | set(current):
+        change = current.get(key, 0) - previous.get(key, 0)
+        if change:
+            staff_id, leave_type, year = key
+            # pylint: disable=no-member
+            AnnualLeave.objects.filter(
+                staff_id=staff_id, leave_type=leave_type, year=year
+            ).update(taken_days=F("taken_days") + change)
+
+
+def reconcile_taken_days(
+    queryset: Optional[models.QuerySet] = None, fix: bool = True
+) -> List[Tuple[AnnualLeave, Decimal]]:
+    """
+    Check AnnualLeave.taken_days counters against the leave history.
+
+    Returns an (annual_leave, counter) tuple for each wrong counter, where counter
+    is the wrong value and annual_leave.taken_days is set to the right value.  The
+    counters are corrected unless fix is False.
+
+    :param queryset: the AnnualLeave objects to check, defaults to all of them
+    :param fix: whether to correct the wrong counters
+    """
+    if queryset is None:
+        queryset = AnnualLeave.objects.all()  # pylint: disable=no-member
+    wrong = []
+    for annual_leave in queryset.order_by().iterator():
+        counter = annual_leave.taken_days
+        annual_leave.taken_days = annual_leave.get_cumulative_leave_taken()
+        if annual_leave.taken_days != counter:
+            wrong.append((annual_leave, counter))
+    if fix:
+        # pylint: disable=no-member
+        AnnualLeave.objects.bulk_update([_[0] for _ in wrong], ["taken_days"])
+        balance_cache.invalidate(
+            (_.staff_id, _.year, _.leave_type) for _, counter in wrong
+        )
+    return wrong
+
+
+def get_balance_key_query(keys: Iterable[BalanceKey]) -> Q:
+    """Get a query that matches the records of many (staff_id, year, leave_type)."""
+    query = Q(pk__in=[])
+    for staff_id, year, leave_type in keys:
+        query |= Q(staff_id=staff_id, year=year, leave_type=leave_type)
+    return query
+
+
+def get_month_intervals(start: date, end: date) -> List[Tuple[int, date, date]]:
+    """Split a (start, end) date interval into (year, start, end) month intervals."""
+    intervals = []
+    first_day = start
+    while first_day <= end:
+        year, month = first_day.year, first_day.month
+        last_day = date(year, month, monthrange(year, month)[1])
+        intervals.append((year, first_day, min(end, last_day)))
+        first_day = last_day + timedelta(days=1)
+    return intervals
+
+
+def get_monthly_taken_days(
+    annual_leaves: Sequence[AnnualLeave],
+) -> Dict[Tuple[int, int, str, int], Decimal]:
+    """
+    Count the approved leave days taken in each month of many AnnualLeave records.
+
+    Returns the days keyed by (staff_id, year, leave_type, month), months without
+    leave are left out.  The approved leave of all the records is loaded in one
+    query and split by month.
+    """
+    keys = {(_.staff_id, _.year, _.leave_type) for _ in annual_leaves}
+    years = [_.year for _ in annual_leaves]
+    # pylint: disable=no-member
+    queryset = Leave.objects.filter(
+        staff_id__in={_.staff_id for _ in annual_leaves},
+        leave_type__in={_.leave_type for _ in annual_leaves},
+        review_status=Leave.APPROVED,
+    ).overlapping_years(min(years), max(years))
+    rows = []
+    for staff_id, leave_type, start_date, end_date, calendar_id in (
+        queryset.order_by().values_list(
+            "staff_id", "leave_type", "start_date", "end_date", "staff__calendar_id"
+        )
+    ):
+        for year, first_day, last_day in get_month_intervals(start_date, end_date):
+            if (staff_id, year, leave_type) in keys:
+                key = (staff_id, year, leave_type, first_day.month)
+                rows.append((key, first_day, last_day, calendar_id))
+    return sum_leave_day_counts(rows)
+
+
+def get_monthly_leave_balances(
+    annual_leaves: Sequence[AnnualLeave],
+) -> List[MonthlyLeaveBalance]:
+    """
+    Work out the monthly leave balances of many AnnualLeave records.
+
+    Returns twelve unsaved MonthlyLeaveBalance objects per AnnualLeave record, so
+    that the closing balance of a month is what get_available_leave_days returns
+    once the leave taken up to the end of that month is all the leave taken.
+    """
+    if not annual_leaves:
+        return []
+    taken = get_monthly_taken_days(annual_leaves)
+    balances = []
+    for annual_leave in annual_leaves:
+        key = (annual_leave.staff_id, annual_leave.year, annual_leave.leave_type)
+        accrued = annual_leave.get_earned_leave_days(1).quantize(TWOPLACES)
+        closing = Decimal(annual_leave.carried_over_days)
+        taken_so_far = Decimal(0)
+        for month in range(1, 13):
+            month_taken = taken.get(key + (month,), Decimal(0))
+            taken_so_far += month_taken
+            opening = closing
+            closing = (
+                annual_leave.carried_over_days
+                + annual_leave.get_earned_leave_days(month)
+                - taken_so_far
+            )
+            balances.append(
+                MonthlyLeaveBalance(
+                    staff_id=annual_leave.staff_id,
+                    year=annual_leave.year,
+                    month=month,
+                    leave_type=annual_leave.leave_type,
+                    opening_days=opening.quantize(TWOPLACES),
+                    accrued_days=accrued,
+                    taken_days=month_taken.quantize(TWOPLACES),
+                    closing_days=closing.quantize(TWOPLACES),
+                )
+            )
+    return balances
+
+
+def save_monthly_leave_balances(keys: Iterable[BalanceKey]) -> int:
+    """
+    Replace the MonthlyLeaveBalance records of many (staff_id, year, leave_type).
+
+    The matching AnnualLeave records are locked first, so that concurrent changes
+    to the same balances are applied one after the other.  Keys without an
+    AnnualLeave record lose their monthly balances.  Returns the number of
+    records created.
+    """
+    query = get_balance_key_query(keys)
+    with transaction.atomic():
+        # pylint: disable=no-member
+        annual_leaves = list(
+            AnnualLeave.objects.select_for_update()
+            .filter(query)
+            .order_by("pk")
+            .only("staff_id", "year", "leave_type", "allowed_days", "carried_over_days")
+        )
+        MonthlyLeaveBalance.objects.filter(query).delete()
+        balances = MonthlyLeaveBalance.objects.bulk_create(
+            get_monthly_leave_balances(annual_leaves)
+        )
+    return len(balances)
+
+
+def update_monthly_leave_balances(keys: Iterable[BalanceKey]) -> int:
+    """
+    Bring existing MonthlyLeaveBalance records up to date.
+
+    Only keys that already have monthly balances are updated, making them in the
+    first place is left to the create_monthly_leave_balances job.  Returns the
+    number of records created.
+
+    :param keys: the (staff_id, year, leave_type) of the changed balances
+    """
+    keys = set(keys)
+    if not keys:
+        return 0
+    # pylint: disable=no-member
+    existing = set(
+        MonthlyLeaveBalance.objects.filter(get_balance_key_query(keys))
+        .order_by()
+        .values_list("staff_id", "year", "leave_type")
+        .distinct()
+    )
+    if not existing:
+        return 0
+    return save_monthly_leave_balances(existing)
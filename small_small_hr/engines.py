@@ -0,0 +1,180 @@
+"""
+Leave day counting engines for small_small_hr.
+
+The default engine counts leave days in Python, from bitmaps of the leave days
+of each year kept by the FreeDay calendar in small_small_hr.calendars.  When
+numpy is installed, setting SSHR_LEAVE_DAY_ENGINE to "numpy" counts many leave
+intervals at once with vectorized operations.  Setting it to "sql" computes taken
+leave days inside PostgreSQL.
+"""
+from datetime import date
+from decimal import Decimal
+from typing import Dict, FrozenSet, List, Sequence, Tuple
+
+from django.apps import apps
+from django.conf import settings
+from django.db import connection
+
+from small_small_hr.calendars import (
+    get_day_value_units,
+    units_to_days,
+)
+
+try:
+    import numpy
+except ImportError:  # pragma: no cover
+    numpy = None  # type: ignore # pylint: disable=invalid-name
+
+PYTHON_ENGINE = "python"
+NUMPY_ENGINE = "numpy"
+SQL_ENGINE = "sql"
+# the largest multiplier used to turn fractional day values into integers
+MAX_DAY_VALUE_SCALE = 10 ** 6
+
+
+def use_numpy_engine() -> bool:
+    """
+    Check if the numpy engine is configured and can be used.
+
+    Falls back to the Python engine if numpy is not installed or if the day
+    values cannot be represented as integers of a reasonable scale.
+    """
+    return (
+        settings.SSHR_LEAVE_DAY_ENGINE == NUMPY_ENGINE
+        and numpy is not None
+        and get_day_value_units(settings.SSHR_DAY_LEAVE_VALUES)[0]
+        <= MAX_DAY_VALUE_SCALE
+    )
+
+
+def numpy_leave_day_counts(
+    intervals: Sequence[Tuple[date, date]],
+    free_days: FrozenSet[date],
+    day_values: Dict[int, object],
+) -> List[Decimal]:
+    """
+    Count the leave days in each (start, end) interval using numpy.
+
+    Both ends of an interval are inclusive.  When every weekday is worth either
+    0 or 1 day this is numpy.busday_count, otherwise the counts are differences
+    of a prefix sum of the weighted days.
+    """
+    if not intervals:
+        return []
+
+    starts = numpy.array([_[0] for _ in intervals], dtype="datetime64[D]")
+    ends = numpy.array([_[1] for _ in intervals], dtype="datetime64[D]") + 1
+    ends = numpy.maximum(starts, ends)
+    holidays = numpy.array(sorted(free_days), dtype="datetime64[D]")
+    values = [day_values[isoweekday] for isoweekday in range(1, 8)]
+
+    if all(value in (0, 1) for value in values) and any(values):
+        weekmask = "".join("1" if value else "0" for value in values)
+        counts = numpy.busday_count(starts, ends, weekmask=weekmask, holidays=holidays)
+        return [Decimal(int(count)) for count in counts]
+    return numpy_weighted_day_counts(starts, ends, holidays, day_values)
+
+
+def numpy_weighted_day_counts(
+    starts: "numpy.ndarray",
+    ends: "numpy.ndarray",
+    holidays: "numpy.ndarray",
+    day_values: Dict[int, object],
+) -> List[Decimal]:
+    """
+    Count the leave days in each [start, end) interval, weighted by day_values.
+
+    The counts are differences of a prefix sum of the weighted days, which are
+    summed as integer units of a day.
+    """
+    scale, day_units = get_day_value_units(day_values)
+    units = numpy.array(day_units, dtype=numpy.int64)
+    first = starts.min()
+    days = numpy.arange(first, ends.max(), dtype="datetime64[D]")
+    # 1970-01-01 was a Thursday, so shift by 3 to get Monday as 0
+    weights = units[(days.astype(numpy.int64) + 3) % 7]
+    weights[numpy.isin(days, holidays)] = 0
+    cumulative = numpy.concatenate(([0], numpy.cumsum(weights)))
+    totals = (
+        cumulative[(ends - first).astype(numpy.int64)]
+        - cumulative[(starts - first).astype(numpy.int64)]
+    )
+    return [units_to_days(int(total), scale) for total in totals]
+
+
+def use_sql_engine() -> bool:
+    """Check if the sql engine is configured."""
+    return settings.SSHR_LEAVE_DAY_ENGINE == SQL_ENGINE
+
+
+def get_day_value_case_sql(column: str) -> Tuple[str, List[object]]:
+    """Get SQL that maps a date column to its value in SSHR_DAY_LEAVE_VALUES."""
+    whens = " ".join("WHEN %s THEN %s" for _ in range(7))
+    params: List[object] = []
+    for isoweekday in range(1, 8):
+        value = settings.SSHR_DAY_LEAVE_VALUES[isoweekday]
+        params += [isoweekday, Decimal(str(value))]
+    return f"CASE EXTRACT(ISODOW FROM {column})::integer {whens} END", params
+
+
+def get_taken_leave_days_sql() -> Tuple[str, List[object]]:
+    """
+    Get the SQL of sql_taken_leave_days, with the params of its day values.
+
+    The SQL still needs the first day, last day, staff id, status, leave type,
+    last day and first day params, in that order.
+    """
+    # pylint: disable=protected-access
+    leave_table = apps.get_model("small_small_hr", "Leave")._meta.db_table
+    free_day_table = apps.get_model("small_small_hr", "FreeDay")._meta.db_table
+    staff_table = apps.get_model("small_small_hr", "StaffProfile")._meta.db_table
+    day_value_sql, day_value_params = get_day_value_case_sql("leave_day")
+    sql = f"""
+        SELECT COALESCE(SUM({day_value_sql}), 0)
+        FROM {leave_table} AS leave_obj
+        INNER JOIN {staff_table} AS staff ON staff.id = leave_obj.staff_id
+        CROSS JOIN LATERAL generate_series(
+            GREATEST(leave_obj.start_date, %s),
+            LEAST(leave_obj.end_date, %s),
+            interval '1 day'
+        ) AS leave_day
+        WHERE leave_obj.staff_id = %s
+        AND leave_obj.review_status = %s
+        AND leave_obj.leave_type = %s
+        AND leave_obj.start_date <= %s
+        AND leave_obj.end_date >= %s
+        AND NOT EXISTS (
+            SELECT 1 FROM {free_day_table} AS free_day
+            WHERE free_day.date = leave_day::date
+            AND free_day.calendar_id IS NOT DISTINCT FROM staff.calendar_id
+        )
+    """
+    return sql, day_value_params
+
+
+def sql_taken_leave_days(
+    staffprofile: object, status: str, leave_type: str, start_year: int, end_year: int
+) -> Decimal:
+    """
+    Calculate the number of leave days taken using a single PostgreSQL query.
+
+    Each Leave is expanded into its dates with generate_series, clipped to
+    the given years, the FreeDay dates of the staff member's HolidayCalendar are
+    excluded and the rest are weighted by SSHR_DAY_LEAVE_VALUES.
+    """
+    first_day = date(start_year, 1, 1)
+    last_day = date(end_year, 12, 31)
+    sql, params = get_taken_leave_days_sql()
+    params += [
+        first_day,
+        last_day,
+        getattr(staffprofile, "pk", staffprofile),
+        status,
+        leave_type,
+        last_day,
+        first_day,
+    ]
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        (count,) = cursor.fetchone()
+    return Decimal(count)
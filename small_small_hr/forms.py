@@ -1,13 +1,13 @@
 """Forms module for small small hr."""
 from datetime import datetime, time
+from typing import Optional
 
 from django import forms
 from django.conf import settings
 from django.contrib.auth.models import User  # pylint: disable = imported-auth-user
-from django.db.models import Q
+from django.utils import timezone
 from django.utils.translation import ugettext as _
 
-import pytz
 from crispy_forms.bootstrap import Field, FormActions
 from crispy_forms.helper import FormHelper
 from crispy_forms.layout import Layout, Submit
@@ -15,15 +15,16 @@ from phonenumber_field.formfields import PhoneNumberField
 from phonenumber_field.phonenumber import PhoneNumber
 
 from small_small_hr.models import (
-    TWOPLACES,
     AnnualLeave,
     FreeDay,
+    HolidayCalendar,
     Leave,
     OverTime,
     Role,
     StaffDocument,
     StaffProfile,
 )
+from small_small_hr.utils import validate_leave_applications
 
 
 class AnnualLeaveForm(forms.ModelForm):
@@ -85,6 +86,33 @@ class RoleForm(forms.ModelForm):
         )
 
 
+class HolidayCalendarForm(forms.ModelForm):
+    """Form used when managing HolidayCalendar objects."""
+
+    class Meta:  # pylint: disable=too-few-public-methods
+        """Class meta options."""
+
+        model = HolidayCalendar
+        fields = ["name", "description"]
+
+    def __init__(self, *args, **kwargs):
+        """Initialize the form."""
+        self.request = kwargs.pop("request", None)
+        super().__init__(*args, **kwargs)
+        self.helper = FormHelper()
+        self.helper.form_tag = True
+        self.helper.form_method = "post"
+        self.helper.render_required_fields = True
+        self.helper.form_show_labels = True
+        self.helper.html5_required = True
+        self.helper.form_id = "holidaycalendar-form"
+        self.helper.layout = Layout(
+            Field("name",),
+            Field("description",),
+            FormActions(Submit("submitBtn", _("Submit"), css_class="btn-primary"),),
+        )
+
+
 class FreeDayForm(forms.ModelForm):
     """Form used when managing FreeDay objects."""
 
@@ -92,7 +120,7 @@ class FreeDayForm(forms.ModelForm):
         """Class meta options."""
 
         model = FreeDay
-        fields = ["name", "date"]
+        fields = ["name", "date", "calendar"]
 
     def __init__(self, *args, **kwargs):
         """Initialize the form."""
@@ -108,6 +136,7 @@ class FreeDayForm(forms.ModelForm):
         self.helper.layout = Layout(
             Field("name",),
             Field("date",),
+            Field("calendar",),
             FormActions(Submit("submitBtn", _("Submit"), css_class="btn-primary"),),
         )
 
@@ -162,20 +191,27 @@ class OverTimeForm(forms.ModelForm):
         if end <= start:
             self.add_error("end", _("end must be greater than start"))
 
-        # must not overlap within the same date unless being rejected
-        # pylint: disable=no-member
-        overlap_qs = OverTime.objects.filter(
-            date=date, staff=staff, review_status=OverTime.APPROVED
-        ).filter(Q(start__gte=start) & Q(end__lte=end))
+        # must not overlap within the same date unless being rejected.  Overtime
+        # approved at the same time can still overlap, which the database
+        # constraint catches by making save() raise IntegrityError
+        if review_status != OverTime.REJECTED:
+            # pylint: disable=no-member
+            overlap_qs = OverTime.objects.filter(
+                date=date,
+                staff=staff,
+                review_status=OverTime.APPROVED,
+                start__lt=end,
+                end__gt=start,
+            )
 
-        if self.instance is not None:
-            overlap_qs = overlap_qs.exclude(id=self.instance.id)
+            if self.instance is not None:
+                overlap_qs = overlap_qs.exclude(id=self.instance.id)
 
-        if overlap_qs.exists() and review_status != OverTime.REJECTED:
-            msg = _("you cannot have overlapping overtime hours on the " "same day")
-            self.add_error("start", msg)
-            self.add_error("end", msg)
-            self.add_error("date", msg)
+            if overlap_qs.exists():
+                msg = _("you cannot have overlapping overtime hours on the same day")
+                self.add_error("start", msg)
+                self.add_error("end", msg)
+                self.add_error("date", msg)
 
 
 class ApplyOverTimeForm(OverTimeForm):
@@ -230,7 +266,15 @@ class ApplyOverTimeForm(OverTimeForm):
 
 
 class LeaveForm(forms.ModelForm):
-    """Form used when managing Leave objects."""
+    """
+    Form used when managing Leave objects.
+
+    The leave balance is checked when the form is cleaned, without locking it,
+    so forms that approve leave at the same time can spend the same days.
+    Callers that must not oversubscribe should save the leave as pending and
+    approve it with small_small_hr.utils.approve_leave, which checks the balance
+    again under a lock and raises ValidationError if the days are gone.
+    """
 
     start = forms.DateField(label=_("Start Date"), required=True)
     end = forms.DateField(label=_("End Date"), required=True)
@@ -251,6 +295,8 @@ class LeaveForm(forms.ModelForm):
     def __init__(self, *args, **kwargs):
         """Initialize the form."""
         self.request = kwargs.pop("request", None)
+        # BaseLeaveFormSet validates the leave of all its forms together
+        self.validate_leave = kwargs.pop("validate_leave", True)
         super().__init__(*args, **kwargs)
         self.helper = FormHelper()
         self.helper.form_tag = True
@@ -275,7 +321,8 @@ class LeaveForm(forms.ModelForm):
         data = datetime.combine(
             date=data,
             time=time(settings.SSHR_DEFAULT_TIME, 0, 0, 0),
-            tzinfo=pytz.timezone(settings.TIME_ZONE),
+            # the default timezone is cached and reset when TIME_ZONE changes
+            tzinfo=timezone.get_default_timezone(),
         )
         return data
 
@@ -285,7 +332,8 @@ class LeaveForm(forms.ModelForm):
         data = datetime.combine(
             date=data,
             time=time(settings.SSHR_DEFAULT_TIME, 0, 0, 0),
-            tzinfo=pytz.timezone(settings.TIME_ZONE),
+            # the default timezone is cached and reset when TIME_ZONE changes
+            tzinfo=timezone.get_default_timezone(),
         )
         return data
 
@@ -296,9 +344,10 @@ class LeaveForm(forms.ModelForm):
         staff = cleaned_data.get("staff")
         end = cleaned_data.get("end")
         start = cleaned_data.get("start")
-        review_status = cleaned_data.get("review_status")
 
         if all([staff, leave_type, start, end]):
+            leave_obj = self.get_leave_application()
+
             # end year and start year must be the same
             if end.year != start.year:
                 msg = _("start and end must be from the same year")
@@ -309,42 +358,34 @@ class LeaveForm(forms.ModelForm):
             if end < start:
                 self.add_error("end", _("end must be greater than start"))
 
-            if not settings.SSHR_ALLOW_OVERSUBSCRIBE:
-                # staff profile must have sufficient sick days
-                if leave_type == Leave.SICK:
-                    sick_days = staff.get_available_sick_days(year=start.year)
-                    if (end - start).days > sick_days:
-                        msg = _(
-                            "Not enough sick days. Available sick days "
-                            f"are {sick_days.quantize(TWOPLACES)}"
-                        )
-                        self.add_error("start", msg)
-                        self.add_error("end", msg)
-
-                # staff profile must have sufficient leave days
-                if leave_type == Leave.REGULAR:
-                    leave_days = staff.get_available_leave_days(year=start.year)
-                    if (end - start).days > leave_days:
-                        msg = _(
-                            "Not enough leave days. Available leave days "
-                            f"are {leave_days.quantize(TWOPLACES)}"
-                        )
-                        self.add_error("start", msg)
-                        self.add_error("end", msg)
-
-            # must not overlap unless it is being rejected
-            # pylint: disable=no-member
-            overlap_qs = Leave.objects.filter(
-                staff=staff, review_status=Leave.APPROVED, leave_type=leave_type
-            ).filter(Q(start__gte=start) & Q(end__lte=end))
-
-            if self.instance is not None:
-                overlap_qs = overlap_qs.exclude(id=self.instance.id)
-
-            if overlap_qs.exists() and review_status != Leave.REJECTED:
-                msg = _("you cannot have overlapping leave days")
-                self.add_error("start", msg)
-                self.add_error("end", msg)
+            # staff profile must have sufficient leave days, and the leave must
+            # not overlap approved leave.  Leave approved at the same time can
+            # still overlap, which the database constraint catches by making
+            # save() raise IntegrityError
+            if self.validate_leave:
+                for msg in validate_leave_applications([leave_obj])[0]:
+                    self.add_error("start", msg)
+                    self.add_error("end", msg)
+
+    def get_leave_application(self) -> Optional[Leave]:
+        """
+        Get the leave as it would be saved by this form, for validation.
+
+        Returns None unless the staff, leave type, start and end are all valid.
+        """
+        fields = ["staff", "leave_type", "start", "end"]
+        if not all(self.cleaned_data.get(field) for field in fields):
+            return None
+        return Leave(
+            id=self.instance.pk,
+            staff=self.cleaned_data["staff"],
+            leave_type=self.cleaned_data["leave_type"],
+            start=self.cleaned_data["start"],
+            end=self.cleaned_data["end"],
+            review_status=self.cleaned_data.get(
+                "review_status", self.instance.review_status
+            ),
+        )
 
 
 class ApplyLeaveForm(LeaveForm):
@@ -398,6 +439,47 @@ class ApplyLeaveForm(LeaveForm):
         return leave
 
 
+class BaseLeaveFormSet(forms.BaseModelFormSet):
+    """
+    Formset used when managing many Leave objects at once.
+
+    The leave of all the forms is validated together, see
+    validate_leave_applications, so the number of queries does not depend on
+    the number of forms.
+    """
+
+    def get_form_kwargs(self, index):
+        """Get the keyword arguments of a form."""
+        kwargs = super().get_form_kwargs(index)
+        kwargs["validate_leave"] = False
+        return kwargs
+
+    def clean(self):
+        """Validate the leave of all the forms."""
+        super().clean()
+        leave_forms = []
+        leave_objs = []
+        for form in self.forms:
+            if self.can_delete and self._should_delete_form(form):
+                continue
+            if not form.has_changed():
+                continue
+            leave_obj = form.get_leave_application()
+            if leave_obj is not None:
+                leave_forms.append(form)
+                leave_objs.append(leave_obj)
+        errors = validate_leave_applications(leave_objs)
+        for form, messages in zip(leave_forms, errors):
+            for msg in messages:
+                form.add_error("start", msg)
+                form.add_error("end", msg)
+
+
+LeaveFormSet = forms.modelformset_factory(  # pylint: disable=invalid-name
+    Leave, form=LeaveForm, formset=BaseLeaveFormSet, extra=0
+)
+
+
 class StaffDocumentForm(forms.ModelForm):
     """Form used when managing StaffDocument objects."""
 
@@ -513,6 +595,7 @@ class StaffProfileAdminForm(forms.ModelForm):
             "phone",
             "sex",
             "role",
+            "calendar",
             "nhif",
             "nssf",
             "pin_number",
@@ -551,6 +634,7 @@ class StaffProfileAdminForm(forms.ModelForm):
             Field("id_number",),
             Field("sex",),
             Field("role",),
+            Field("calendar",),
             Field("nhif",),
             Field("nssf",),
             Field("pin_number",),
@@ -668,6 +752,7 @@ class StaffProfileAdminCreateForm(StaffProfileAdminForm):
             "phone",
             "sex",
             "role",
+            "calendar",
             "nhif",
             "nssf",
             "pin_number",
@@ -706,6 +791,7 @@ class StaffProfileAdminCreateForm(StaffProfileAdminForm):
             Field("id_number",),
             Field("sex",),
             Field("role",),
+            Field("calendar",),
             Field("nhif",),
             Field("nssf",),
             Field("pin_number",),
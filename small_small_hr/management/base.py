@@ -0,0 +1,31 @@
+"""Base classes of the small_small_hr management commands."""
+from django.core.management.base import BaseCommand
+
+from small_small_hr.utils import ROLLOVER_BATCH_SIZE
+
+
+class StaffBatchCommand(BaseCommand):  # pylint: disable=abstract-method
+    """
+    Base class of commands that handle all the staff members for a year.
+
+    The staff members are handled in batches of --batch-size, and the progress is
+    written after each batch.
+    """
+
+    year_help = "The year to handle, defaults to this year."
+
+    def add_arguments(self, parser):
+        """Add command arguments."""
+        parser.add_argument(
+            "--year", type=int, default=None, help=self.year_help,
+        )
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=ROLLOVER_BATCH_SIZE,
+            help="The number of staff members handled at once.",
+        )
+
+    def write_progress(self, done: int, total: int):
+        """Write how many staff members have been handled."""
+        self.stdout.write(f"Processed {done} of {total} staff members.")
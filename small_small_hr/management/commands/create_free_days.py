@@ -0,0 +1,53 @@
+"""Management command to create FreeDay objects."""
+from django.core.management.base import BaseCommand, CommandError
+
+from small_small_hr.models import HolidayCalendar
+from small_small_hr.utils import create_free_days
+
+
+class Command(BaseCommand):
+    """
+    Create the FreeDay objects of many years from SSHR_FREE_DAYS.
+
+    Free days that already exist are left alone, so this can be run again.
+    """
+
+    help = "Create the FreeDay objects of many years from SSHR_FREE_DAYS."
+
+    def add_arguments(self, parser):
+        """Add command arguments."""
+        parser.add_argument(
+            "--start-year",
+            type=int,
+            default=None,
+            help="The first year to create FreeDay objects for, defaults to this year.",
+        )
+        parser.add_argument(
+            "--years",
+            type=int,
+            default=11,
+            help="The number of years to create FreeDay objects for.",
+        )
+        parser.add_argument(
+            "--calendar",
+            default=None,
+            help="The name of the holiday calendar, defaults to the default calendar.",
+        )
+
+    def handle(self, *args, **options):
+        """Handle the command."""
+        calendar = None
+        if options["calendar"] is not None:
+            try:
+                # pylint: disable=no-member
+                calendar = HolidayCalendar.objects.get(name=options["calendar"])
+            except HolidayCalendar.DoesNotExist as error:
+                raise CommandError(
+                    f"Holiday calendar {options['calendar']} does not exist."
+                ) from error
+        created = create_free_days(
+            start_year=options["start_year"],
+            number_of_years=options["years"],
+            calendar=calendar,
+        )
+        self.stdout.write(self.style.SUCCESS(f"Created {created} free days."))
@@ -0,0 +1,31 @@
+"""Management command to create the MonthlyLeaveBalance objects of a year."""
+from django.utils import timezone
+
+from small_small_hr.management.base import StaffBatchCommand
+from small_small_hr.utils import create_monthly_leave_balances
+
+
+class Command(StaffBatchCommand):
+    """
+    Create the MonthlyLeaveBalance objects of a year for all staff members.
+
+    Existing MonthlyLeaveBalance objects of the year are replaced.  Once created
+    they are kept up to date as leave, annual leave and free days change.
+    """
+
+    help = "Create the MonthlyLeaveBalance objects of a year for all staff members."
+    year_help = (
+        "The year to create MonthlyLeaveBalance objects for, defaults to this year."
+    )
+
+    def handle(self, *args, **options):
+        """Handle the command."""
+        year = options["year"] or timezone.now().year
+        created = create_monthly_leave_balances(
+            year, batch_size=options["batch_size"], progress=self.write_progress
+        )
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"Created {created} monthly leave balance objects for {year}."
+            )
+        )
@@ -0,0 +1,31 @@
+"""Management command to recompute the carried over days of AnnualLeave objects."""
+from django.core.management.base import BaseCommand
+
+from small_small_hr.utils import recompute_carry_over
+
+
+class Command(BaseCommand):
+    """
+    Recompute the carried over days of regular AnnualLeave objects.
+
+    Run this after leave in a past year was corrected, so that the change carries
+    through to the years that follow.
+    """
+
+    help = "Recompute the carried over days of regular AnnualLeave objects."
+
+    def add_arguments(self, parser):
+        """Add command arguments."""
+        parser.add_argument(
+            "--from-year",
+            type=int,
+            default=None,
+            help="Do not change AnnualLeave objects of earlier years.",
+        )
+
+    def handle(self, *args, **options):
+        """Handle the command."""
+        changed = recompute_carry_over(from_year=options["from_year"])
+        self.stdout.write(
+            self.style.SUCCESS(f"Updated {changed} annual leave objects.")
+        )
@@ -0,0 +1,41 @@
+"""Management command to check the taken days counters of AnnualLeave objects."""
+from django.core.management.base import BaseCommand
+
+from small_small_hr.counters import reconcile_taken_days
+from small_small_hr.models import TWOPLACES, AnnualLeave
+
+
+class Command(BaseCommand):
+    """
+    Check the taken days counters of AnnualLeave objects against the leave history.
+
+    Wrong counters are listed, and corrected if --fix is given.
+    """
+
+    help = "Check the taken days counters of AnnualLeave objects."
+
+    def add_arguments(self, parser):
+        """Add command arguments."""
+        parser.add_argument(
+            "--year", type=int, default=None, help="Only check this year.",
+        )
+        parser.add_argument(
+            "--fix", action="store_true", help="Correct the wrong counters.",
+        )
+
+    def handle(self, *args, **options):
+        """Handle the command."""
+        queryset = AnnualLeave.objects.all()  # pylint: disable=no-member
+        if options["year"]:
+            queryset = queryset.filter(year=options["year"])
+        wrong = reconcile_taken_days(queryset, fix=options["fix"])
+        for annual_leave, counter in wrong:
+            taken = annual_leave.taken_days.quantize(TWOPLACES)
+            self.stdout.write(
+                f"{annual_leave}: the counter is {counter.quantize(TWOPLACES)} "
+                f"but {taken} days were taken."
+            )
+        if options["fix"]:
+            self.stdout.write(self.style.SUCCESS(f"Fixed {len(wrong)} counters."))
+        else:
+            self.stdout.write(f"Found {len(wrong)} wrong counters.")
@@ -0,0 +1,27 @@
+"""Management command to create the AnnualLeave objects of a year."""
+from django.utils import timezone
+
+from small_small_hr.management.base import StaffBatchCommand
+from small_small_hr.utils import rollover_annual_leave
+
+
+class Command(StaffBatchCommand):
+    """
+    Create the AnnualLeave objects of a year for all active staff members.
+
+    Leave days remaining at the end of the previous year are carried over, up to
+    SSHR_MAX_CARRY_OVER.  Existing AnnualLeave objects are left alone.
+    """
+
+    help = "Create the AnnualLeave objects of a year for all active staff members."
+    year_help = "The year to create AnnualLeave objects for, defaults to this year."
+
+    def handle(self, *args, **options):
+        """Handle the command."""
+        year = options["year"] or timezone.now().year
+        created = rollover_annual_leave(
+            year, batch_size=options["batch_size"], progress=self.write_progress
+        )
+        self.stdout.write(
+            self.style.SUCCESS(f"Created {created} annual leave objects for {year}.")
+        )
@@ -0,0 +1,35 @@
+"""Management command to recompute the day count of Leave objects."""
+from django.core.management.base import BaseCommand
+
+from small_small_hr.calendars import free_day_calendar
+from small_small_hr.counters import update_leave_day_counts
+from small_small_hr.models import Leave
+
+
+class Command(BaseCommand):
+    """
+    Recompute and store the day count of Leave objects.
+
+    Run this to backfill existing Leave objects, and whenever FreeDay records are
+    changed in bulk or SSHR_DAY_LEAVE_VALUES is changed.
+    """
+
+    help = "Recompute and store the day count of Leave objects."
+
+    def add_arguments(self, parser):
+        """Add command arguments."""
+        parser.add_argument(
+            "--year",
+            type=int,
+            default=None,
+            help="Only update leave that includes days in this year.",
+        )
+
+    def handle(self, *args, **options):
+        """Handle the command."""
+        free_day_calendar.invalidate()
+        queryset = Leave.objects.all()  # pylint: disable=no-member
+        if options["year"]:
+            queryset = queryset.overlapping_years(options["year"], options["year"])
+        changed = update_leave_day_counts(queryset)
+        self.stdout.write(self.style.SUCCESS(f"Updated {changed} leave objects."))
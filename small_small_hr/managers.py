@@ -1,10 +1,42 @@
 """
 Small small HR model managers module
 """
+from datetime import date
+
 from django.db import models
 
 
-class LeaveManager(models.Manager):  # pylint: disable=too-few-public-methods
+class LeaveQuerySet(models.QuerySet):
+    """
+    Custom queryset for Leave model
+    """
+
+    def overlapping(self, first_day: date, last_day: date):
+        """
+        Get leave that includes at least one day between first_day and last_day
+
+        Both days are inclusive and are compared to the local leave dates
+        """
+        return self.filter(start_date__lte=last_day, end_date__gte=first_day)
+
+    def overlapping_years(self, start_year: int, end_year: int):
+        """
+        Get leave that includes at least one day between start_year and end_year
+        """
+        return self.overlapping(date(start_year, 1, 1), date(end_year, 12, 31))
+
+    def within_years(self, start_year: int, end_year: int):
+        """
+        Get leave whose days all fall between start_year and end_year
+        """
+        return self.filter(
+            start_date__gte=date(start_year, 1, 1), end_date__lte=date(end_year, 12, 31)
+        )
+
+
+class LeaveManager(  # pylint: disable=too-few-public-methods
+    models.Manager.from_queryset(LeaveQuerySet)  # type: ignore
+):
     """
     Custom manager for Leave model
     """
@@ -15,3 +47,40 @@ class LeaveManager(models.Manager):  # pylint: disable=too-few-public-methods
         """
         return super().get_queryset().annotate(
             duration=models.F('end')-models.F('start'))
+
+
+class AnnualLeaveQuerySet(models.QuerySet):
+    """
+    Custom queryset for AnnualLeave model
+    """
+
+    def with_balances(self, month: int = 12):
+        """
+        Annotate the leave days earned and available
+
+        The annotations are earned_days and available_days, computed in the
+        database from the taken_days counter the same way as
+        AnnualLeave.get_available_leave_days
+        """
+        month = min(max(month, 1), 12)
+        decimal_field = models.DecimalField(max_digits=20, decimal_places=10)
+        return self.annotate(
+            earned_days=models.ExpressionWrapper(
+                models.F("allowed_days") * month / 12, output_field=decimal_field
+            ),
+        ).annotate(
+            available_days=models.ExpressionWrapper(
+                models.F("earned_days")
+                + models.F("carried_over_days")
+                - models.F("taken_days"),
+                output_field=decimal_field,
+            )
+        )
+
+
+class AnnualLeaveManager(  # pylint: disable=too-few-public-methods
+    models.Manager.from_queryset(AnnualLeaveQuerySet)  # type: ignore
+):
+    """
+    Custom manager for AnnualLeave model
+    """
@@ -0,0 +1,44 @@
+# Generated by Django 3.1.14 on 2026-10-17 03:51
+
+from datetime import timedelta
+from decimal import Decimal
+
+from django.conf import settings
+from django.db import migrations, models
+from django.utils import timezone
+
+
+def set_day_counts(apps, schema_editor):
+    """Count the leave days of existing leave."""
+    FreeDay = apps.get_model('small_small_hr', 'FreeDay')
+    Leave = apps.get_model('small_small_hr', 'Leave')
+    default_tz = timezone.get_default_timezone()
+    free_days = set(FreeDay.objects.values_list('date', flat=True))
+    changed = []
+    for leave_obj in Leave.objects.only('id', 'start', 'end').iterator():
+        day = default_tz.normalize(leave_obj.start).date()
+        end_date = default_tz.normalize(leave_obj.end).date()
+        day_count = Decimal(0)
+        while day <= end_date:
+            if day not in free_days:
+                day_count += Decimal(str(settings.SSHR_DAY_LEAVE_VALUES[day.isoweekday()]))
+            day += timedelta(days=1)
+        leave_obj.day_count = day_count
+        changed.append(leave_obj)
+    Leave.objects.bulk_update(changed, ['day_count'], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('small_small_hr', '0011_auto_20220131_1640'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='leave',
+            name='day_count',
+            field=models.DecimalField(decimal_places=2, default=0, editable=False, help_text='Number of leave days, excluding free days and weekends.', max_digits=12, verbose_name='Day count'),
+        ),
+        migrations.RunPython(set_day_counts, migrations.RunPython.noop),
+    ]
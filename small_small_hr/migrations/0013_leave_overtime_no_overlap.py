@@ -0,0 +1,126 @@
+from datetime import datetime
+
+from django.db import migrations, models
+import django.db.models.expressions
+
+# btree_gist is not needed: the equality columns are compared as single value
+# ranges so that the constraints only use the built-in range operator classes
+
+LEAVE_CONSTRAINT_SQL = """
+ALTER TABLE small_small_hr_leave
+ADD CONSTRAINT sshr_leave_no_overlap
+EXCLUDE USING gist (
+    int4range(staff_id, staff_id, '[]') WITH &&,
+    int4range(leave_type::integer, leave_type::integer, '[]') WITH &&,
+    tstzrange(start, "end", '[]') WITH &&
+) WHERE (review_status = '1');
+"""
+
+OVERTIME_CONSTRAINT_SQL = """
+ALTER TABLE small_small_hr_overtime
+ADD CONSTRAINT sshr_overtime_no_overlap
+EXCLUDE USING gist (
+    int4range(staff_id, staff_id, '[]') WITH &&,
+    tsrange(date + start, date + "end", '[)') WITH &&
+) WHERE (review_status = '1');
+"""
+
+
+def get_overlaps(rows, closed):
+    """
+    Get the (id, id) pairs of overlapping rows.
+
+    The rows are (group, start, end, id) tuples sorted by group and start, only
+    rows in the same group can overlap and closed ranges overlap at their ends.
+    """
+    overlaps = []
+    last = None
+    for group, start, end, row_id in rows:
+        if last is not None and last[0] == group and (
+            start < last[2] or (closed and start == last[2])
+        ):
+            overlaps.append((last[3], row_id))
+        if last is None or last[0] != group or end > last[2]:
+            last = (group, start, end, row_id)
+    return overlaps
+
+
+def check_overlaps(apps, schema_editor):
+    """
+    Check that no approved Leave or OverTime overlap before adding constraints.
+
+    Which of two overlapping approved applications is wrong cannot be decided
+    here, so they are reported to be fixed by hand before migrating again.  So
+    are approved applications that end before they start, which the overlap
+    constraints cannot turn into ranges.
+    """
+    Leave = apps.get_model('small_small_hr', 'Leave')
+    OverTime = apps.get_model('small_small_hr', 'OverTime')
+    leave_rows = (
+        Leave.objects.filter(review_status='1')
+        .order_by('staff_id', 'leave_type', 'start')
+        .values_list('staff_id', 'leave_type', 'start', 'end', 'id')
+    )
+    leave_overlaps = get_overlaps(
+        (((staff_id, leave_type), start, end, row_id)
+         for staff_id, leave_type, start, end, row_id in leave_rows.iterator()),
+        closed=True,
+    )
+    overtime_rows = (
+        OverTime.objects.filter(review_status='1')
+        .order_by('staff_id', 'date', 'start')
+        .values_list('staff_id', 'date', 'start', 'end', 'id')
+    )
+    overtime_overlaps = get_overlaps(
+        ((staff_id, datetime.combine(date, start), datetime.combine(date, end), row_id)
+         for staff_id, date, start, end, row_id in overtime_rows.iterator()),
+        closed=False,
+    )
+    errors = [
+        f'{model} {row_id} ends before it starts'
+        for model, rows in (('Leave', leave_rows), ('OverTime', overtime_rows))
+        for row_id in rows.filter(end__lt=models.F('start')).values_list('id', flat=True)
+    ]
+    errors += [
+        f'{model} {first} overlaps {model} {second}'
+        for model, overlaps in (('Leave', leave_overlaps), ('OverTime', overtime_overlaps))
+        for first, second in overlaps
+    ]
+    if errors:
+        raise ValueError(
+            'Approved applications overlap or end before they start, reject or '
+            'change them before migrating: ' + '; '.join(errors)
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('small_small_hr', '0012_leave_day_count'),
+    ]
+
+    operations = [
+        migrations.RunPython(check_overlaps, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='leave',
+            constraint=models.CheckConstraint(check=models.Q(models.Q(_negated=True, review_status='1'), ('end__gte', django.db.models.expressions.F('start')), _connector='OR'), name='sshr_leave_approved_start_end'),
+        ),
+        migrations.AddConstraint(
+            model_name='overtime',
+            constraint=models.CheckConstraint(check=models.Q(models.Q(_negated=True, review_status='1'), ('end__gte', django.db.models.expressions.F('start')), _connector='OR'), name='sshr_overtime_approved_start_end'),
+        ),
+        migrations.RunSQL(
+            LEAVE_CONSTRAINT_SQL,
+            reverse_sql=(
+                "ALTER TABLE small_small_hr_leave "
+                "DROP CONSTRAINT sshr_leave_no_overlap;"
+            ),
+        ),
+        migrations.RunSQL(
+            OVERTIME_CONSTRAINT_SQL,
+            reverse_sql=(
+                "ALTER TABLE small_small_hr_overtime "
+                "DROP CONSTRAINT sshr_overtime_no_overlap;"
+            ),
+        ),
+    ]
@@ -0,0 +1,35 @@
+from django.db import migrations, models
+from django.utils import timezone
+
+
+def set_local_dates(apps, schema_editor):
+    """Set the local start and end dates of existing leave."""
+    Leave = apps.get_model('small_small_hr', 'Leave')
+    default_tz = timezone.get_default_timezone()
+    changed = []
+    for leave_obj in Leave.objects.only('id', 'start', 'end').iterator():
+        leave_obj.start_date = default_tz.normalize(leave_obj.start).date()
+        leave_obj.end_date = default_tz.normalize(leave_obj.end).date()
+        changed.append(leave_obj)
+    Leave.objects.bulk_update(changed, ['start_date', 'end_date'], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('small_small_hr', '0013_leave_overtime_no_overlap'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='leave',
+            name='start_date',
+            field=models.DateField(editable=False, help_text='The date of start in the default timezone.', null=True, verbose_name='Local Start Date'),
+        ),
+        migrations.AddField(
+            model_name='leave',
+            name='end_date',
+            field=models.DateField(editable=False, help_text='The date of end in the default timezone.', null=True, verbose_name='Local End Date'),
+        ),
+        migrations.RunPython(set_local_dates, migrations.RunPython.noop),
+    ]
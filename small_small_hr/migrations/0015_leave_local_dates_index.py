@@ -0,0 +1,25 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('small_small_hr', '0014_leave_local_dates'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='leave',
+            name='start_date',
+            field=models.DateField(editable=False, help_text='The date of start in the default timezone.', verbose_name='Local Start Date'),
+        ),
+        migrations.AlterField(
+            model_name='leave',
+            name='end_date',
+            field=models.DateField(editable=False, help_text='The date of end in the default timezone.', verbose_name='Local End Date'),
+        ),
+        migrations.AddIndex(
+            model_name='leave',
+            index=models.Index(fields=['staff', 'leave_type', 'review_status', 'start_date', 'end_date'], name='sshr_leave_overlap_idx'),
+        ),
+    ]
@@ -0,0 +1,44 @@
+from datetime import timedelta
+from decimal import Decimal
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+def set_taken_days(apps, schema_editor):
+    """Count the approved leave days taken in each AnnualLeave year."""
+    AnnualLeave = apps.get_model('small_small_hr', 'AnnualLeave')
+    FreeDay = apps.get_model('small_small_hr', 'FreeDay')
+    Leave = apps.get_model('small_small_hr', 'Leave')
+    free_days = set(FreeDay.objects.values_list('date', flat=True))
+    taken = {}
+    for leave_obj in Leave.objects.filter(review_status='1').iterator():
+        day = leave_obj.start_date
+        while day <= leave_obj.end_date:
+            if day not in free_days:
+                key = (leave_obj.staff_id, leave_obj.leave_type, day.year)
+                value = Decimal(str(settings.SSHR_DAY_LEAVE_VALUES[day.isoweekday()]))
+                taken[key] = taken.get(key, Decimal(0)) + value
+            day += timedelta(days=1)
+    changed = []
+    for annual_leave in AnnualLeave.objects.iterator():
+        key = (annual_leave.staff_id, annual_leave.leave_type, annual_leave.year)
+        annual_leave.taken_days = taken.get(key, Decimal(0))
+        changed.append(annual_leave)
+    AnnualLeave.objects.bulk_update(changed, ['taken_days'], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('small_small_hr', '0015_leave_local_dates_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='annualleave',
+            name='taken_days',
+            field=models.DecimalField(decimal_places=2, default=0, editable=False, help_text='Number of approved leave days taken in this year.', max_digits=12, verbose_name='Taken Leave days'),
+        ),
+        migrations.RunPython(set_taken_days, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,37 @@
+# Generated by Django 3.1.14 on 2026-10-17 04:13
+
+import django.core.validators
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('small_small_hr', '0016_annualleave_taken_days'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MonthlyLeaveBalance',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created', models.DateTimeField(auto_now_add=True, verbose_name='Created')),
+                ('modified', models.DateTimeField(auto_now=True, verbose_name='Modified')),
+                ('year', models.PositiveIntegerField(db_index=True, verbose_name='Year')),
+                ('month', models.PositiveSmallIntegerField(validators=[django.core.validators.MinValueValidator(1), django.core.validators.MaxValueValidator(12)], verbose_name='Month')),
+                ('leave_type', models.CharField(choices=[('1', 'Sick Leave'), ('2', 'Regular Leave')], db_index=True, max_length=1, verbose_name='Type')),
+                ('opening_days', models.DecimalField(decimal_places=2, default=0, help_text='Number of leave days available at the start of the month.', max_digits=12, verbose_name='Opening Leave days')),
+                ('accrued_days', models.DecimalField(decimal_places=2, default=0, help_text='Number of leave days earned in the month.', max_digits=12, verbose_name='Accrued Leave days')),
+                ('taken_days', models.DecimalField(decimal_places=2, default=0, help_text='Number of approved leave days taken in the month.', max_digits=12, verbose_name='Taken Leave days')),
+                ('closing_days', models.DecimalField(decimal_places=2, default=0, help_text='Number of leave days available at the end of the month.', max_digits=12, verbose_name='Closing Leave days')),
+                ('staff', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='small_small_hr.staffprofile', verbose_name='Staff Member')),
+            ],
+            options={
+                'verbose_name': 'Monthly Leave Balance',
+                'verbose_name_plural': 'Monthly Leave Balances',
+                'ordering': ['-year', '-month', 'leave_type', 'staff'],
+                'unique_together': {('year', 'month', 'staff', 'leave_type')},
+            },
+        ),
+    ]
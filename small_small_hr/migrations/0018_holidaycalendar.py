@@ -0,0 +1,53 @@
+# Generated by Django 3.1.14 on 2026-10-17 04:28
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('small_small_hr', '0017_monthlyleavebalance'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='HolidayCalendar',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created', models.DateTimeField(auto_now_add=True, verbose_name='Created')),
+                ('modified', models.DateTimeField(auto_now=True, verbose_name='Modified')),
+                ('name', models.CharField(max_length=255, unique=True, verbose_name='Name')),
+                ('description', models.TextField(blank=True, default='', verbose_name='Description')),
+            ],
+            options={
+                'verbose_name': 'Holiday Calendar',
+                'verbose_name_plural': 'Holiday Calendars',
+                'ordering': ['name'],
+                'abstract': False,
+            },
+        ),
+        migrations.AlterField(
+            model_name='freeday',
+            name='date',
+            field=models.DateField(verbose_name='Date'),
+        ),
+        migrations.AddField(
+            model_name='freeday',
+            name='calendar',
+            field=models.ForeignKey(blank=True, default=None, help_text='Leave empty for the default calendar.', null=True, on_delete=django.db.models.deletion.CASCADE, to='small_small_hr.holidaycalendar', verbose_name='Holiday Calendar'),
+        ),
+        migrations.AddConstraint(
+            model_name='freeday',
+            constraint=models.UniqueConstraint(fields=('calendar', 'date'), name='sshr_freeday_calendar_date'),
+        ),
+        migrations.AddConstraint(
+            model_name='freeday',
+            constraint=models.UniqueConstraint(condition=models.Q(calendar__isnull=True), fields=('date',), name='sshr_freeday_default_date'),
+        ),
+        migrations.AddField(
+            model_name='staffprofile',
+            name='calendar',
+            field=models.ForeignKey(blank=True, default=None, help_text='The public holidays of the staff member, empty for the default.', null=True, on_delete=django.db.models.deletion.PROTECT, to='small_small_hr.holidaycalendar', verbose_name='Holiday Calendar'),
+        ),
+    ]
@@ -1,13 +1,17 @@
 """Models module for small_small_hr."""
-from datetime import datetime, timedelta
+import warnings
+from collections import defaultdict
+from datetime import date, datetime, timedelta
 from decimal import Decimal
-from typing import Optional
+from functools import partial
+from typing import Dict, Hashable, Iterable, List, Optional, Sequence, Tuple, TypeVar
 
 from django.conf import settings
+from django.core.exceptions import ValidationError
 from django.contrib.postgres.fields import JSONField
 from django.db import models
-from django.core.validators import MinValueValidator
-from django.db.models import Q
+from django.core.validators import MaxValueValidator, MinValueValidator
+from django.db.models import Q, Sum
 from django.utils import timezone
 from django.utils.functional import cached_property
 from django.utils.translation import ugettext as _
@@ -18,11 +22,21 @@ from phonenumber_field.modelfields import PhoneNumberField
 from private_storage.fields import PrivateFileField
 from sorl.thumbnail import ImageField
 
+from small_small_hr.balances import balance_cache
+from small_small_hr.calendars import free_day_calendar
 from small_small_hr.constants import EMAIL_TEMPLATE_PATH
-from small_small_hr.managers import LeaveManager
+from small_small_hr.engines import (
+    numpy_leave_day_counts,
+    sql_taken_leave_days,
+    use_numpy_engine,
+    use_sql_engine,
+)
+from small_small_hr.managers import AnnualLeaveManager, LeaveManager
 
 USER = settings.AUTH_USER_MODEL
 TWOPLACES = Decimal(10) ** -2
+# the keys by which sum_leave_day_counts sums leave days
+SumKey = TypeVar("SumKey", bound=Hashable)
 
 
 class TimeStampedModel(models.Model):
@@ -58,6 +72,31 @@ class Role(TimeStampedModel, models.Model):
         return self.name
 
 
+class HolidayCalendar(TimeStampedModel, models.Model):
+    """
+    Model class for holiday calendars.
+
+    Each calendar has its own free days, so that staff members in different
+    countries or offices get their own public holidays.  Free days and staff
+    members without a calendar use the default calendar.
+    """
+
+    name = models.CharField(_("Name"), max_length=255, unique=True)
+    description = models.TextField(_("Description"), blank=True, default="")
+
+    class Meta:  # pylint: disable=too-few-public-methods
+        """Meta options for HolidayCalendar."""
+
+        abstract = False
+        verbose_name = _("Holiday Calendar")
+        verbose_name_plural = _("Holiday Calendars")
+        ordering = ["name"]
+
+    def __str__(self):
+        """Unicode representation of class object."""
+        return self.name
+
+
 class StaffProfile(TimeStampedModel, MPTTModel):
     """
     StaffProfile model class.
@@ -111,6 +150,15 @@ class StaffProfile(TimeStampedModel, MPTTModel):
         null=True,
         on_delete=models.SET_NULL,
     )
+    calendar = models.ForeignKey(
+        HolidayCalendar,
+        verbose_name=_("Holiday Calendar"),
+        blank=True,
+        default=None,
+        null=True,
+        on_delete=models.PROTECT,
+        help_text=_("The public holidays of the staff member, empty for the default."),
+    )
     phone = PhoneNumberField(_("Phone"), blank=True, default="")
     address = models.TextField(_("Addresss"), blank=True, default="")
     birthday = models.DateField(_("Birthday"), blank=True, default=None, null=True)
@@ -170,48 +218,94 @@ class StaffProfile(TimeStampedModel, MPTTModel):
 
     def get_approved_leave_days(self, year: Optional[int] = None):
         """Get approved leave days in the current year."""
-        # pylint: disable=no-member
-        return get_taken_leave_days(
-            staffprofile=self,
-            status=Leave.APPROVED,
-            leave_type=Leave.REGULAR,
-            start_year=year or self._current_year,
-            end_year=year or self._current_year,
-        )
+        return self._get_approved_days(year=year, leave_type=Leave.REGULAR)
 
     def get_approved_sick_days(self, year: Optional[int] = None):
         """Get approved leave days in the current year."""
-        return get_taken_leave_days(
-            staffprofile=self,
-            status=Leave.APPROVED,
-            leave_type=Leave.SICK,
-            start_year=year or self._current_year,
-            end_year=year or self._current_year,
-        )
+        return self._get_approved_days(year=year, leave_type=Leave.SICK)
 
     def get_available_leave_days(self, year: Optional[int] = None):
         """Get available leave days."""
-        try:
-            # pylint: disable=no-member
-            leave_record = AnnualLeave.objects.get(
-                leave_type=Leave.REGULAR, staff=self, year=year or self._current_year
-            )
-        except AnnualLeave.DoesNotExist:
-            return Decimal(0)
-        else:
-            return leave_record.get_available_leave_days()
+        return self._get_available_days(year=year, leave_type=Leave.REGULAR)
 
     def get_available_sick_days(self, year: Optional[int] = None):
         """Get available sick days."""
-        try:
-            # pylint: disable=no-member
-            leave_record = AnnualLeave.objects.get(
-                leave_type=Leave.SICK, staff=self, year=year or self._current_year
+        return self._get_available_days(year=year, leave_type=Leave.SICK)
+
+    def _get_approved_days(self, year: Optional[int], leave_type: str):
+        """Get approved days of a leave type, using the balance cache."""
+        year = year or self._current_year
+        return balance_cache.get(
+            key=(self.pk, year, leave_type),
+            name="approved",
+            compute=partial(
+                get_taken_leave_days,
+                staffprofile=self,
+                status=Leave.APPROVED,
+                leave_type=leave_type,
+                start_year=year,
+                end_year=year,
+            ),
+        )
+
+    def _get_available_days(self, year: Optional[int], leave_type: str):
+        """Get available days of a leave type, using the balance cache."""
+        year = year or self._current_year
+        return balance_cache.get(
+            key=(self.pk, year, leave_type),
+            name="available",
+            compute=partial(get_available_days, self, year, leave_type),
+        )
+
+    def get_leave_summary(self, year: Optional[int] = None) -> Dict[str, Decimal]:
+        """
+        Get the approved and available leave and sick days of a year at once.
+
+        Returns a dict with the `approved_leave_days`, `approved_sick_days`,
+        `available_leave_days` and `available_sick_days`, as returned by the
+        methods of the same names, from one AnnualLeave and one Leave query.
+        """
+        year = year or self._current_year
+        first_day = date(year, 1, 1)
+        last_day = date(year, 12, 31)
+        # pylint: disable=no-member
+        approved = {Leave.REGULAR: Decimal(0), Leave.SICK: Decimal(0)}
+        leave_qs = (
+            Leave.objects.filter(
+                staff=self, review_status=Leave.APPROVED, leave_type__in=approved
             )
-        except AnnualLeave.DoesNotExist:
-            return Decimal(0)
-        else:
-            return leave_record.get_available_leave_days()
+            .overlapping_years(year, year)
+            .order_by()
+            .values_list("leave_type", "start_date", "end_date", "day_count")
+        )
+        partial_leave = []
+        for leave_type, start_date, end_date, day_count in leave_qs:
+            if start_date >= first_day and end_date <= last_day:
+                approved[leave_type] += day_count
+            else:
+                partial_leave.append(
+                    (
+                        leave_type,
+                        max(start_date, first_day),
+                        min(end_date, last_day),
+                        self.calendar_id,
+                    )
+                )
+        for leave_type, count in sum_leave_day_counts(partial_leave).items():
+            approved[leave_type] += count
+
+        available = {Leave.REGULAR: Decimal(0), Leave.SICK: Decimal(0)}
+        for annual_leave in AnnualLeave.objects.filter(
+            staff=self, year=year, leave_type__in=available
+        ).order_by():
+            available[annual_leave.leave_type] = annual_leave.get_available_leave_days()
+
+        return {
+            "approved_leave_days": approved[Leave.REGULAR],
+            "approved_sick_days": approved[Leave.SICK],
+            "available_leave_days": available[Leave.REGULAR],
+            "available_sick_days": available[Leave.SICK],
+        }
 
     def __str__(self):
         """Unicode representation of class object."""
@@ -312,6 +406,24 @@ class Leave(BaseStaffRequest):
         blank=True,
         db_index=True,
     )
+    start_date = models.DateField(
+        _("Local Start Date"),
+        editable=False,
+        help_text=_("The date of start in the default timezone."),
+    )
+    end_date = models.DateField(
+        _("Local End Date"),
+        editable=False,
+        help_text=_("The date of end in the default timezone."),
+    )
+    day_count = models.DecimalField(
+        _("Day count"),
+        default=0,
+        decimal_places=2,
+        max_digits=12,
+        editable=False,
+        help_text=_("Number of leave days, excluding free days and weekends."),
+    )
 
     objects = LeaveManager()
 
@@ -333,6 +445,27 @@ class Leave(BaseStaffRequest):
         verbose_name = _("Leave")
         verbose_name_plural = _("Leave")
         ordering = ["staff", "-start"]
+        indexes = [
+            models.Index(
+                fields=[
+                    "staff",
+                    "leave_type",
+                    "review_status",
+                    "start_date",
+                    "end_date",
+                ],
+                name="sshr_leave_overlap_idx",
+            )
+        ]
+        # approved leave is also kept from overlapping by a database constraint,
+        # which cannot compare leave that ends before it starts
+        constraints = [
+            models.CheckConstraint(
+                check=~Q(review_status=AbstractReview.APPROVED)
+                | Q(end__gte=models.F("start")),
+                name="sshr_leave_approved_start_end",
+            )
+        ]
 
     def __str__(self):
         """Unicode representation of class object."""
@@ -348,14 +481,25 @@ class Leave(BaseStaffRequest):
         """Get duration as a property."""
         return self.get_duration()
 
-    @cached_property
-    def day_count(self):
+    def save(self, *args, **kwargs):  # pylint: disable=signature-differs
         """
-        Get the number of leave days as a property.
+        Save the leave object.
 
-        This takes into account holidays and weekend policy.
+        The local start and end dates and the day count are recomputed every time
+        the leave object is saved.  The day count takes into account holidays and
+        weekend policy.
         """
-        return get_real_leave_duration(leave_obj=self)
+        self.start_date = get_local_date(self.start)
+        self.end_date = get_local_date(self.end)
+        self.day_count = get_real_leave_duration(leave_obj=self)
+        update_fields = kwargs.get("update_fields")
+        if update_fields is not None:
+            kwargs["update_fields"] = set(update_fields) | {
+                "start_date",
+                "end_date",
+                "day_count",
+            }
+        super().save(*args, **kwargs)
 
 
 class OverTime(BaseStaffRequest):
@@ -385,6 +529,14 @@ class OverTime(BaseStaffRequest):
         verbose_name = _("Overtime")
         verbose_name_plural = _("Overtime")
         ordering = ["staff", "-date", "start"]
+        # see Leave.Meta.constraints
+        constraints = [
+            models.CheckConstraint(
+                check=~Q(review_status=AbstractReview.APPROVED)
+                | Q(end__gte=models.F("start")),
+                name="sshr_overtime_approved_start_end",
+            )
+        ]
 
     def __str__(self):
         """Unicode representation of class object."""
@@ -440,6 +592,16 @@ class AnnualLeave(TimeStampedModel, models.Model):
         validators=[MinValueValidator(Decimal('0.1'))],
         help_text=_("Number of leave days carried over into this year."),
     )
+    taken_days = models.DecimalField(
+        _("Taken Leave days"),
+        default=0,
+        decimal_places=2,
+        max_digits=12,
+        editable=False,
+        help_text=_("Number of approved leave days taken in this year."),
+    )
+
+    objects = AnnualLeaveManager()
 
     class Meta:  # pylint: disable=too-few-public-methods
         """Meta options for AnnualLeave."""
@@ -456,22 +618,42 @@ class AnnualLeave(TimeStampedModel, models.Model):
             f"{self.year}: {self.staff.get_name()} " f"{self.get_leave_type_display()}"
         )
 
+    def save(self, *args, **kwargs):  # pylint: disable=signature-differs
+        """
+        Save the annual leave object.
+
+        The taken days are counted from the leave history when the annual leave
+        object is created.  After that they are kept up to date in the database
+        as leave is approved, changed or deleted, so saving an existing annual
+        leave object leaves them alone unless "taken_days" is in update_fields.
+        """
+        if self._state.adding:
+            self.taken_days = self.get_cumulative_leave_taken()
+        elif kwargs.get("update_fields") is None and not kwargs.get("force_insert"):
+            # pylint: disable=no-member
+            kwargs["update_fields"] = [
+                field.name
+                for field in self._meta.concrete_fields
+                if not field.primary_key and field.name != "taken_days"
+            ]
+        super().save(*args, **kwargs)
+
     def get_cumulative_leave_taken(self):
         """
-        Get the cumulative leave taken.
+        Get the cumulative leave taken, counted from the leave history.
 
-        Returns a timedelta
+        Returns a Decimal
         """
         return get_taken_leave_days(
-            staffprofile=self.staff,
+            staffprofile=self.staff_id,
             status=Leave.APPROVED,
             leave_type=self.leave_type,
             start_year=self.year,
             end_year=self.year,
         )
 
-    def get_available_leave_days(self, month: int = 12):
-        """Get the remaining leave days."""
+    def get_earned_leave_days(self, month: int = 12):
+        """Get the leave days earned so far, given the month."""
         if month <= 0:
             month = 1
         elif month > 12:
@@ -484,10 +666,15 @@ class AnnualLeave(TimeStampedModel, models.Model):
         per_month = Decimal(allowed / 12)
 
         # the days earned so far, given the month
-        earned = Decimal(month) * per_month
+        return Decimal(month) * per_month
+
+    def get_available_leave_days(self, month: int = 12):
+        """Get the remaining leave days."""
+        # the days earned so far, given the month
+        earned = self.get_earned_leave_days(month=month)
 
         # the days taken
-        taken = self.get_cumulative_leave_taken()
+        taken = self.taken_days
 
         # the starting balance
         starting_balance = self.carried_over_days
@@ -495,11 +682,85 @@ class AnnualLeave(TimeStampedModel, models.Model):
         return Decimal(earned + starting_balance - taken)
 
 
+class MonthlyLeaveBalance(TimeStampedModel, models.Model):
+    """
+    Model to keep a monthly statement of staff employee leave balances.
+
+    The records of a year are made by the create_monthly_leave_balances job and
+    are then kept up to date as leave, annual leave and free days change
+    Each staff member has one record per leave_type per month
+    """
+
+    staff = models.ForeignKey(
+        StaffProfile, verbose_name=_("Staff Member"), on_delete=models.CASCADE
+    )
+    year = models.PositiveIntegerField(_("Year"), db_index=True)
+    month = models.PositiveSmallIntegerField(
+        _("Month"), validators=[MinValueValidator(1), MaxValueValidator(12)]
+    )
+    leave_type = models.CharField(
+        _("Type"), max_length=1, choices=Leave.TYPE_CHOICES, db_index=True
+    )
+    opening_days = models.DecimalField(
+        _("Opening Leave days"),
+        default=0,
+        decimal_places=2,
+        max_digits=12,
+        help_text=_("Number of leave days available at the start of the month."),
+    )
+    accrued_days = models.DecimalField(
+        _("Accrued Leave days"),
+        default=0,
+        decimal_places=2,
+        max_digits=12,
+        help_text=_("Number of leave days earned in the month."),
+    )
+    taken_days = models.DecimalField(
+        _("Taken Leave days"),
+        default=0,
+        decimal_places=2,
+        max_digits=12,
+        help_text=_("Number of approved leave days taken in the month."),
+    )
+    closing_days = models.DecimalField(
+        _("Closing Leave days"),
+        default=0,
+        decimal_places=2,
+        max_digits=12,
+        help_text=_("Number of leave days available at the end of the month."),
+    )
+
+    class Meta:  # pylint: disable=too-few-public-methods
+        """Meta options for MonthlyLeaveBalance."""
+
+        verbose_name = _("Monthly Leave Balance")
+        verbose_name_plural = _("Monthly Leave Balances")
+        ordering = ["-year", "-month", "leave_type", "staff"]
+        unique_together = (("year", "month", "staff", "leave_type"),)
+
+    def __str__(self):
+        """Unicode representation of class object."""
+        # pylint: disable=no-member
+        return _(
+            f"{self.year}-{self.month:02d}: {self.staff.get_name()} "
+            f"{self.get_leave_type_display()}"
+        )
+
+
 class FreeDay(models.Model):
     """Model definition for FreeDay."""
 
     name = models.CharField(_("Name"), max_length=255)
-    date = models.DateField(_("Date"), unique=True)
+    date = models.DateField(_("Date"))
+    calendar = models.ForeignKey(
+        HolidayCalendar,
+        verbose_name=_("Holiday Calendar"),
+        blank=True,
+        default=None,
+        null=True,
+        on_delete=models.CASCADE,
+        help_text=_("Leave empty for the default calendar."),
+    )
 
     class Meta:
         """Meta definition for FreeDay."""
@@ -507,14 +768,61 @@ class FreeDay(models.Model):
         ordering = ["-date"]
         verbose_name = _("Free Day")
         verbose_name_plural = _("Free Days")
+        constraints = [
+            models.UniqueConstraint(
+                fields=["calendar", "date"], name="sshr_freeday_calendar_date"
+            ),
+            # NULL calendars are not equal to each other in the constraint above
+            models.UniqueConstraint(
+                fields=["date"],
+                condition=Q(calendar__isnull=True),
+                name="sshr_freeday_default_date",
+            ),
+        ]
 
     def __str__(self):
         """Unicode representation of class object."""
         return f"{self.date.year} - {self.name}"
 
+    def validate_unique(self, exclude=None):
+        """Check that the date is unique in the default calendar too."""
+        super().validate_unique(exclude=exclude)
+        if self.calendar_id is None and "date" not in (exclude or []):
+            # pylint: disable=no-member
+            queryset = FreeDay.objects.filter(calendar=None, date=self.date)
+            if self.pk:
+                queryset = queryset.exclude(pk=self.pk)
+            if queryset.exists():
+                raise ValidationError(
+                    {"date": self.unique_error_message(FreeDay, ("date",))}
+                )
+
+
+def get_available_days(staffprofile: StaffProfile, year: int, leave_type: str):
+    """Get the available days of a leave type, from its AnnualLeave record."""
+    try:
+        # pylint: disable=no-member
+        leave_record = AnnualLeave.objects.get(
+            leave_type=leave_type, staff=staffprofile, year=year
+        )
+    except AnnualLeave.DoesNotExist:
+        return Decimal(0)
+    else:
+        return leave_record.get_available_leave_days()
+
 
 def get_days(start: object, end: object):
-    """Yield the days between two datetime objects."""
+    """
+    Yield the days between two datetime objects.
+
+    Deprecated: leave days are counted by get_leave_day_counts, and the local
+    dates of leave are Leave.start_date and Leave.end_date.
+    """
+    warnings.warn(
+        "get_days is deprecated, use get_leave_day_counts instead",
+        DeprecationWarning,
+        stacklevel=2,
+    )
     current_tz = timezone.get_current_timezone()
     local_start = current_tz.normalize(start)
     local_end = current_tz.normalize(end)
@@ -523,22 +831,111 @@ def get_days(start: object, end: object):
         yield local_start.date() + timedelta(days=i)
 
 
+def get_local_date(value: datetime) -> date:
+    """
+    Get the date of a datetime object in the default timezone.
+
+    Unlike the current timezone, which may be activated per request, the default
+    timezone is the same for every request, so stored dates do not depend on who
+    saved them.
+    """
+    return timezone.get_default_timezone().normalize(value).date()
+
+
+def get_leave_day_counts(
+    intervals: Sequence[Tuple[date, date]], calendar_id: Optional[int] = None
+) -> List[Decimal]:
+    """
+    Count the leave days in many (start, end) date intervals at once.
+
+    Both ends of each interval are inclusive.  Takes into account public holidays,
+    weekends and weekend policy
+
+    :param intervals: the (start, end) date intervals
+    :param calendar_id: the HolidayCalendar of the public holidays, defaults to
+        the default calendar
+    """
+    if not intervals:
+        return []
+    if use_numpy_engine():
+        free_days = free_day_calendar.get_free_days(
+            min(_[0] for _ in intervals).year,
+            max(_[1] for _ in intervals).year,
+            calendar_id=calendar_id,
+        )
+        return numpy_leave_day_counts(
+            intervals, free_days=free_days, day_values=settings.SSHR_DAY_LEAVE_VALUES
+        )
+    return free_day_calendar.count_many_leave_days(intervals, calendar_id=calendar_id)
+
+
+def get_calendar_leave_day_counts(
+    intervals: Sequence[Tuple[date, date]], calendar_ids: Sequence[Optional[int]]
+) -> List[Decimal]:
+    """
+    Count the leave days in many intervals, each in its own holiday calendar.
+
+    The intervals are grouped by HolidayCalendar and each group is counted at
+    once, after the free days of all the calendars are loaded in one query.
+
+    :param intervals: the (start, end) date intervals
+    :param calendar_ids: the HolidayCalendar id of each interval, None for the
+        default calendar
+    """
+    if not intervals:
+        return []
+    free_day_calendar.load_calendars(
+        min(_[0] for _ in intervals).year,
+        max(_[1] for _ in intervals).year,
+        calendar_ids=set(calendar_ids),
+    )
+    groups: Dict[Optional[int], List[int]] = defaultdict(list)
+    for index, calendar_id in enumerate(calendar_ids):
+        groups[calendar_id].append(index)
+    counts = [Decimal(0)] * len(intervals)
+    for calendar_id, indexes in groups.items():
+        group_counts = get_leave_day_counts(
+            [intervals[index] for index in indexes], calendar_id=calendar_id
+        )
+        for index, count in zip(indexes, group_counts):
+            counts[index] = count
+    return counts
+
+
+def sum_leave_day_counts(
+    rows: Iterable[Tuple[SumKey, date, date, Optional[int]]]
+) -> Dict[SumKey, Decimal]:
+    """
+    Count the leave days of many intervals at once, and sum them per key.
+
+    :param rows: (key, start, end, calendar_id) tuples, where both ends are
+        inclusive and calendar_id is the HolidayCalendar id, None for the default
+        calendar
+    """
+    keys = []
+    intervals = []
+    calendar_ids = []
+    for key, start, end, calendar_id in rows:
+        keys.append(key)
+        intervals.append((start, end))
+        calendar_ids.append(calendar_id)
+    counts = get_calendar_leave_day_counts(intervals, calendar_ids=calendar_ids)
+    totals: Dict[SumKey, Decimal] = defaultdict(Decimal)
+    for key, count in zip(keys, counts):
+        totals[key] += count
+    return totals
+
+
 def get_real_leave_duration(leave_obj: Leave) -> Decimal:
     """
     Get the real leave duration.
 
     Takes into account public holidays, weekends and weekend policy
     """
-    count = Decimal(0)
-    free_days = FreeDay.objects.filter(
-        date__gte=leave_obj.start.date(), date__lte=leave_obj.end.date()
-    ).values_list("date", flat=True)
-    days = get_days(start=leave_obj.start, end=leave_obj.end)
-    for day in days:
-        if day not in free_days:
-            day_value = settings.SSHR_DAY_LEAVE_VALUES[day.isoweekday()]
-            count = count + Decimal(day_value)
-    return count
+    return get_leave_day_counts(
+        [(leave_obj.start_date, leave_obj.end_date)],
+        calendar_id=leave_obj.staff.calendar_id,
+    )[0]
 
 
 def get_taken_leave_days(
@@ -549,17 +946,27 @@ def get_taken_leave_days(
 
     Takes into account weekends and weekend policy
     """
-    count = Decimal(0)
-    free_days = FreeDay.objects.filter(
-        date__year__gte=start_year, date__year__lte=end_year
-    ).values_list("date", flat=True)
+    if use_sql_engine():
+        return sql_taken_leave_days(
+            staffprofile=staffprofile,
+            status=status,
+            leave_type=leave_type,
+            start_year=start_year,
+            end_year=end_year,
+        )
     queryset = Leave.objects.filter(
         staff=staffprofile, review_status=status, leave_type=leave_type
-    ).filter(Q(start__year__gte=start_year) | Q(end__year__lte=end_year))
-    for leave_obj in queryset:
-        days = get_days(start=leave_obj.start, end=leave_obj.end)
-        for day in days:
-            if day.year >= start_year and day.year <= end_year and day not in free_days:
-                day_value = settings.SSHR_DAY_LEAVE_VALUES[day.isoweekday()]
-                count = count + Decimal(day_value)
-    return count
+    ).overlapping_years(start_year, end_year)
+    # leave that falls entirely within the years is counted using its day count
+    within_years = queryset.within_years(start_year, end_year)
+    count = within_years.aggregate(total=Sum("day_count"))["total"] or Decimal(0)
+    # the rest is clipped to the years
+    first_day = date(start_year, 1, 1)
+    last_day = date(end_year, 12, 31)
+    intervals = []
+    calendar_id = None
+    for start_date, end_date, calendar_id in queryset.exclude(
+        pk__in=within_years.values("pk")
+    ).values_list("start_date", "end_date", "staff__calendar_id"):
+        intervals.append((max(start_date, first_day), min(end_date, last_day)))
+    return sum(get_leave_day_counts(intervals, calendar_id=calendar_id), count)
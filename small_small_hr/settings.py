@@ -13,6 +13,18 @@ SSHR_DAY_LEAVE_VALUES = {
     6: 0,  # Saturday
     7: 0,  # Sunday
 }
+# leave days are summed as integers in these fractions of a day, e.g. tenths
+SSHR_DAY_LEAVE_UNITS = 10
+# engine used to count leave days: "python", "numpy" (requires numpy) or "sql"
+SSHR_LEAVE_DAY_ENGINE = "python"
+# the Django cache used to store leave balances, and for how long in seconds,
+# balances are not cached unless it is shared by all processes e.g. memcached
+SSHR_BALANCE_CACHE = "default"
+SSHR_BALANCE_CACHE_TIMEOUT = 60 * 60
+# the Django cache shared by all processes that tells them when free days change,
+# and how often in seconds processes check it outside requests
+SSHR_CALENDAR_CACHE = "default"
+SSHR_CALENDAR_CHECK_INTERVAL = 60
 SSHR_ALLOW_OVERSUBSCRIBE = True  # allow taking more leave days one has
 SSHR_DEFAULT_TIME = 7  # default time of the day for leave
 SSHR_FREE_DAYS = [
@@ -24,6 +36,9 @@ SSHR_FREE_DAYS = [
     {"day": 25, "month": 12},  # Christmas
     {"day": 26, "month": 12},  # Boxing day
 ]  # these are days that are not counted when getting taken leave days
+# besides fixed dates, rules may be relative to Easter e.g. {"easter": -2}, the nth
+# weekday of a month e.g. {"month": 5, "weekday": 1, "nth": -1} and may set
+# "observed": True to also observe a weekend free day on the next weekday
 # admins
 SSHR_ADMIN_USER_GROUP_NAME = "Human Resource"
 # emails
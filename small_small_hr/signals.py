@@ -1,9 +1,25 @@
 """
 Small small HR signals module
 """
+from datetime import date
+from typing import Optional, Set
+
 from django.conf import settings
+from django.core.signals import request_started
+from django.db.models import Q
+from django.db.models.signals import post_delete, post_save, pre_save
+from django.dispatch import receiver
 
-from small_small_hr.models import StaffProfile
+from small_small_hr.balances import balance_cache
+from small_small_hr.calendars import free_day_calendar
+from small_small_hr.counters import (
+    LEAVE_TAKEN_DAYS_FIELDS,
+    get_leave_taken_days,
+    update_leave_day_counts,
+    update_monthly_leave_balances,
+    update_taken_days,
+)
+from small_small_hr.models import AnnualLeave, FreeDay, Leave, StaffProfile
 
 USER = settings.AUTH_USER_MODEL
 
@@ -20,3 +36,195 @@ def create_staffprofile(sender, instance, created, **kwargs):
         # pylint: disable=no-member
         profile, profile_created = \
             StaffProfile.objects.get_or_create(user=instance)
+
+
+@receiver(request_started)
+def expire_free_day_calendar(sender, **kwargs):
+    """
+    Check whether other processes changed free days at the start of each request
+    """
+    free_day_calendar.expire()
+
+
+@receiver(pre_save, sender=FreeDay)
+def remember_free_day_date(sender, instance, raw, **kwargs):
+    """
+    Remember the date and calendar of a FreeDay before it is changed
+    """
+    instance.previous_date = None
+    instance.previous_calendar_id = None
+    if instance.pk and not raw:
+        # pylint: disable=no-member
+        previous = (
+            FreeDay.objects.filter(pk=instance.pk)
+            .values_list("date", "calendar_id")
+            .first()
+        )
+        if previous is not None:
+            instance.previous_date, instance.previous_calendar_id = previous
+
+
+def get_free_day_dates(instance: FreeDay, signal: object) -> Set[date]:
+    """
+    Get the dates affected by a saved or deleted FreeDay
+    """
+    dates = {instance.date}
+    if signal is post_save and getattr(instance, "previous_date", None):
+        dates.add(instance.previous_date)
+    return dates
+
+
+def get_free_day_calendar_ids(instance: FreeDay, signal: object) -> Set[Optional[int]]:
+    """
+    Get the HolidayCalendar ids affected by a saved or deleted FreeDay
+    """
+    calendar_ids = {instance.calendar_id}
+    if signal is post_save and getattr(instance, "previous_date", None):
+        calendar_ids.add(instance.previous_calendar_id)
+    return calendar_ids
+
+
+@receiver(post_save, sender=FreeDay)
+@receiver(post_delete, sender=FreeDay)
+def clear_free_day_calendar(sender, instance, signal, **kwargs):
+    """
+    Clear the affected years of the cached FreeDay calendar
+
+    Note that bulk operations (bulk_create, update) do not send these signals
+    """
+    dates = get_free_day_dates(instance, signal)
+    free_day_calendar.invalidate(years={the_date.year for the_date in dates})
+
+
+@receiver(post_save, sender=FreeDay)
+@receiver(post_delete, sender=FreeDay)
+def update_free_day_leave(sender, instance, signal, **kwargs):
+    """
+    Update the day count of Leave that includes a saved or deleted FreeDay
+
+    Only the leave of staff members in the calendar of the FreeDay is updated.
+    This must run after clear_free_day_calendar
+    """
+    if kwargs.get("raw"):
+        return
+    calendar_ids = get_free_day_calendar_ids(instance, signal)
+    query = Q(staff__calendar_id__in=calendar_ids - {None})
+    if None in calendar_ids:
+        query |= Q(staff__calendar__isnull=True)
+    for the_date in get_free_day_dates(instance, signal):
+        # pylint: disable=no-member
+        update_leave_day_counts(
+            Leave.objects.filter(query).overlapping(the_date, the_date)
+        )
+
+
+@receiver(pre_save, sender=StaffProfile)
+def remember_staff_calendar(sender, instance, raw, **kwargs):
+    """
+    Remember the HolidayCalendar of a StaffProfile before it is changed
+    """
+    instance.previous_calendar_id = instance.calendar_id
+    if instance.pk and not raw:
+        # pylint: disable=no-member
+        instance.previous_calendar_id = (
+            StaffProfile.objects.filter(pk=instance.pk)
+            .values_list("calendar_id", flat=True)
+            .first()
+        )
+
+
+@receiver(post_save, sender=StaffProfile)
+def update_staff_calendar_leave(sender, instance, created, raw, **kwargs):
+    """
+    Update the day count of a staff member's Leave when their calendar changes
+    """
+    if created or raw:
+        return
+    if getattr(instance, "previous_calendar_id", None) != instance.calendar_id:
+        # pylint: disable=no-member
+        update_leave_day_counts(Leave.objects.filter(staff=instance))
+        balance_cache.invalidate()
+
+
+@receiver(pre_save, sender=Leave)
+def remember_leave_taken_days(sender, instance, raw, **kwargs):
+    """
+    Remember the leave days taken by a Leave before it is changed
+    """
+    instance.previous_taken_days = {}
+    if instance.pk and not raw:
+        # pylint: disable=no-member
+        previous = (
+            Leave.objects.filter(pk=instance.pk)
+            .only(*LEAVE_TAKEN_DAYS_FIELDS)
+            .first()
+        )
+        if previous is not None:
+            instance.previous_taken_days = get_leave_taken_days(previous)
+
+
+@receiver(post_save, sender=Leave)
+def update_leave_taken_days(sender, instance, raw, **kwargs):
+    """
+    Update the AnnualLeave taken days and monthly balances when a Leave is saved
+    """
+    if raw:
+        return
+    previous = getattr(instance, "previous_taken_days", {})
+    current = get_leave_taken_days(instance)
+    update_taken_days(previous=previous, current=current)
+    keys = {
+        (staff_id, year, leave_type)
+        for staff_id, leave_type, year in set(previous) | set(current)
+    }
+    balance_cache.invalidate(keys)
+    update_monthly_leave_balances(keys)
+
+
+@receiver(post_delete, sender=Leave)
+def remove_leave_taken_days(sender, instance, **kwargs):
+    """
+    Update the AnnualLeave taken days and monthly balances when a Leave is deleted
+    """
+    previous = get_leave_taken_days(instance)
+    update_taken_days(previous=previous, current={})
+    keys = {(staff_id, year, leave_type) for staff_id, leave_type, year in previous}
+    balance_cache.invalidate(keys)
+    update_monthly_leave_balances(keys)
+
+
+@receiver(pre_save, sender=AnnualLeave)
+def remember_annual_leave_key(sender, instance, raw, **kwargs):
+    """
+    Remember the staff, year and leave type of an AnnualLeave before it is changed
+    """
+    instance.previous_key = None
+    if instance.pk and not raw:
+        # pylint: disable=no-member
+        instance.previous_key = (
+            AnnualLeave.objects.filter(pk=instance.pk)
+            .values_list("staff_id", "year", "leave_type")
+            .first()
+        )
+
+
+@receiver(post_save, sender=AnnualLeave)
+@receiver(post_delete, sender=AnnualLeave)
+def clear_annual_leave_balances(sender, instance, **kwargs):
+    """
+    Clear the cached and update the monthly balances of a saved or deleted AnnualLeave
+    """
+    keys = {(instance.staff_id, instance.year, instance.leave_type)}
+    if getattr(instance, "previous_key", None):
+        keys.add(instance.previous_key)
+    balance_cache.invalidate(keys)
+    update_monthly_leave_balances(keys)
+
+
+@receiver(post_save, sender=FreeDay)
+@receiver(post_delete, sender=FreeDay)
+def clear_free_day_balances(sender, instance, **kwargs):
+    """
+    Clear all cached balances when a FreeDay is saved or deleted
+    """
+    balance_cache.invalidate()
@@ -1,12 +1,49 @@
 """
 Utils module for small small hr
 """
-from datetime import date
+from calendar import monthrange
+from collections import defaultdict
+from datetime import date, timedelta
+from decimal import ROUND_HALF_UP, Decimal
+from functools import partial
+from itertools import groupby
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Sequence, Tuple
 
 from django.conf import settings
+from django.contrib.contenttypes.models import ContentType
+from django.core.exceptions import ValidationError
+from django.db import transaction
+from django.db.models import Q, QuerySet
 from django.utils import timezone
+from django.utils.translation import ugettext as _
 
-from small_small_hr.models import AnnualLeave, FreeDay, Leave, StaffProfile
+from model_reviews.models import ModelReview
+
+from small_small_hr.balances import balance_cache
+from small_small_hr.calendars import free_day_calendar
+from small_small_hr.counters import (
+    TakenDaysKey,
+    get_balance_key_query,
+    get_leave_taken_days,
+    save_monthly_leave_balances,
+    update_leave_day_counts,
+    update_monthly_leave_balances,
+)
+from small_small_hr.models import (
+    TWOPLACES,
+    AnnualLeave,
+    FreeDay,
+    HolidayCalendar,
+    Leave,
+    MonthlyLeaveBalance,
+    StaffProfile,
+    get_local_date,
+    sum_leave_day_counts,
+)
+
+ROLLOVER_BATCH_SIZE = 1000
+# AnnualLeave.carried_over_days has one decimal place
+CARRY_OVER_PLACES = Decimal("0.1")
 
 
 def get_carry_over(staffprofile: StaffProfile, year: int, leave_type: str):
@@ -17,58 +54,863 @@ def get_carry_over(staffprofile: StaffProfile, year: int, leave_type: str):
             staff=staffprofile, year=year - 1, leave_type=leave_type
         ).first()
         if previous_obj:
-            remaining = previous_obj.get_available_leave_days()
-            max_carry_over = settings.SSHR_MAX_CARRY_OVER
-            if remaining > max_carry_over:
-                carry_over = max_carry_over
-            else:
-                carry_over = remaining
-
-            return carry_over
+            return limit_carry_over(previous_obj.get_available_leave_days())
 
     return 0
 
 
+def limit_carry_over(remaining: Decimal) -> Decimal:
+    """
+    Limit the leave days remaining at the end of a year to SSHR_MAX_CARRY_OVER.
+
+    The result is rounded half up to the decimal places of
+    AnnualLeave.carried_over_days, so every caller stores the same value.
+    """
+    max_carry_over = settings.SSHR_MAX_CARRY_OVER
+    if remaining > max_carry_over:
+        carry_over = max_carry_over
+    else:
+        carry_over = remaining
+
+    return Decimal(carry_over).quantize(CARRY_OVER_PLACES, rounding=ROUND_HALF_UP)
+
+
 def create_annual_leave(staffprofile: StaffProfile, year: int, leave_type: str):
-    """Creates an annual leave object for the staff member."""
+    """
+    Creates an annual leave object for the staff member.
+
+    The record is inserted in a savepoint, so that when another request creates
+    it first the existing record is returned instead of raising IntegrityError.
+    """
+    if leave_type == Leave.REGULAR:
+        allowed_days = staffprofile.leave_days
+    elif leave_type == Leave.SICK:
+        allowed_days = staffprofile.sick_days
+
+    # pylint: disable=no-member
+    annual_leave, _ = AnnualLeave.objects.get_or_create(
+        staff=staffprofile,
+        year=year,
+        leave_type=leave_type,
+        defaults={
+            "allowed_days": allowed_days,
+            # only worked out when the record is created
+            "carried_over_days": partial(
+                get_carry_over, staffprofile, year, leave_type
+            ),
+        },
+    )
+
+    return annual_leave
+
+
+def create_annual_leaves(
+    staff_qs: QuerySet, year: int, leave_type: str
+) -> Dict[int, AnnualLeave]:
+    """
+    Create the annual leave objects of many staff members at once.
+
+    Does what create_annual_leave does for every staff member, in a constant
+    number of queries.  Records are inserted with ON CONFLICT DO NOTHING, so
+    records created concurrently are left alone instead of raising IntegrityError.
+    Returns all the records, keyed by StaffProfile id.
+
+    :param staff_qs: a StaffProfile queryset
+    :param year: the year
+    :param leave_type: the leave type
+    """
+    _rollover_annual_leave_batch(year, staff_qs, leave_types=[leave_type])
     # pylint: disable=no-member
-    try:
-        annual_leave = AnnualLeave.objects.get(
-            staff=staffprofile, year=year, leave_type=leave_type
+    return {
+        _.staff_id: _
+        for _ in AnnualLeave.objects.filter(
+            staff__in=staff_qs, year=year, leave_type=leave_type
+        ).order_by()
+    }
+
+
+def approve_leave(leave_obj: Leave) -> Leave:
+    """
+    Approve a leave request through its review.
+
+    Unless SSHR_ALLOW_OVERSUBSCRIBE is True, the leave days are checked against
+    the staff member's balance while the leave and its AnnualLeave records are
+    locked with SELECT ... FOR UPDATE, so that approvals running at the same time
+    cannot both spend the same days.  The locks are taken in the same order as
+    saving the leave takes them, and are held only for the check and the status
+    change.  Raises ValidationError if there are not enough days available.
+    """
+    # pylint: disable=no-member
+    with transaction.atomic():
+        current = Leave.objects.select_for_update().get(pk=leave_obj.pk)
+        if current.review_status != Leave.APPROVED:
+            if not settings.SSHR_ALLOW_OVERSUBSCRIBE:
+                current.review_status = Leave.APPROVED
+                check_leave_balance(current)
+            review, _created = ModelReview.objects.get_or_create(
+                content_type=ContentType.objects.get_for_model(Leave),
+                object_id=leave_obj.pk,
+            )
+            review.review_status = ModelReview.APPROVED
+            review.review_date = timezone.now()
+            review.save()
+    leave_obj.refresh_from_db()
+    return leave_obj
+
+
+def check_leave_balance(leave_obj: Leave):
+    """
+    Check that the staff member has enough days available for approved leave.
+
+    The AnnualLeave records are locked until the end of the transaction, which
+    must be open.  Raises ValidationError if there are not enough days available.
+    """
+    needed = get_leave_taken_days(leave_obj)
+    # pylint: disable=no-member
+    annual_leaves = {
+        (_.staff_id, _.leave_type, _.year): _
+        for _ in AnnualLeave.objects.select_for_update()
+        .filter(
+            get_balance_key_query(
+                (staff_id, year, leave_type) for staff_id, leave_type, year in needed
+            )
         )
-    except AnnualLeave.DoesNotExist:
-        carry_over = get_carry_over(staffprofile, year, leave_type)
+        .order_by("pk")
+    }
+    for key, days in needed.items():
+        annual_leave = annual_leaves.get(key)
+        available = Decimal(0)
+        if annual_leave is not None:
+            available = annual_leave.get_available_leave_days()
+        if days > available:
+            raise ValidationError(
+                get_not_enough_days_message(leave_obj.leave_type, available)
+            )
 
-        if leave_type == Leave.REGULAR:
-            allowed_days = staffprofile.leave_days
-        elif leave_type == Leave.SICK:
-            allowed_days = staffprofile.sick_days
 
-        annual_leave = AnnualLeave(
-            staff=staffprofile,
-            year=year,
-            leave_type=leave_type,
-            allowed_days=allowed_days,
-            carried_over_days=carry_over,
+def get_not_enough_days_message(leave_type: str, available: Decimal) -> str:
+    """Get the error message for leave that exceeds the available days."""
+    if leave_type == Leave.SICK:
+        return _(
+            "Not enough sick days. Available sick days "
+            f"are {available.quantize(TWOPLACES)}"
         )
-        annual_leave.save()
+    return _(
+        "Not enough leave days. Available leave days "
+        f"are {available.quantize(TWOPLACES)}"
+    )
 
-    return annual_leave
+
+def get_year_intervals(start: date, end: date) -> List[Tuple[int, date, date]]:
+    """Split a (start, end) date interval into (year, start, end) intervals."""
+    return [
+        (year, max(start, date(year, 1, 1)), min(end, date(year, 12, 31)))
+        for year in range(start.year, end.year + 1)
+    ]
+
+
+def validate_leave_applications(leave_objs: Sequence[Leave]) -> List[List[str]]:
+    """
+    Validate many leave applications together.
+
+    Returns the error messages of each leave object, in the same order, and each
+    message is about both its start and end.  Leave that is not rejected must
+    not overlap approved leave.  Unless SSHR_ALLOW_OVERSUBSCRIBE is True, leave
+    that is not rejected must not take more days than are available, counting
+    days as Leave.day_count does, i.e. weighted by SSHR_DAY_LEAVE_VALUES and
+    without the free days of the staff member's HolidayCalendar.
+
+    The leave objects are checked against each other too, so applications of a
+    staff member spend the same balance one after the other.  Leave objects that
+    are already saved are checked as they are now, not as they were saved.
+
+    This takes at most four queries whatever the number of leave objects: the
+    AnnualLeave records, the approved leave, the calendars of staff members that
+    are not loaded and the free days that are not cached.
+
+    :param leave_objs: unsaved or changed Leave objects
+    """
+    errors: List[List[str]] = [[] for _ in leave_objs]
+    checked = [_.review_status != Leave.REJECTED for _ in leave_objs]
+    if not any(checked):
+        return errors
+    check_balance = not settings.SSHR_ALLOW_OVERSUBSCRIBE
+    pks = {_.pk for _ in leave_objs if _.pk}
+
+    # approved leave that the leave objects may overlap, and their saved versions
+    query = Q(pk__in=pks) if check_balance else Q(pk__in=[])
+    for leave_obj, check in zip(leave_objs, checked):
+        if check:
+            query |= Q(
+                staff_id=leave_obj.staff_id,
+                leave_type=leave_obj.leave_type,
+                start__lte=leave_obj.end,
+                end__gte=leave_obj.start,
+            )
+    # pylint: disable=no-member
+    approved = list(
+        Leave.objects.filter(query, review_status=Leave.APPROVED)
+        .order_by()
+        .values_list(
+            "pk", "staff_id", "leave_type", "start", "end", "start_date", "end_date"
+        )
+    )
+    # the leave objects replace their saved versions
+    overlapping = _get_overlapping_applications(
+        leave_objs, checked, [row for row in approved if row[0] not in pks]
+    )
+    for index in overlapping:
+        errors[index].append(_("you cannot have overlapping leave days"))
+    if check_balance:
+        balance_errors = _get_leave_balance_errors(
+            leave_objs, checked, [row for row in approved if row[0] in pks]
+        )
+        for index, msg in balance_errors:
+            errors[index].append(msg)
+    return errors
+
+
+def _get_overlapping_applications(
+    leave_objs: Sequence[Leave], checked: Sequence[bool], approved: Sequence[tuple]
+) -> List[int]:
+    """
+    Get the indexes of the checked leave objects that overlap approved leave.
+
+    :param leave_objs: the leave objects, of which the approved ones count too
+    :param checked: whether to check each leave object
+    :param approved: (pk, staff_id, leave_type, start, end, ...) rows of the other
+        approved leave
+    """
+    # leave objects do not overlap themselves
+    others = [(None,) + tuple(row[1:5]) for row in approved] + [
+        (index, _.staff_id, _.leave_type, _.start, _.end)
+        for index, _ in enumerate(leave_objs)
+        if _.review_status == Leave.APPROVED
+    ]
+    return [
+        index
+        for index, leave_obj in enumerate(leave_objs)
+        if checked[index]
+        and any(
+            other_index != index
+            and staff_id == leave_obj.staff_id
+            and leave_type == leave_obj.leave_type
+            and start <= leave_obj.end
+            and end >= leave_obj.start
+            for other_index, staff_id, leave_type, start, end in others
+        )
+    ]
+
+
+def _get_leave_balance_errors(
+    leave_objs: Sequence[Leave], checked: Sequence[bool], saved_rows: Sequence[tuple]
+) -> List[Tuple[int, str]]:
+    """
+    Get the (index, message) of the checked leave objects that take too many days.
+
+    :param leave_objs: the leave objects
+    :param checked: whether to check each leave object
+    :param saved_rows: (pk, staff_id, leave_type, start, end, start_date, end_date)
+        rows of the saved versions of the leave objects that are approved
+    """
+    needed, saved = _get_needed_leave_days(leave_objs, checked, saved_rows)
+    keys = {key for days in needed for key in days}
+    available: Dict[TakenDaysKey, Decimal] = defaultdict(Decimal)
+    # pylint: disable=no-member
+    for annual_leave in AnnualLeave.objects.filter(
+        get_balance_key_query(
+            (staff_id, year, leave_type) for staff_id, leave_type, year in keys
+        )
+    ).order_by():
+        key = (annual_leave.staff_id, annual_leave.leave_type, annual_leave.year)
+        available[key] = annual_leave.get_available_leave_days() + saved[key]
+    errors = []
+    for index, leave_obj in enumerate(leave_objs):
+        for key, days in needed[index].items():
+            if days > available[key]:
+                msg = get_not_enough_days_message(leave_obj.leave_type, available[key])
+                errors.append((index, msg))
+                break
+        else:
+            for key, days in needed[index].items():
+                available[key] -= days
+    return errors
+
+
+def _get_needed_leave_days(
+    leave_objs: Sequence[Leave], checked: Sequence[bool], saved_rows: Sequence[tuple]
+) -> Tuple[List[Dict[TakenDaysKey, Decimal]], Dict[TakenDaysKey, Decimal]]:
+    """
+    Count the days needed by the leave objects, and by their saved versions.
+
+    Returns the days that each leave object needs, and the days that their saved
+    versions already take from AnnualLeave.taken_days, all in one go.
+    """
+    needed: List[Dict[TakenDaysKey, Decimal]] = [
+        defaultdict(Decimal) for _ in leave_objs
+    ]
+    saved: Dict[TakenDaysKey, Decimal] = defaultdict(Decimal)
+    counts = sum_leave_day_counts(_get_leave_day_rows(leave_objs, checked, saved_rows))
+    for (owner, key), count in counts.items():
+        if owner is None:
+            saved[key] += count
+        else:
+            needed[owner][key] += count
+    return needed, saved
+
+
+def _get_leave_day_rows(
+    leave_objs: Sequence[Leave], checked: Sequence[bool], saved_rows: Sequence[tuple]
+) -> Iterator[Tuple[Tuple[Optional[int], TakenDaysKey], date, date, Optional[int]]]:
+    """
+    Yield the days of the leave objects and of their saved versions, by year.
+
+    The rows are ((index, key), start, end, calendar_id) tuples for
+    sum_leave_day_counts, where index is that of the leave object, or None for
+    a saved version.
+    """
+    calendar_ids = get_calendar_ids(
+        {_.staff_id for _ in leave_objs} | {row[1] for row in saved_rows}, leave_objs
+    )
+    for index, leave_obj in enumerate(leave_objs):
+        if checked[index]:
+            for year, start_date, end_date in get_year_intervals(
+                get_local_date(leave_obj.start), get_local_date(leave_obj.end)
+            ):
+                key = (leave_obj.staff_id, leave_obj.leave_type, year)
+                yield (index, key), start_date, end_date, calendar_ids[key[0]]
+    for row in saved_rows:
+        for year, start_date, end_date in get_year_intervals(row[5], row[6]):
+            key = (row[1], row[2], year)
+            yield (None, key), start_date, end_date, calendar_ids[key[0]]
+
+
+def get_calendar_ids(
+    staff_ids: Iterable[int], leave_objs: Sequence[Leave] = ()
+) -> Dict[int, Optional[int]]:
+    """
+    Get the HolidayCalendar ids of many staff members.
+
+    Staff members already loaded on the given leave objects are not queried.
+    """
+    calendar_ids = {
+        leave_obj.staff_id: leave_obj.staff.calendar_id
+        for leave_obj in leave_objs
+        if Leave.staff.is_cached(leave_obj)
+    }
+    missing = set(staff_ids) - set(calendar_ids)
+    if missing:
+        # pylint: disable=no-member
+        calendar_ids.update(
+            StaffProfile.objects.filter(pk__in=missing)
+            .order_by()
+            .values_list("pk", "calendar_id")
+        )
+    return calendar_ids
+
+
+def rollover_annual_leave(
+    year: int,
+    staff_qs: Optional[QuerySet] = None,
+    batch_size: int = ROLLOVER_BATCH_SIZE,
+    progress: Optional[Callable[[int, int], None]] = None,
+) -> int:
+    """
+    Create the AnnualLeave records of a year for many staff members at once.
+
+    Does what create_annual_leave does for every staff member and leave type, in
+    batches that each take a constant number of queries.  Existing records are
+    left alone.  Returns the number of records created.
+
+    :param year: the year
+    :param staff_qs: the staff members, defaults to those still employed in the
+        year whose user account is active
+    :param batch_size: the number of staff members handled at once
+    :param progress: called with the number of staff members done and the total
+        number of staff members after each batch
+    """
+    # pylint: disable=no-member
+    if staff_qs is None:
+        staff_qs = StaffProfile.objects.filter(user__is_active=True).filter(
+            Q(end_date__isnull=True) | Q(end_date__gte=date(year, 1, 1))
+        )
+    staff_ids = list(staff_qs.order_by("id").values_list("id", flat=True))
+    created = 0
+    for index in range(0, len(staff_ids), batch_size):
+        batch_ids = staff_ids[index:index + batch_size]
+        batch_qs = StaffProfile.objects.filter(id__in=batch_ids)
+        created += _rollover_annual_leave_batch(year, batch_qs)
+        if progress is not None:
+            progress(min(index + batch_size, len(staff_ids)), len(staff_ids))
+    return created
 
 
-def create_free_days(start_year: int = timezone.now().year, number_of_years: int = 11):
+def _rollover_annual_leave_batch(
+    year: int,
+    staff_qs: QuerySet,
+    leave_types: Iterable[str] = (Leave.REGULAR, Leave.SICK),
+) -> int:
+    """
+    Create the AnnualLeave records of a year for a batch of staff members.
+
+    Conflicting records that are created concurrently are left alone.  Returns
+    the number of records that were missing.
+    """
+    # pylint: disable=no-member
+    existing = set(
+        AnnualLeave.objects.filter(staff__in=staff_qs, year=year)
+        .order_by()
+        .values_list("staff_id", "leave_type")
+    )
+    previous_year = (
+        AnnualLeave.objects.filter(
+            staff__in=staff_qs, year=year - 1, leave_type=Leave.REGULAR
+        )
+        .order_by()
+        .only("staff_id", "allowed_days", "carried_over_days", "taken_days")
+    )
+    carry_over = {
+        _.staff_id: limit_carry_over(_.get_available_leave_days()) for _ in previous_year
+    }
+    leave_types = list(leave_types)
+    taken = {
+        leave_type: get_leave_balances(staff_qs, year, leave_type)
+        for leave_type in leave_types
+    }
+
+    annual_leaves: List[AnnualLeave] = []
+    for staff_id, leave_days, sick_days in staff_qs.order_by().values_list(
+        "id", "leave_days", "sick_days"
+    ):
+        for leave_type, allowed_days in (
+            (Leave.REGULAR, leave_days),
+            (Leave.SICK, sick_days),
+        ):
+            if leave_type not in taken or (staff_id, leave_type) in existing:
+                continue
+            annual_leaves.append(
+                AnnualLeave(
+                    staff_id=staff_id,
+                    year=year,
+                    leave_type=leave_type,
+                    allowed_days=allowed_days,
+                    carried_over_days=carry_over.get(staff_id, 0)
+                    if leave_type == Leave.REGULAR
+                    else 0,
+                    taken_days=taken[leave_type][staff_id]["taken"],
+                )
+            )
+
+    AnnualLeave.objects.bulk_create(annual_leaves, ignore_conflicts=True)
+    balance_cache.invalidate((_.staff_id, year, _.leave_type) for _ in annual_leaves)
+    return len(annual_leaves)
+
+
+def get_carry_over_chain(
+    annual_leaves: Iterable[AnnualLeave], from_year: Optional[int] = None
+) -> Dict[int, Tuple[Decimal, Decimal]]:
+    """
+    Walk the regular AnnualLeave years of one staff member in order.
+
+    Returns a dict keyed by year, of the days carried over into the year and the
+    days remaining at its end.  Each year is worked out once, from the days
+    remaining at the end of the year before, so changing an early year carries
+    through to all the years that follow.  A year without an AnnualLeave record
+    for the year before keeps its stored carried over days.
+
+    :param annual_leaves: the AnnualLeave records of one staff member and type
+    :param from_year: years before this one keep their stored carried over days
+    """
+    chain: Dict[int, Tuple[Decimal, Decimal]] = {}
+    for annual_leave in sorted(annual_leaves, key=lambda _: _.year):
+        previous = chain.get(annual_leave.year - 1)
+        if previous is not None and (from_year is None or annual_leave.year >= from_year):
+            annual_leave.carried_over_days = limit_carry_over(previous[1])
+        chain[annual_leave.year] = (
+            annual_leave.carried_over_days,
+            annual_leave.get_available_leave_days(),
+        )
+    return chain
+
+
+def recompute_carry_over(
+    staff_qs: Optional[QuerySet] = None,
+    from_year: Optional[int] = None,
+    batch_size: int = ROLLOVER_BATCH_SIZE,
+) -> int:
+    """
+    Recompute the carried over days of regular AnnualLeave records.
+
+    Use this after leave in a past year was corrected.  The leave days taken are
+    read from the AnnualLeave taken_days counters.  Returns the number of
+    AnnualLeave records that changed.
+
+    :param staff_qs: the staff members, defaults to all of them
+    :param from_year: years before this one are not changed
+    :param batch_size: the number of staff members handled at once
+    """
+    # pylint: disable=no-member
+    if staff_qs is None:
+        staff_qs = StaffProfile.objects.all()
+    staff_ids = list(staff_qs.order_by("id").values_list("id", flat=True))
+    changed = 0
+    for index in range(0, len(staff_ids), batch_size):
+        annual_leaves = AnnualLeave.objects.filter(
+            staff_id__in=staff_ids[index:index + batch_size], leave_type=Leave.REGULAR
+        ).order_by("staff_id", "year")
+        changed_leaves = []
+        for _staff_id, group in groupby(annual_leaves, key=lambda _: _.staff_id):
+            staff_leaves = list(group)
+            stored = {_.year: _.carried_over_days for _ in staff_leaves}
+            get_carry_over_chain(staff_leaves, from_year=from_year)
+            changed_leaves += [
+                _ for _ in staff_leaves if _.carried_over_days != stored[_.year]
+            ]
+        AnnualLeave.objects.bulk_update(changed_leaves, ["carried_over_days"])
+        keys = {(_.staff_id, _.year, _.leave_type) for _ in changed_leaves}
+        balance_cache.invalidate(keys)
+        update_monthly_leave_balances(keys)
+        changed += len(changed_leaves)
+    return changed
+
+
+def create_monthly_leave_balances(
+    year: int,
+    staff_qs: Optional[QuerySet] = None,
+    batch_size: int = ROLLOVER_BATCH_SIZE,
+    progress: Optional[Callable[[int, int], None]] = None,
+) -> int:
+    """
+    Create the MonthlyLeaveBalance records of a year for many staff members.
+
+    Every AnnualLeave record of the year gets a record per month, and existing
+    records of the year are replaced.  From then on the records are kept up to
+    date as leave, annual leave and free days change.  Returns the number of
+    records created.
+
+    :param year: the year
+    :param staff_qs: the staff members, defaults to all of them
+    :param batch_size: the number of staff members handled at once
+    :param progress: called with the number of staff members done and the total
+        number of staff members after each batch
+    """
+    # pylint: disable=no-member
+    if staff_qs is None:
+        staff_qs = StaffProfile.objects.all()
+    staff_ids = list(staff_qs.order_by("id").values_list("id", flat=True))
+    created = 0
+    for index in range(0, len(staff_ids), batch_size):
+        batch_ids = staff_ids[index:index + batch_size]
+        keys = set()
+        for model in (AnnualLeave, MonthlyLeaveBalance):
+            keys.update(
+                model.objects.filter(staff_id__in=batch_ids, year=year)
+                .order_by()
+                .values_list("staff_id", "year", "leave_type")
+                .distinct()
+            )
+        created += save_monthly_leave_balances(keys)
+        if progress is not None:
+            progress(min(index + batch_size, len(staff_ids)), len(staff_ids))
+    return created
+
+
+def get_leave_balances(
+    staff_qs: QuerySet, year: int, leave_type: str, month: int = 12
+) -> Dict[int, Dict[str, Decimal]]:
+    """
+    Get the leave balances of many staff members at once.
+
+    Returns a dict keyed by StaffProfile id.  Each value is a dict with the
+    `earned`, `carried_over`, `taken` and `available` leave days for the year,
+    computed the same way as AnnualLeave.get_available_leave_days.  Staff members
+    without an AnnualLeave record have nothing earned or available.
+
+    The number of queries does not depend on the number of staff members.  Their
+    leave is grouped by HolidayCalendar and the free days of all the calendars
+    are loaded at once.
+
+    :param staff_qs: a StaffProfile queryset
+    :param year: the year
+    :param leave_type: the leave type
+    :param month: the month up to which leave days are earned
+    """
+    # pylint: disable=no-member
+    balances = {
+        staff_id: {
+            "earned": Decimal(0),
+            "carried_over": Decimal(0),
+            "taken": Decimal(0),
+            "available": Decimal(0),
+        }
+        for staff_id in staff_qs.values_list("id", flat=True)
+    }
+
+    leave_qs = (
+        Leave.objects.filter(
+            staff__in=staff_qs, review_status=Leave.APPROVED, leave_type=leave_type
+        )
+        .overlapping_years(year, year)
+        .order_by()
+        .values_list("staff_id", "start_date", "end_date", "staff__calendar_id")
+    )
+    first_day, last_day = date(year, 1, 1), date(year, 12, 31)
+    taken = sum_leave_day_counts(
+        (staff_id, max(start_date, first_day), min(end_date, last_day), calendar_id)
+        for staff_id, start_date, end_date, calendar_id in leave_qs
+    )
+    for staff_id, count in taken.items():
+        balances[staff_id]["taken"] += count
+
+    annual_leave_qs = AnnualLeave.objects.filter(
+        staff__in=staff_qs, year=year, leave_type=leave_type
+    ).order_by()
+    for annual_leave in annual_leave_qs:
+        balance = balances[annual_leave.staff_id]
+        balance["earned"] = annual_leave.get_earned_leave_days(month=month)
+        balance["carried_over"] = annual_leave.carried_over_days
+        balance["available"] = Decimal(
+            balance["earned"] + balance["carried_over"] - balance["taken"]
+        )
+
+    return balances
+
+
+def get_balances_as_of(
+    staff_qs: QuerySet, as_of: date, leave_type: str
+) -> Dict[int, Decimal]:
+    """
+    Get the available leave days of many staff members at a date.
+
+    Returns a dict keyed by StaffProfile id.  The days allowed in the year are
+    earned day by day, and only leave taken up to and including the date is
+    counted.  On the last day of the year this is what
+    AnnualLeave.get_available_leave_days returns.  Staff members without an
+    AnnualLeave record for the year have nothing available.
+
+    Leave that ends by the date is counted using its stored day count and the
+    rest is counted from the bitmaps of free_day_calendar, grouped by
+    HolidayCalendar, so the number of queries does not depend on the number of
+    staff members.
+
+    :param staff_qs: a StaffProfile queryset
+    :param as_of: the date
+    :param leave_type: the leave type
+    """
+    taken = get_taken_days_as_of(staff_qs, as_of, leave_type)
+    balances = {staff_id: Decimal(0) for staff_id in taken}
+    days_in_year = date(as_of.year, 12, 31).timetuple().tm_yday
+    # pylint: disable=no-member
+    annual_leave_qs = (
+        AnnualLeave.objects.filter(
+            staff__in=staff_qs, year=as_of.year, leave_type=leave_type
+        )
+        .order_by()
+        .values_list("staff_id", "allowed_days", "carried_over_days")
+    )
+    for staff_id, allowed_days, carried_over_days in annual_leave_qs:
+        earned = allowed_days * as_of.timetuple().tm_yday / days_in_year
+        balances[staff_id] = Decimal(earned + carried_over_days - taken[staff_id])
+
+    return balances
+
+
+def get_taken_days_as_of(
+    staff_qs: QuerySet, as_of: date, leave_type: str
+) -> Dict[int, Decimal]:
+    """
+    Get the leave days that many staff members took from 1 January up to a date.
+
+    Returns a dict keyed by StaffProfile id, see get_balances_as_of.
+    """
+    # pylint: disable=no-member
+    first_day = date(as_of.year, 1, 1)
+    taken = {
+        staff_id: Decimal(0) for staff_id in staff_qs.values_list("id", flat=True)
+    }
+
+    leave_qs = (
+        Leave.objects.filter(
+            staff__in=staff_qs, review_status=Leave.APPROVED, leave_type=leave_type
+        )
+        .overlapping(first_day, as_of)
+        .order_by()
+        .values_list(
+            "staff_id", "start_date", "end_date", "day_count", "staff__calendar_id"
+        )
+    )
+    partial_leave = []
+    for staff_id, start_date, end_date, day_count, calendar_id in leave_qs:
+        if start_date >= first_day and end_date <= as_of:
+            taken[staff_id] += day_count
+        else:
+            partial_leave.append(
+                (staff_id, max(start_date, first_day), min(end_date, as_of), calendar_id)
+            )
+    for staff_id, count in sum_leave_day_counts(partial_leave).items():
+        taken[staff_id] += count
+    return taken
+
+
+def get_balance_as_of(staffprofile: StaffProfile, as_of: date, leave_type: str):
+    """
+    Get the available leave days of a staff member at a date.
+
+    See get_balances_as_of.
+    """
+    # pylint: disable=no-member
+    staff_qs = StaffProfile.objects.filter(pk=staffprofile.pk)
+    return get_balances_as_of(staff_qs, as_of=as_of, leave_type=leave_type)[
+        staffprofile.pk
+    ]
+
+
+def get_easter(year: int) -> date:
+    """Get the date of Easter Sunday in a year, in the Gregorian calendar."""
+    # the anonymous Gregorian algorithm
+    golden = year % 19
+    century, year_of_century = divmod(year, 100)
+    leap_centuries, century_remainder = divmod(century, 4)
+    correction = (century + 8) // 25
+    moon = (century - correction + 1) // 3
+    epact = (19 * golden + century - leap_centuries - moon + 15) % 30
+    leap_years, year_remainder = divmod(year_of_century, 4)
+    weekday = (32 + 2 * century_remainder + 2 * leap_years - epact - year_remainder) % 7
+    offset = (golden + 11 * epact + 22 * weekday) // 451
+    month, day = divmod(epact + weekday - 7 * offset + 114, 31)
+    return date(year, month, day + 1)
+
+
+def get_free_day_rule_date(rule: dict, year: int) -> date:
+    """
+    Get the date of a SSHR_FREE_DAYS rule in a year.
+
+    A rule is one of:
+
+        - a fixed date: {"day": 25, "month": 12}
+        - a number of days after Easter Sunday: {"easter": -2} for Good Friday
+        - the nth weekday of a month: {"month": 5, "weekday": 1, "nth": -1} for the
+          last Monday of May, where weekday 1 is Monday and 7 is Sunday
+
+    Raises ValueError if the rule has no date in the year, e.g. the 5th Monday of
+    a month that only has four, or 29 February in a year that is not a leap year.
+    """
+    if "easter" in rule:
+        return get_easter(year) + timedelta(days=rule["easter"])
+    if "weekday" in rule:
+        nth = rule.get("nth", 1)
+        if nth > 0:
+            first_day = date(year, rule["month"], 1)
+            offset = (rule["weekday"] - first_day.isoweekday()) % 7
+            the_date = first_day + timedelta(days=offset + (nth - 1) * 7)
+        else:
+            last_day = date(year, rule["month"], monthrange(year, rule["month"])[1])
+            offset = (last_day.isoweekday() - rule["weekday"]) % 7
+            the_date = last_day - timedelta(days=offset + (-nth - 1) * 7)
+        if the_date.month != rule["month"] or the_date.year != year:
+            raise ValueError(f"{rule} has no date in {year}")
+        return the_date
+    return date(year=year, month=rule["month"], day=rule["day"])
+
+
+def get_free_days(year: int, rules: Optional[List[dict]] = None) -> List[FreeDay]:
+    """
+    Get the free days of a year as unsaved FreeDay objects, ordered by date.
+
+    A rule with "observed": True that falls on a day off, i.e. a day whose value
+    in SSHR_DAY_LEAVE_VALUES is 0, is also observed on the next working day that
+    is not already a free day.  The observed day may be in the next year, so the
+    free days of the years before and after are taken into account too.  A rule
+    may have a "name".  Rules that have no date in the year are skipped.
+
+    :param year: the year
+    :param rules: the rules, defaults to SSHR_FREE_DAYS
+    """
+    if rules is None:
+        rules = settings.SSHR_FREE_DAYS
+    days_off = {
+        weekday for weekday, value in settings.SSHR_DAY_LEAVE_VALUES.items() if not value
+    }
+    if len(days_off) == 7:
+        # there is no working day to observe free days on
+        days_off = set()
+    rule_dates = []
+    for rule_year in (year - 1, year, year + 1):
+        for rule in rules:
+            try:
+                the_date = get_free_day_rule_date(rule, rule_year)
+            except ValueError:
+                continue
+            rule_dates.append((the_date, rule_year, rule))
+    # observed days are handed out in date order, the earliest free day first
+    rule_dates.sort(key=lambda rule_date: rule_date[0])
+    taken = {the_date for the_date, rule_year, rule in rule_dates}
+    free_days: Dict[date, str] = {}
+    for the_date, rule_year, rule in rule_dates:
+        if rule_year == year:
+            free_days.setdefault(the_date, rule.get("name", ""))
+    for the_date, rule_year, rule in rule_dates:
+        if rule.get("observed") and the_date.isoweekday() in days_off:
+            observed = the_date
+            while observed in taken or observed.isoweekday() in days_off:
+                observed += timedelta(days=1)
+            taken.add(observed)
+            if rule_year == year:
+                name = rule.get("name", "")
+                free_days[observed] = _(f"{name} (observed)") if name else ""
+    return [
+        FreeDay(name=name or the_date.strftime("%A %d %B %Y"), date=the_date)
+        for the_date, name in sorted(free_days.items())
+    ]
+
+
+def create_free_days(
+    start_year: Optional[int] = None,
+    number_of_years: int = 11,
+    rules: Optional[List[dict]] = None,
+    calendar: Optional[HolidayCalendar] = None,
+) -> int:
     """
     Create FreeDay records.
 
-    :param start_year:  the year from which to start creating free days
+    All the free days are inserted at once and those that already exist are left
+    alone, so this can be run again for the same years.  Since bulk inserts do
+    not send the FreeDay signals, the calendar and balance caches are cleared
+    and the day counts of affected leave are updated here.  Returns the number
+    of free days created.
+
+    :param start_year:  the year from which to start creating free days, defaults
+        to this year
     :param number_of_years: number of years to create free days objects
+    :param rules: the rules of the free days, defaults to SSHR_FREE_DAYS
+    :param calendar: the HolidayCalendar of the free days, defaults to the default
+        calendar
     """
-    default_days = settings.SSHR_FREE_DAYS
-    years = (start_year + _ for _ in range(number_of_years))
-    for year in years:
-        for default_day in default_days:
-            the_date = date(
-                year=year, month=default_day["month"], day=default_day["day"],
+    if start_year is None:
+        start_year = timezone.now().year
+    years = range(start_year, start_year + number_of_years)
+    free_days = [_ for year in years for _ in get_free_days(year, rules=rules)]
+    if not free_days:
+        return 0
+    for free_day in free_days:
+        free_day.calendar = calendar
+    # observed free days may be in the year after the last one
+    dates = [_.date for _ in free_days]
+    # pylint: disable=no-member
+    existing = set(
+        FreeDay.objects.filter(
+            calendar=calendar, date__gte=min(dates), date__lte=max(dates)
+        ).values_list("date", flat=True)
+    )
+    free_days = [_ for _ in free_days if _.date not in existing]
+    FreeDay.objects.bulk_create(free_days, batch_size=1000, ignore_conflicts=True)
+    if free_days:
+        dates = [_.date for _ in free_days]
+        free_day_calendar.invalidate(years={_.year for _ in dates})
+        balance_cache.invalidate()
+        update_leave_day_counts(
+            Leave.objects.filter(staff__calendar=calendar).overlapping(
+                min(dates), max(dates)
             )
-            free_day = FreeDay(name=the_date.strftime("%A %d %B %Y"), date=the_date,)
-            free_day.save()
+        )
+    return len(free_days)
@@ -0,0 +1,129 @@
+"""Module to test small_small_hr balances."""
+import tempfile
+from contextlib import contextmanager
+from datetime import datetime
+from decimal import Decimal
+from unittest.mock import Mock
+
+from django.conf import settings
+from django.test import TestCase, override_settings
+
+import pytz
+from model_mommy import mommy
+
+from small_small_hr.balances import BalanceCache
+from small_small_hr.models import Leave
+
+
+@contextmanager
+def shared_cache():
+    """Use a default cache that could be shared by all processes."""
+    with tempfile.TemporaryDirectory() as cache_dir, override_settings(
+        CACHES={
+            "default": {
+                "BACKEND": "django.core.cache.backends.filebased.FileBasedCache",
+                "LOCATION": cache_dir,
+            }
+        }
+    ):
+        yield
+
+
+class TestBalanceCache(TestCase):
+    """Test class for BalanceCache."""
+
+    def test_get(self):
+        """Test get and invalidate."""
+        with shared_cache():
+            cache = BalanceCache()
+            self.assertIsNotNone(cache.cache)
+            compute = Mock(return_value=Decimal(5))
+            key = (-1, 2017, Leave.REGULAR)
+
+            self.assertEqual(5, cache.get(key, "approved", compute))
+            self.assertEqual(5, cache.get(key, "approved", compute))
+            self.assertEqual(1, compute.call_count)
+            # balances are cached by name
+            self.assertEqual(5, cache.get(key, "available", compute))
+            self.assertEqual(2, compute.call_count)
+            # and by day values
+            with override_settings(
+                SSHR_DAY_LEAVE_VALUES={1: 1, 2: 1, 3: 1, 4: 1, 5: 1, 6: 1, 7: 1}
+            ):
+                cache.get(key, "approved", compute)
+            self.assertEqual(3, compute.call_count)
+
+            # other keys are not invalidated
+            cache.invalidate([(-1, 2018, Leave.REGULAR), (-1, 2017, Leave.SICK)])
+            cache.get(key, "approved", compute)
+            self.assertEqual(3, compute.call_count)
+
+            # while the transaction is open invalidated keys are not cached
+            cache.invalidate([key])
+            cache.get(key, "approved", compute)
+            cache.get(key, "approved", compute)
+            self.assertEqual(5, compute.call_count)
+            # pretend the transaction was committed
+            cache._bump([key])  # pylint: disable=protected-access
+            cache._pending.clear()  # pylint: disable=protected-access
+            cache.get(key, "approved", compute)
+            cache.get(key, "approved", compute)
+            self.assertEqual(6, compute.call_count)
+
+            # invalidating everything
+            cache._bump()  # pylint: disable=protected-access
+            cache.get(key, "approved", compute)
+            self.assertEqual(7, compute.call_count)
+
+            # unsaved staff members are not cached
+            cache.get((None, 2017, Leave.REGULAR), "approved", compute)
+            cache.get((None, 2017, Leave.REGULAR), "approved", compute)
+            self.assertEqual(9, compute.call_count)
+
+    def test_no_shared_cache(self):
+        """Test that balances are not cached in a cache private to the process."""
+        cache = BalanceCache()
+        self.assertIsNone(cache.cache)
+        compute = Mock(return_value=Decimal(5))
+        key = (-1, 2017, Leave.REGULAR)
+        self.assertEqual(5, cache.get(key, "approved", compute))
+        self.assertEqual(5, cache.get(key, "approved", compute))
+        self.assertEqual(2, compute.call_count)
+        cache.invalidate([key])
+        self.assertEqual(5, cache.get(key, "approved", compute))
+        self.assertEqual(3, compute.call_count)
+
+    def test_staffprofile_balances(self):
+        """Test that cached StaffProfile balances follow Leave and AnnualLeave."""
+        with shared_cache():
+            tzinfo = pytz.timezone(settings.TIME_ZONE)
+            staff = mommy.make("small_small_hr.StaffProfile")
+            annual_leave = mommy.make(
+                "small_small_hr.AnnualLeave",
+                staff=staff,
+                year=2017,
+                leave_type=Leave.REGULAR,
+                allowed_days=21,
+            )
+            self.assertEqual(0, staff.get_approved_leave_days(year=2017))
+            self.assertEqual(21, staff.get_available_leave_days(year=2017))
+
+            leave_obj = mommy.make(
+                "small_small_hr.Leave",
+                staff=staff,
+                start=tzinfo.localize(datetime(2017, 6, 5, 7)),
+                end=tzinfo.localize(datetime(2017, 6, 9, 7)),
+                leave_type=Leave.REGULAR,
+                review_status=Leave.APPROVED,
+            )
+            self.assertEqual(5, staff.get_approved_leave_days(year=2017))
+            self.assertEqual(16, staff.get_available_leave_days(year=2017))
+            self.assertEqual(0, staff.get_approved_sick_days(year=2017))
+
+            annual_leave.allowed_days = 20
+            annual_leave.save()
+            self.assertEqual(15, staff.get_available_leave_days(year=2017))
+
+            leave_obj.delete()
+            self.assertEqual(0, staff.get_approved_leave_days(year=2017))
+            self.assertEqual(20, staff.get_available_leave_days(year=2017))
@@ -0,0 +1,38 @@
+"""Module to test small_small_hr caching helpers."""
+from unittest.mock import Mock
+
+from django.db import transaction
+from django.test import TestCase
+
+from small_small_hr.caching import PendingCallbacks, get_version_stamp
+
+
+class TestCaching(TestCase):
+    """Test class for caching helpers."""
+
+    def test_get_version_stamp(self):
+        """Test get_version_stamp."""
+        first = get_version_stamp()
+        self.assertIsInstance(first, int)
+        self.assertLessEqual(first, get_version_stamp())
+
+    def test_pending_callbacks(self):
+        """Test that PendingCallbacks follows savepoints."""
+        pending = PendingCallbacks()
+        callback = Mock()
+        pending.add(callback, value="kept")
+        self.assertEqual([("kept", callback)], pending.get())
+
+        # callbacks of a rolled back savepoint are dropped
+        try:
+            with transaction.atomic():
+                pending.add(Mock(), value="dropped")
+                self.assertEqual(2, len(pending.get()))
+                raise ValueError
+        except ValueError:
+            pass
+        self.assertEqual([("kept", callback)], pending.get())
+
+        pending.clear()
+        self.assertEqual([], pending.get())
+        callback.assert_not_called()
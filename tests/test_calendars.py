@@ -0,0 +1,291 @@
+"""Module to test small_small_hr calendars."""
+import tempfile
+from datetime import date
+from decimal import Decimal
+from unittest.mock import Mock, PropertyMock, patch
+
+from django.core.cache import caches
+from django.test import TestCase, override_settings
+
+from model_mommy import mommy
+
+from small_small_hr.calendars import (
+    FreeDayCalendar,
+    free_day_calendar,
+    get_day_value_scale,
+    get_day_value_units,
+    popcount,
+    units_to_days,
+)
+from small_small_hr.models import FreeDay
+from small_small_hr.signals import expire_free_day_calendar
+
+
+class TestFreeDayCalendar(TestCase):
+    """Test class for FreeDayCalendar."""
+
+    def test_get_free_days(self):
+        """Test get_free_days."""
+        mommy.make("small_small_hr.FreeDay", date=date(2017, 12, 25))
+        mommy.make("small_small_hr.FreeDay", date=date(2018, 1, 1))
+        mommy.make("small_small_hr.FreeDay", date=date(2019, 1, 1))
+        calendar = FreeDayCalendar()
+
+        with self.assertNumQueries(1):
+            self.assertEqual(
+                frozenset([date(2017, 12, 25), date(2018, 1, 1)]),
+                calendar.get_free_days(2017, 2018),
+            )
+        # the years are now cached
+        with self.assertNumQueries(0):
+            self.assertEqual(
+                frozenset([date(2018, 1, 1)]), calendar.get_free_days(2018)
+            )
+            self.assertTrue(calendar.is_free_day(date(2017, 12, 25)))
+            self.assertFalse(calendar.is_free_day(date(2017, 12, 26)))
+        # only the missing year is loaded
+        with self.assertNumQueries(1):
+            self.assertEqual(
+                frozenset([date(2017, 12, 25), date(2018, 1, 1), date(2019, 1, 1)]),
+                calendar.get_free_days(2017, 2019),
+            )
+
+    def test_holiday_calendars(self):
+        """Test that each HolidayCalendar has its own free days."""
+        kenya = mommy.make("small_small_hr.HolidayCalendar", name="Kenya")
+        uganda = mommy.make("small_small_hr.HolidayCalendar", name="Uganda")
+        mommy.make("small_small_hr.FreeDay", date=date(2017, 6, 1))
+        mommy.make("small_small_hr.FreeDay", date=date(2017, 6, 1), calendar=kenya)
+        mommy.make("small_small_hr.FreeDay", date=date(2017, 6, 3), calendar=uganda)
+        mommy.make("small_small_hr.FreeDay", date=date(2017, 6, 9), calendar=uganda)
+        calendar = FreeDayCalendar()
+
+        # all the calendars are loaded at once
+        with self.assertNumQueries(1):
+            calendar.load_calendars(2017, 2017, [None, kenya.id, uganda.id])
+        with self.assertNumQueries(0):
+            self.assertEqual(
+                frozenset([date(2017, 6, 1)]), calendar.get_free_days(2017)
+            )
+            self.assertEqual(
+                frozenset([date(2017, 6, 1)]),
+                calendar.get_free_days(2017, calendar_id=kenya.id),
+            )
+            self.assertEqual(
+                frozenset([date(2017, 6, 3), date(2017, 6, 9)]),
+                calendar.get_free_days(2017, calendar_id=uganda.id),
+            )
+            self.assertTrue(calendar.is_free_day(date(2017, 6, 1)))
+            self.assertFalse(calendar.is_free_day(date(2017, 6, 1), uganda.id))
+            # 1 to 9 June 2017 has 7 weekdays
+            self.assertEqual(
+                6, calendar.count_leave_days(date(2017, 6, 1), date(2017, 6, 9))
+            )
+            self.assertEqual(
+                6,
+                calendar.count_leave_days(
+                    date(2017, 6, 1), date(2017, 6, 9), calendar_id=kenya.id
+                ),
+            )
+            # 3 June 2017 is a Saturday
+            self.assertEqual(
+                6,
+                calendar.count_leave_days(
+                    date(2017, 6, 1), date(2017, 6, 9), calendar_id=uganda.id
+                ),
+            )
+        # calendars that are already loaded are not loaded again
+        with self.assertNumQueries(0):
+            calendar.load_calendars(2017, 2017, [kenya.id, uganda.id])
+
+        # clearing a year clears it for all the calendars
+        calendar._clear([2017])  # pylint: disable=protected-access
+        with self.assertNumQueries(1):
+            calendar.load_calendars(2017, 2017, [kenya.id, uganda.id])
+        with self.assertNumQueries(1):
+            calendar.get_free_days(2017)
+
+    def test_invalidation(self):
+        """Test that FreeDay signals invalidate the shared calendar."""
+        self.assertFalse(free_day_calendar.is_free_day(date(2017, 6, 8)))
+
+        free_day = mommy.make("small_small_hr.FreeDay", date=date(2017, 6, 8))
+        self.assertTrue(free_day_calendar.is_free_day(date(2017, 6, 8)))
+
+        free_day.date = date(2017, 6, 9)
+        free_day.save()
+        self.assertFalse(free_day_calendar.is_free_day(date(2017, 6, 8)))
+        self.assertTrue(free_day_calendar.is_free_day(date(2017, 6, 9)))
+
+        FreeDay.objects.all().delete()
+        self.assertFalse(free_day_calendar.is_free_day(date(2017, 6, 9)))
+
+    def test_shared_version(self):
+        """Test that calendars in other processes are cleared through the cache."""
+        with tempfile.TemporaryDirectory() as cache_dir, override_settings(
+            CACHES={
+                "default": {
+                    "BACKEND": "django.core.cache.backends.filebased.FileBasedCache",
+                    "LOCATION": cache_dir,
+                }
+            }
+        ):
+            # a calendar in this process and one in another
+            calendar = FreeDayCalendar()
+            other = FreeDayCalendar()
+            self.assertIsNotNone(calendar.shared_cache)
+            self.assertFalse(other.is_free_day(date(2017, 6, 8)))
+
+            mommy.make("small_small_hr.FreeDay", date=date(2017, 6, 8))
+            calendar.invalidate(years=[2017])
+            # pretend the transaction was committed
+            calendar._bump()  # pylint: disable=protected-access
+            # the other process still uses its calendar
+            with self.assertNumQueries(0):
+                self.assertFalse(other.is_free_day(date(2017, 6, 8)))
+            # until it checks the version at the start of a request
+            other.expire()
+            with self.assertNumQueries(1):
+                self.assertTrue(other.is_free_day(date(2017, 6, 8)))
+            # which only costs a query when the version changed
+            other.expire()
+            with self.assertNumQueries(0):
+                self.assertTrue(other.is_free_day(date(2017, 6, 8)))
+
+            # the version outlives its eviction
+            caches["default"].clear()
+            other.expire()
+            with self.assertNumQueries(1):
+                self.assertTrue(other.is_free_day(date(2017, 6, 8)))
+
+            # outside requests the version is checked every so often
+            with override_settings(SSHR_CALENDAR_CHECK_INTERVAL=0):
+                calendar._bump()  # pylint: disable=protected-access
+                with self.assertNumQueries(1):
+                    self.assertTrue(other.is_free_day(date(2017, 6, 8)))
+
+    def test_no_shared_cache(self):
+        """Test that without a shared cache the calendar is loaded per request."""
+        calendar = FreeDayCalendar()
+        self.assertIsNone(calendar.shared_cache)
+        self.assertFalse(calendar.is_free_day(date(2017, 6, 8)))
+        with self.assertNumQueries(0):
+            self.assertFalse(calendar.is_free_day(date(2017, 6, 8)))
+        calendar.expire()
+        with self.assertNumQueries(1):
+            self.assertFalse(calendar.is_free_day(date(2017, 6, 8)))
+
+        # the shared calendar is checked at the start of each request
+        free_day_calendar.is_free_day(date(2017, 6, 8))
+        expire_free_day_calendar(sender=None)
+        with self.assertNumQueries(1):
+            free_day_calendar.is_free_day(date(2017, 6, 8))
+
+    def test_unreachable_shared_cache(self):
+        """Test that errors reaching the shared cache are logged, not raised."""
+        calendar = FreeDayCalendar()
+        cache = Mock()
+        with patch.object(
+            FreeDayCalendar, "shared_cache", new_callable=PropertyMock
+        ) as shared_cache:
+            shared_cache.return_value = cache
+            cache.get_or_set.side_effect = ConnectionError
+            cache.incr.side_effect = ConnectionError
+            with self.assertLogs("small_small_hr.calendars", "WARNING") as logs:
+                # pylint: disable=protected-access
+                self.assertIsNone(calendar._get_version())
+                calendar._bump()
+            self.assertEqual(2, len(logs.output))
+
+            # a version that does not exist yet is fine
+            cache.incr.side_effect = ValueError
+            calendar._bump()  # pylint: disable=protected-access
+
+            # but errors in the code are raised
+            cache.get_or_set.side_effect = TypeError
+            with self.assertRaises(TypeError):
+                calendar._get_version()  # pylint: disable=protected-access
+
+    @override_settings(
+        SSHR_DAY_LEAVE_VALUES={
+            1: 1,  # Monday
+            2: 1,  # Tuesday
+            3: 1,  # Wednesday
+            4: 1,  # Thursday
+            5: 1,  # Friday
+            6: 0.5,  # Saturday
+            7: 0,  # Sunday
+        }
+    )
+    def test_count_leave_days(self):
+        """Test count_leave_days."""
+        mommy.make("small_small_hr.FreeDay", date=date(2017, 6, 15))
+        mommy.make("small_small_hr.FreeDay", date=date(2018, 1, 1))
+        calendar = FreeDayCalendar()
+
+        bitmaps = calendar.get_leave_day_bitmaps(2017)
+        # the values are in tenths of a day
+        self.assertEqual([5, 10], [_[0] for _ in bitmaps])
+        # 1/1/2017 is a Sunday
+        self.assertEqual(0b1000000, bitmaps[0][1] & 0b1111111)
+        self.assertEqual(0b0111110, bitmaps[1][1] & 0b1111111)
+        self.assertEqual(52, popcount(bitmaps[0][1]))
+        # 52 weeks and a Sunday, less a free day
+        self.assertEqual(52 * 5 - 1, popcount(bitmaps[1][1]))
+        self.assertTrue(calendar.is_leave_day(date(2017, 6, 14)))
+        self.assertFalse(calendar.is_leave_day(date(2017, 6, 15)))
+        self.assertTrue(calendar.is_leave_day(date(2017, 6, 17)))
+        self.assertFalse(calendar.is_leave_day(date(2017, 6, 18)))
+        self.assertEqual(
+            95, calendar.count_leave_units(date(2017, 6, 5), date(2017, 6, 16))
+        )
+
+        self.assertEqual(
+            Decimal("9.5"), calendar.count_leave_days(date(2017, 6, 5), date(2017, 6, 16))
+        )
+        self.assertEqual(
+            Decimal(6), calendar.count_leave_days(date(2017, 12, 29), date(2018, 1, 6))
+        )
+        self.assertEqual(
+            Decimal(0), calendar.count_leave_days(date(2017, 6, 16), date(2017, 6, 5))
+        )
+        with self.assertNumQueries(0):
+            self.assertEqual(
+                Decimal(1),
+                calendar.count_leave_days(date(2017, 6, 16), date(2017, 6, 16)),
+            )
+
+        # the bitmaps follow SSHR_DAY_LEAVE_VALUES
+        with override_settings(
+            SSHR_DAY_LEAVE_VALUES={1: 1, 2: 1, 3: 1, 4: 1, 5: 1, 6: 1, 7: 1}
+        ):
+            self.assertEqual(
+                Decimal(11),
+                calendar.count_leave_days(date(2017, 6, 5), date(2017, 6, 16)),
+            )
+
+        # free days are reloaded after the calendar is invalidated
+        calendar.invalidate(years=[2018])
+        with self.assertNumQueries(1):
+            calendar.count_leave_days(date(2017, 12, 29), date(2018, 1, 6))
+
+    def test_get_day_value_units(self):
+        """Test get_day_value_scale and get_day_value_units."""
+        self.assertEqual(1, get_day_value_scale({1: 1, 2: 0, 3: 10}))
+        self.assertEqual(10, get_day_value_scale({1: 1, 2: 0.5}))
+        self.assertEqual(100, get_day_value_scale({1: Decimal("0.25"), 2: 0.5}))
+
+        day_values = {1: 1, 2: 1, 3: 1, 4: 1, 5: 1, 6: 0.5, 7: 0}
+        self.assertEqual(
+            (10, (10, 10, 10, 10, 10, 5, 0)), get_day_value_units(day_values)
+        )
+        with override_settings(SSHR_DAY_LEAVE_UNITS=2):
+            self.assertEqual((2, (2, 2, 2, 2, 2, 1, 0)), get_day_value_units(day_values))
+        # values that are not whole units use a finer scale
+        day_values[6] = Decimal("0.25")
+        self.assertEqual(
+            (100, (100, 100, 100, 100, 100, 25, 0)), get_day_value_units(day_values)
+        )
+
+        self.assertEqual(Decimal("9.5"), units_to_days(95, 10))
+        self.assertEqual(Decimal(6), units_to_days(600, 100))
@@ -0,0 +1,192 @@
+"""Module to test small_small_hr management commands."""
+from datetime import datetime
+from io import StringIO
+
+from django.conf import settings
+from django.core.management import CommandError, call_command
+from django.test import TestCase, override_settings
+
+import pytz
+from model_mommy import mommy
+
+from small_small_hr.models import (
+    AnnualLeave,
+    FreeDay,
+    Leave,
+    MonthlyLeaveBalance,
+    StaffProfile,
+)
+
+
+class TestCommands(TestCase):
+    """Test class for management commands."""
+
+    @override_settings(
+        SSHR_DAY_LEAVE_VALUES={
+            1: 1,  # Monday
+            2: 1,  # Tuesday
+            3: 1,  # Wednesday
+            4: 1,  # Thursday
+            5: 1,  # Friday
+            6: 0,  # Saturday
+            7: 0,  # Sunday
+        }
+    )
+    def test_update_leave_day_counts(self):
+        """Test update_leave_day_counts."""
+        staff = mommy.make("small_small_hr.StaffProfile")
+        tzinfo = pytz.timezone(settings.TIME_ZONE)
+        leave_2017 = mommy.make(
+            "small_small_hr.Leave",
+            staff=staff,
+            start=tzinfo.localize(datetime(2017, 6, 5, 7)),
+            end=tzinfo.localize(datetime(2017, 6, 16, 7)),
+        )
+        leave_2018 = mommy.make(
+            "small_small_hr.Leave",
+            staff=staff,
+            start=tzinfo.localize(datetime(2018, 6, 4, 7)),
+            end=tzinfo.localize(datetime(2018, 6, 8, 7)),
+        )
+        Leave.objects.update(day_count=0)
+
+        out = StringIO()
+        call_command("update_leave_day_counts", "--year", "2017", stdout=out)
+        self.assertIn("Updated 1 leave objects.", out.getvalue())
+        leave_2017.refresh_from_db()
+        leave_2018.refresh_from_db()
+        self.assertEqual(10, leave_2017.day_count)
+        self.assertEqual(0, leave_2018.day_count)
+
+        call_command("update_leave_day_counts", stdout=out)
+        self.assertIn("Updated 1 leave objects.", out.getvalue())
+        leave_2018.refresh_from_db()
+        self.assertEqual(5, leave_2018.day_count)
+
+    def test_reconcile_taken_days(self):
+        """Test reconcile_taken_days."""
+        staff = mommy.make("small_small_hr.StaffProfile")
+        tzinfo = pytz.timezone(settings.TIME_ZONE)
+        mommy.make(
+            "small_small_hr.AnnualLeave", staff=staff, year=2017, leave_type=Leave.REGULAR
+        )
+        mommy.make(
+            "small_small_hr.AnnualLeave", staff=staff, year=2018, leave_type=Leave.REGULAR
+        )
+        mommy.make(
+            "small_small_hr.Leave",
+            staff=staff,
+            start=tzinfo.localize(datetime(2017, 6, 5, 7)),
+            end=tzinfo.localize(datetime(2017, 6, 9, 7)),
+            leave_type=Leave.REGULAR,
+            review_status=Leave.APPROVED,
+        )
+        AnnualLeave.objects.update(taken_days=2)
+
+        out = StringIO()
+        call_command("reconcile_taken_days", "--year", "2017", stdout=out)
+        self.assertIn("the counter is 2.00 but 5.00 days were taken.", out.getvalue())
+        self.assertIn("Found 1 wrong counters.", out.getvalue())
+
+        out = StringIO()
+        call_command("reconcile_taken_days", "--fix", stdout=out)
+        self.assertIn("Fixed 2 counters.", out.getvalue())
+        self.assertEqual(
+            [(2017, 5), (2018, 0)],
+            list(AnnualLeave.objects.order_by("year").values_list("year", "taken_days")),
+        )
+
+    def test_rollover_annual_leave(self):
+        """Test rollover_annual_leave."""
+        users = mommy.make("auth.User", is_active=True, _quantity=3)
+        StaffProfile.objects.all().delete()
+        for user in users:
+            mommy.make("small_small_hr.StaffProfile", user=user)
+
+        out = StringIO()
+        call_command(
+            "rollover_annual_leave", "--year", "2018", "--batch-size", "2", stdout=out
+        )
+        self.assertIn("Processed 2 of 3 staff members.", out.getvalue())
+        self.assertIn("Processed 3 of 3 staff members.", out.getvalue())
+        self.assertIn("Created 6 annual leave objects for 2018.", out.getvalue())
+        self.assertEqual(6, AnnualLeave.objects.filter(year=2018).count())
+
+    def test_recompute_carry_over(self):
+        """Test recompute_carry_over."""
+        staff = mommy.make("small_small_hr.StaffProfile")
+        for year, carried_over_days in [(2017, 0), (2018, 1), (2019, 2)]:
+            mommy.make(
+                "small_small_hr.AnnualLeave",
+                staff=staff,
+                year=year,
+                leave_type=Leave.REGULAR,
+                allowed_days=21,
+                carried_over_days=carried_over_days,
+            )
+
+        out = StringIO()
+        call_command("recompute_carry_over", "--from-year", "2019", stdout=out)
+        self.assertIn("Updated 1 annual leave objects.", out.getvalue())
+        call_command("recompute_carry_over", stdout=out)
+        self.assertIn("Updated 1 annual leave objects.", out.getvalue())
+        self.assertEqual(
+            [0, settings.SSHR_MAX_CARRY_OVER, settings.SSHR_MAX_CARRY_OVER],
+            list(
+                AnnualLeave.objects.order_by("year").values_list(
+                    "carried_over_days", flat=True
+                )
+            ),
+        )
+
+    def test_create_monthly_leave_balances(self):
+        """Test create_monthly_leave_balances."""
+        staff = mommy.make("small_small_hr.StaffProfile")
+        mommy.make(
+            "small_small_hr.AnnualLeave",
+            staff=staff,
+            year=2018,
+            leave_type=Leave.REGULAR,
+            allowed_days=12,
+        )
+
+        out = StringIO()
+        call_command("create_monthly_leave_balances", "--year", "2018", stdout=out)
+        self.assertIn("Processed 1 of 1 staff members.", out.getvalue())
+        self.assertIn(
+            "Created 12 monthly leave balance objects for 2018.", out.getvalue()
+        )
+        self.assertEqual(12, MonthlyLeaveBalance.objects.filter(staff=staff).count())
+
+    def test_create_free_days(self):
+        """Test create_free_days."""
+        out = StringIO()
+        call_command(
+            "create_free_days", "--start-year", "2017", "--years", "30", stdout=out
+        )
+        self.assertIn(
+            f"Created {30 * len(settings.SSHR_FREE_DAYS)} free days.", out.getvalue()
+        )
+        call_command(
+            "create_free_days", "--start-year", "2017", "--years", "31", stdout=out
+        )
+        self.assertIn(
+            f"Created {len(settings.SSHR_FREE_DAYS)} free days.", out.getvalue()
+        )
+        self.assertEqual(31 * len(settings.SSHR_FREE_DAYS), FreeDay.objects.count())
+
+        # free days of a holiday calendar
+        calendar = mommy.make("small_small_hr.HolidayCalendar", name="Kenya")
+        out = StringIO()
+        call_command(
+            "create_free_days", "--start-year", "2017", "--calendar", "Kenya", stdout=out
+        )
+        self.assertIn(
+            f"Created {11 * len(settings.SSHR_FREE_DAYS)} free days.", out.getvalue()
+        )
+        self.assertEqual(
+            11 * len(settings.SSHR_FREE_DAYS),
+            FreeDay.objects.filter(calendar=calendar).count(),
+        )
+        with self.assertRaises(CommandError):
+            call_command("create_free_days", "--calendar", "Uganda", stdout=out)
@@ -0,0 +1,106 @@
+"""Module to test small_small_hr engines."""
+from datetime import date, datetime, time
+from decimal import Decimal
+from unittest import skipIf
+
+from django.conf import settings
+from django.test import TestCase, override_settings
+
+import pytz
+from model_mommy import mommy
+
+from small_small_hr.engines import numpy, numpy_leave_day_counts, sql_taken_leave_days
+from small_small_hr.models import Leave, get_leave_day_counts, get_taken_leave_days
+
+INTERVALS = [
+    (date(2017, 6, 5), date(2017, 6, 16)),
+    (date(2017, 6, 16), date(2017, 6, 16)),
+    (date(2017, 12, 29), date(2018, 1, 6)),
+    (date(2017, 6, 10), date(2017, 6, 5)),
+]
+
+
+class TestEngines(TestCase):
+    """Test class for leave day counting engines."""
+
+    @skipIf(numpy is None, "numpy is not installed")
+    def test_numpy_leave_day_counts(self):
+        """Test numpy_leave_day_counts gives the same results as the Python engine."""
+        mommy.make("small_small_hr.FreeDay", date=date(2017, 6, 15))
+        mommy.make("small_small_hr.FreeDay", date=date(2018, 1, 1))
+        free_days = frozenset([date(2017, 6, 15), date(2018, 1, 1)])
+        for day_values in [
+            {1: 1, 2: 1, 3: 1, 4: 1, 5: 1, 6: 0, 7: 0},
+            {1: 1, 2: 1, 3: 1, 4: 1, 5: 1, 6: 0.5, 7: 0},
+            {1: 0, 2: 0, 3: 0, 4: 0, 5: 0, 6: 0, 7: 0},
+        ]:
+            with override_settings(SSHR_DAY_LEAVE_VALUES=day_values):
+                self.assertEqual(
+                    get_leave_day_counts(INTERVALS),
+                    numpy_leave_day_counts(INTERVALS, free_days, day_values),
+                )
+
+        self.assertEqual(
+            [Decimal("9.5"), Decimal(1), Decimal(6), Decimal(0)],
+            numpy_leave_day_counts(
+                INTERVALS, free_days, {1: 1, 2: 1, 3: 1, 4: 1, 5: 1, 6: 0.5, 7: 0}
+            ),
+        )
+        self.assertEqual([], numpy_leave_day_counts([], free_days, {}))
+
+    @skipIf(numpy is None, "numpy is not installed")
+    @override_settings(SSHR_LEAVE_DAY_ENGINE="numpy")
+    def test_get_leave_day_counts_numpy(self):
+        """Test get_leave_day_counts with the numpy engine."""
+        mommy.make("small_small_hr.FreeDay", date=date(2017, 6, 15))
+        self.assertEqual(
+            [Decimal(9), Decimal(1), Decimal(6), Decimal(0)],
+            get_leave_day_counts(INTERVALS),
+        )
+
+    @override_settings(
+        SSHR_DAY_LEAVE_VALUES={
+            1: 1,  # Monday
+            2: 1,  # Tuesday
+            3: 1,  # Wednesday
+            4: 1,  # Thursday
+            5: 1,  # Friday
+            6: 0.5,  # Saturday
+            7: 0,  # Sunday
+        }
+    )
+    def test_sql_taken_leave_days(self):
+        """Test sql_taken_leave_days gives the same results as the Python engine."""
+        staff = mommy.make("small_small_hr.StaffProfile")
+        mommy.make("small_small_hr.FreeDay", date=date(2017, 6, 15))
+        mommy.make("small_small_hr.FreeDay", date=date(2018, 1, 1))
+        tzinfo = pytz.timezone(settings.TIME_ZONE)
+        for start, end, review_status in [
+            (date(2017, 6, 5), date(2017, 6, 16), Leave.APPROVED),
+            (date(2017, 12, 29), date(2018, 1, 6), Leave.APPROVED),
+            (date(2017, 3, 1), date(2017, 3, 10), Leave.REJECTED),
+        ]:
+            mommy.make(
+                "small_small_hr.Leave",
+                staff=staff,
+                start=tzinfo.localize(datetime.combine(start, time(7))),
+                end=tzinfo.localize(datetime.combine(end, time(7))),
+                leave_type=Leave.REGULAR,
+                review_status=review_status,
+            )
+
+        for start_year, end_year, expected in [
+            (2017, 2017, Decimal("11")),
+            (2018, 2018, Decimal("4.5")),
+            (2017, 2018, Decimal("15.5")),
+            (2019, 2019, Decimal(0)),
+        ]:
+            kwargs = dict(
+                staffprofile=staff,
+                status=Leave.APPROVED,
+                leave_type=Leave.REGULAR,
+                start_year=start_year,
+                end_year=end_year,
+            )
+            self.assertEqual(expected, sql_taken_leave_days(**kwargs))
+            self.assertEqual(expected, get_taken_leave_days(**kwargs))
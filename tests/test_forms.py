@@ -6,7 +6,9 @@ from datetime import date, datetime, timedelta
 from django.conf import settings
 from django.contrib.auth.models import AnonymousUser
 from django.contrib.contenttypes.models import ContentType
+from django.core.exceptions import ValidationError
 from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db import IntegrityError, transaction
 from django.test import RequestFactory, TestCase, override_settings
 
 import pytz
@@ -20,6 +22,7 @@ from small_small_hr.forms import (
     ApplyOverTimeForm,
     FreeDayForm,
     LeaveForm,
+    LeaveFormSet,
     OverTimeForm,
     RoleForm,
     StaffDocumentForm,
@@ -30,6 +33,7 @@ from small_small_hr.forms import (
 )
 from small_small_hr.models import Leave, OverTime, StaffProfile, get_taken_leave_days
 from small_small_hr.serializers import StaffProfileSerializer
+from small_small_hr.utils import approve_leave
 
 BASE_DIR = os.path.dirname(os.path.dirname(__file__))
 
@@ -176,6 +180,18 @@ class TestForms(TestCase):  # pylint: disable=too-many-public-methods
             "Free Day with this Date already exists.", form2.errors["date"][0]
         )
 
+        # but only within its calendar
+        calendar = mommy.make("small_small_hr.HolidayCalendar", name="Kenya")
+        form3 = FreeDayForm(data=dict(data, calendar=calendar.id))
+        self.assertTrue(form3.is_valid())
+        self.assertEqual(calendar, form3.save().calendar)
+        form4 = FreeDayForm(data=dict(data, calendar=calendar.id))
+        self.assertFalse(form4.is_valid())
+        self.assertEqual(
+            ["Free Day with this Holiday Calendar and Date already exists."],
+            form4.errors["__all__"],
+        )
+
     def test_overtime_form_apply(self):
         """Test OverTimeForm."""
         user = mommy.make("auth.User", first_name="Bob", last_name="Ndoe")
@@ -336,6 +352,51 @@ class TestForms(TestCase):  # pylint: disable=too-many-public-methods
         self.assertEqual("Extra work", overtime.review_reason)
         self.assertEqual(OverTime.REJECTED, overtime.review_status)
 
+    def test_overtime_form_approve_with_overlap(self):
+        """Test OverTimeForm cannot approve overlapping overtime."""
+        user = mommy.make("auth.User", first_name="Bob", last_name="Ndoe")
+        staffprofile = mommy.make("small_small_hr.StaffProfile", user=user)
+
+        data = {
+            "staff": staffprofile.id,
+            "date": date(2017, 6, 5),
+            "start": datetime(2017, 6, 5, 19, 0).time(),
+            "end": datetime(2017, 6, 5, 21, 0).time(),
+            "review_reason": "Extra work",
+            "review_status": OverTime.APPROVED,
+        }
+
+        form = OverTimeForm(data=data)
+        self.assertTrue(form.is_valid())
+        # overlapping overtime approved after the form was validated
+        mommy.make(
+            "small_small_hr.OverTime",
+            start=datetime(2017, 6, 5, 18, 0).time(),
+            end=datetime(2017, 6, 5, 20, 0).time(),
+            review_status=OverTime.APPROVED,
+            date=date(2017, 6, 5),
+            staff=staffprofile,
+        )
+        # is caught by the database when saving
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            form.save()
+        self.assertEqual(1, OverTime.objects.filter(staff=staffprofile).count())
+
+        # otherwise it is caught when validating
+        form = OverTimeForm(data=data)
+        self.assertFalse(form.is_valid())
+        self.assertEqual(
+            "you cannot have overlapping overtime hours on the same day",
+            form.errors["start"][0],
+        )
+
+        # overtime that follows on is fine
+        data["start"] = datetime(2017, 6, 5, 20, 0).time()
+        form = OverTimeForm(data=data)
+        self.assertTrue(form.is_valid())
+        form.save()
+        self.assertEqual(2, OverTime.objects.filter(staff=staffprofile).count())
+
     def test_overtime_form_start_end(self):
         """Test OverTimeForm start end fields."""
         user = mommy.make("auth.User", first_name="Bob", last_name="Ndoe")
@@ -780,6 +841,101 @@ class TestForms(TestCase):  # pylint: disable=too-many-public-methods
         self.assertEqual("Need a break", leave.review_reason)
         self.assertEqual(Leave.REJECTED, leave.review_status)
 
+    @override_settings(SSHR_DEFAULT_TIME=7)
+    def test_leaveform_approve_with_overlap(self):
+        """Test LeaveForm cannot approve overlapping leave."""
+        user = mommy.make("auth.User", first_name="Bob", last_name="Ndoe")
+        staffprofile = mommy.make("small_small_hr.StaffProfile", user=user)
+        staffprofile.leave_days = 21
+        staffprofile.sick_days = 10
+        staffprofile.save()
+
+        mommy.make(
+            "small_small_hr.AnnualLeave",
+            staff=staffprofile,
+            year=2017,
+            leave_type=Leave.REGULAR,
+            carried_over_days=4,
+        )
+        data = {
+            "staff": staffprofile.id,
+            "leave_type": Leave.REGULAR,
+            "start": date(2017, 6, 8),
+            "end": date(2017, 6, 14),
+            "review_reason": "Need a break",
+            "review_status": Leave.APPROVED,
+        }
+
+        form = LeaveForm(data=data)
+        self.assertTrue(form.is_valid())
+        # overlapping leave approved after the form was validated
+        mommy.make(
+            "small_small_hr.Leave",
+            staff=staffprofile,
+            start=datetime(2017, 6, 5, 7, 0, 0, tzinfo=pytz.timezone(settings.TIME_ZONE)),
+            end=datetime(2017, 6, 10, 7, 0, 0, tzinfo=pytz.timezone(settings.TIME_ZONE)),
+            leave_type=Leave.REGULAR,
+            review_status=Leave.APPROVED,
+        )
+        # is caught by the database when saving
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            form.save()
+        self.assertEqual(1, Leave.objects.filter(staff=staffprofile).count())
+
+        # otherwise approved and pending applications that partly overlap are
+        # caught when validating
+        for review_status in (Leave.APPROVED, Leave.PENDING):
+            data["review_status"] = review_status
+            form = LeaveForm(data=data)
+            self.assertFalse(form.is_valid())
+            self.assertEqual(
+                "you cannot have overlapping leave days", form.errors["start"][0]
+            )
+
+    @override_settings(SSHR_ALLOW_OVERSUBSCRIBE=False)
+    def test_leaveform_approve_balance_spent(self):
+        """Test leave saved by LeaveForm is approved against the locked balance."""
+        user = mommy.make("auth.User", first_name="Bob", last_name="Ndoe")
+        staffprofile = mommy.make("small_small_hr.StaffProfile", user=user)
+        mommy.make(
+            "small_small_hr.AnnualLeave",
+            staff=staffprofile,
+            year=2017,
+            leave_type=Leave.REGULAR,
+            allowed_days=7,
+            carried_over_days=0,
+        )
+
+        # 2 days of leave, saved as pending
+        data = {
+            "staff": staffprofile.id,
+            "leave_type": Leave.REGULAR,
+            "start": date(2017, 6, 12),
+            "end": date(2017, 6, 13),
+            "review_reason": "Need a break",
+            "review_status": Leave.PENDING,
+        }
+        form = LeaveForm(data=data)
+        self.assertTrue(form.is_valid())
+        leave_obj = form.save()
+        # most of the days are taken after the form was validated
+        mommy.make(
+            "small_small_hr.Leave",
+            staff=staffprofile,
+            start=datetime(2017, 6, 2, 7, tzinfo=pytz.timezone(settings.TIME_ZONE)),
+            end=datetime(2017, 6, 9, 7, tzinfo=pytz.timezone(settings.TIME_ZONE)),
+            leave_type=Leave.REGULAR,
+            review_status=Leave.APPROVED,
+        )
+        with self.assertRaises(ValidationError) as context:
+            approve_leave(leave_obj)
+        self.assertEqual(
+            "Not enough leave days. Available leave days are 1.00",
+            context.exception.message,
+        )
+        leave_obj.refresh_from_db()
+        self.assertEqual(Leave.PENDING, leave_obj.review_status)
+
     @override_settings(SSHR_DEFAULT_TIME=7)
     def test_sickleave_apply(self):
         """Test LeaveForm apply for sick leave."""
@@ -1018,6 +1174,63 @@ class TestForms(TestCase):  # pylint: disable=too-many-public-methods
             "Not enough sick days. Available sick days are 10.00", form.errors["end"][0]
         )
 
+    @override_settings(SSHR_ALLOW_OVERSUBSCRIBE=False)
+    def test_leave_formset(self):
+        """Test that LeaveFormSet validates the leave of all its forms together."""
+        user = mommy.make("auth.User", first_name="Bob", last_name="Ndoe")
+        staffprofile = mommy.make("small_small_hr.StaffProfile", user=user)
+        mommy.make(
+            "small_small_hr.AnnualLeave",
+            staff=staffprofile,
+            year=2017,
+            leave_type=Leave.REGULAR,
+            allowed_days=8,
+            carried_over_days=0,
+        )
+        data = {
+            "form-TOTAL_FORMS": "2",
+            "form-INITIAL_FORMS": "0",
+            "form-MIN_NUM_FORMS": "0",
+            "form-MAX_NUM_FORMS": "1000",
+        }
+        # 5 working days each
+        for index, (start, end) in enumerate(
+            [("6/5/2017", "6/9/2017"), ("6/12/2017", "6/16/2017")]
+        ):
+            data.update(
+                {
+                    f"form-{index}-staff": staffprofile.id,
+                    f"form-{index}-leave_type": Leave.REGULAR,
+                    f"form-{index}-start": start,
+                    f"form-{index}-end": end,
+                    f"form-{index}-review_reason": "Need a break",
+                    f"form-{index}-review_status": Leave.PENDING,
+                }
+            )
+
+        # each form on its own is valid
+        for index in range(2):
+            form = LeaveForm(data=data, prefix=f"form-{index}")
+            self.assertTrue(form.is_valid())
+
+        formset = LeaveFormSet(data=data, queryset=Leave.objects.none())
+        self.assertFalse(formset.is_valid())
+        self.assertEqual({}, formset.forms[0].errors)
+        self.assertEqual(
+            "Not enough leave days. Available leave days are 3.00",
+            formset.forms[1].errors["start"][0],
+        )
+        self.assertEqual(
+            "Not enough leave days. Available leave days are 3.00",
+            formset.forms[1].errors["end"][0],
+        )
+
+        data["form-1-end"] = "6/14/2017"
+        formset = LeaveFormSet(data=data, queryset=Leave.objects.none())
+        self.assertTrue(formset.is_valid())
+        leave_objs = formset.save()
+        self.assertEqual([5, 3], [_.day_count for _ in leave_objs])
+
     @override_settings(PRIVATE_STORAGE_ROOT="/tmp/")
     def test_staffdocumentform(self):
         """Test StaffDocumentForm."""
@@ -2,13 +2,30 @@
 from datetime import date, datetime, timedelta
 
 from django.conf import settings
+from django.contrib.contenttypes.models import ContentType
+from django.db import IntegrityError, transaction
 from django.test import TestCase, override_settings
 from django.utils import timezone
 
 import pytz
 from model_mommy import mommy
-
-from small_small_hr.models import FreeDay, Leave, get_taken_leave_days
+from model_reviews.models import ModelReview
+
+from small_small_hr.calendars import free_day_calendar
+from small_small_hr.counters import (
+    reconcile_taken_days,
+    save_monthly_leave_balances,
+    update_leave_day_counts,
+)
+from small_small_hr.models import (
+    AnnualLeave,
+    FreeDay,
+    Leave,
+    MonthlyLeaveBalance,
+    OverTime,
+    StaffProfile,
+    get_taken_leave_days,
+)
 from small_small_hr.utils import create_free_days
 
 # pylint: disable=hard-coded-auth-user
@@ -390,6 +407,76 @@ class TestModels(TestCase):
         # remaining should be 21 - 10
         self.assertEqual(21 - 10, staff.get_available_leave_days(year=2017))
 
+    @override_settings(
+        SSHR_DAY_LEAVE_VALUES={
+            1: 1,  # Monday
+            2: 1,  # Tuesday
+            3: 1,  # Wednesday
+            4: 1,  # Thursday
+            5: 1,  # Friday
+            6: 0,  # Saturday
+            7: 0,  # Sunday
+        }
+    )
+    def test_staffprofile_get_leave_summary(self):
+        """Test StaffProfile get_leave_summary."""
+        tzinfo = pytz.timezone(settings.TIME_ZONE)
+        staff = mommy.make("small_small_hr.StaffProfile")
+        for leave_type, allowed_days in [(Leave.REGULAR, 21), (Leave.SICK, 10)]:
+            mommy.make(
+                "small_small_hr.AnnualLeave",
+                staff=staff,
+                year=2017,
+                leave_type=leave_type,
+                allowed_days=allowed_days,
+                carried_over_days=0,
+            )
+        for start, end, leave_type in [
+            (datetime(2017, 6, 5, 7), datetime(2017, 6, 16, 7), Leave.REGULAR),
+            (datetime(2017, 12, 27, 7), datetime(2018, 1, 3, 7), Leave.REGULAR),
+            (datetime(2017, 3, 1, 7), datetime(2017, 3, 2, 7), Leave.SICK),
+        ]:
+            mommy.make(
+                "small_small_hr.Leave",
+                staff=staff,
+                start=tzinfo.localize(start),
+                end=tzinfo.localize(end),
+                leave_type=leave_type,
+                review_status=Leave.APPROVED,
+            )
+        # load the free days
+        staff.get_leave_summary(year=2017)
+
+        with self.assertNumQueries(2):
+            summary = staff.get_leave_summary(year=2017)
+        self.assertEqual(
+            {
+                "approved_leave_days": 13,
+                "approved_sick_days": 2,
+                "available_leave_days": 21 - 13,
+                "available_sick_days": 10 - 2,
+            },
+            summary,
+        )
+        self.assertEqual(
+            {
+                "approved_leave_days": staff.get_approved_leave_days(year=2017),
+                "approved_sick_days": staff.get_approved_sick_days(year=2017),
+                "available_leave_days": staff.get_available_leave_days(year=2017),
+                "available_sick_days": staff.get_available_sick_days(year=2017),
+            },
+            summary,
+        )
+        self.assertEqual(
+            {
+                "approved_leave_days": 3,
+                "approved_sick_days": 0,
+                "available_leave_days": 0,
+                "available_sick_days": 0,
+            },
+            staff.get_leave_summary(year=2018),
+        )
+
     @override_settings(
         SSHR_DAY_LEAVE_VALUES={
             1: 1,  # Monday
@@ -620,3 +707,467 @@ class TestModels(TestCase):
         )
 
         self.assertEqual(10.5, leave_days)
+
+    @override_settings(
+        SSHR_DAY_LEAVE_VALUES={
+            1: 1,  # Monday
+            2: 1,  # Tuesday
+            3: 1,  # Wednesday
+            4: 1,  # Thursday
+            5: 1,  # Friday
+            6: 0,  # Saturday
+            7: 0,  # Sunday
+        }
+    )
+    def test_leave_day_count_updates(self):
+        """Test that the stored leave day_count is kept up to date."""
+        user = mommy.make("auth.User", first_name="Mosh", last_name="Pitt")
+        staff = mommy.make("small_small_hr.StaffProfile", user=user)
+        start = datetime(2017, 6, 5, 7, 0, 0, tzinfo=pytz.timezone(settings.TIME_ZONE))
+        end = datetime(2017, 6, 16, 7, 0, 0, tzinfo=pytz.timezone(settings.TIME_ZONE))
+        leave_obj = mommy.make(
+            "small_small_hr.Leave",
+            staff=staff,
+            start=start,
+            end=end,
+            leave_type=Leave.REGULAR,
+            review_status=Leave.APPROVED,
+        )
+        leave_obj.refresh_from_db()
+        self.assertEqual(10, leave_obj.day_count)
+
+        # adding, moving and removing a free day updates the day count
+        free_day = mommy.make("small_small_hr.FreeDay", date=date(2017, 6, 15))
+        leave_obj.refresh_from_db()
+        self.assertEqual(9, leave_obj.day_count)
+        free_day.date = date(2017, 6, 17)
+        free_day.save()
+        leave_obj.refresh_from_db()
+        self.assertEqual(10, leave_obj.day_count)
+        free_day.date = date(2017, 6, 16)
+        free_day.save()
+        leave_obj.refresh_from_db()
+        self.assertEqual(9, leave_obj.day_count)
+        free_day.delete()
+        leave_obj.refresh_from_db()
+        self.assertEqual(10, leave_obj.day_count)
+
+        # changing the leave dates updates the day count
+        leave_obj.end = end - timedelta(days=1)
+        leave_obj.save(update_fields=["end"])
+        leave_obj.refresh_from_db()
+        self.assertEqual(9, leave_obj.day_count)
+
+        # bulk changes need update_leave_day_counts
+        FreeDay.objects.bulk_create([FreeDay(name="Bulk", date=date(2017, 6, 5))])
+        free_day_calendar.invalidate()
+        self.assertEqual(1, update_leave_day_counts())
+        self.assertEqual(0, update_leave_day_counts())
+        leave_obj.refresh_from_db()
+        self.assertEqual(8, leave_obj.day_count)
+
+    def test_holiday_calendar_leave(self):
+        """Test that leave is counted using the staff member's HolidayCalendar."""
+        tzinfo = pytz.timezone(settings.TIME_ZONE)
+        kenya = mommy.make("small_small_hr.HolidayCalendar", name="Kenya")
+        uganda = mommy.make("small_small_hr.HolidayCalendar", name="Uganda")
+        mommy.make("small_small_hr.FreeDay", date=date(2017, 6, 1), calendar=kenya)
+        leave_objs = {}
+        for calendar in [None, kenya, uganda]:
+            staff = mommy.make("small_small_hr.StaffProfile", calendar=calendar)
+            mommy.make(
+                "small_small_hr.AnnualLeave",
+                staff=staff,
+                year=2017,
+                leave_type=Leave.REGULAR,
+                allowed_days=21,
+            )
+            leave_objs[calendar] = mommy.make(
+                "small_small_hr.Leave",
+                staff=staff,
+                start=tzinfo.localize(datetime(2017, 5, 29, 7)),
+                end=tzinfo.localize(datetime(2017, 6, 2, 7)),
+                leave_type=Leave.REGULAR,
+                review_status=Leave.APPROVED,
+            )
+
+        def get_day_counts():
+            return [
+                Leave.objects.get(pk=leave_objs[_].pk).day_count
+                for _ in [None, kenya, uganda]
+            ]
+
+        self.assertEqual([5, 4, 5], get_day_counts())
+        self.assertEqual(4, leave_objs[kenya].staff.get_approved_leave_days(2017))
+
+        # free days only change the leave of staff members in their calendar
+        free_day = mommy.make(
+            "small_small_hr.FreeDay", date=date(2017, 5, 31), calendar=uganda
+        )
+        self.assertEqual([5, 4, 4], get_day_counts())
+        free_day.calendar = None
+        free_day.save()
+        self.assertEqual([4, 4, 5], get_day_counts())
+
+        # moving a staff member to another calendar updates their leave
+        staff = leave_objs[uganda].staff
+        staff.calendar = kenya
+        staff.save()
+        self.assertEqual([4, 4, 4], get_day_counts())
+        annual_leave = AnnualLeave.objects.get(staff=staff, year=2017)
+        self.assertEqual(4, annual_leave.taken_days)
+        self.assertEqual(4, staff.get_approved_leave_days(2017))
+        self.assertEqual(
+            4,
+            get_taken_leave_days(
+                staff.pk,
+                status=Leave.APPROVED,
+                leave_type=Leave.REGULAR,
+                start_year=2017,
+                end_year=2017,
+            ),
+        )
+
+    def test_annual_leave_with_balances(self):
+        """Test AnnualLeave.objects.with_balances."""
+        tzinfo = pytz.timezone(settings.TIME_ZONE)
+        users = mommy.make("auth.User", _quantity=2)
+        StaffProfile.objects.all().delete()
+        staff = mommy.make("small_small_hr.StaffProfile", user=users[0])
+        other = mommy.make("small_small_hr.StaffProfile", user=users[1])
+        mommy.make("small_small_hr.FreeDay", date=date(2017, 6, 15))
+        mommy.make("small_small_hr.FreeDay", date=date(2018, 1, 1))
+        for start, end, review_status in [
+            (datetime(2017, 6, 5, 7), datetime(2017, 6, 16, 7), Leave.APPROVED),
+            (datetime(2017, 12, 27, 7), datetime(2018, 1, 5, 7), Leave.APPROVED),
+            (datetime(2017, 7, 3, 7), datetime(2017, 7, 7, 7), Leave.REJECTED),
+        ]:
+            mommy.make(
+                "small_small_hr.Leave",
+                staff=staff,
+                start=tzinfo.localize(start),
+                end=tzinfo.localize(end),
+                leave_type=Leave.REGULAR,
+                review_status=review_status,
+            )
+        for the_staff in [staff, other]:
+            for year in [2017, 2018]:
+                mommy.make(
+                    "small_small_hr.AnnualLeave",
+                    staff=the_staff,
+                    year=year,
+                    leave_type=Leave.REGULAR,
+                    allowed_days=21,
+                    carried_over_days=year - 2015,
+                )
+
+        with self.assertNumQueries(1):
+            annual_leaves = list(AnnualLeave.objects.with_balances(month=6))
+        self.assertEqual(4, len(annual_leaves))
+        for annual_leave in annual_leaves:
+            self.assertEqual(
+                annual_leave.get_cumulative_leave_taken(), annual_leave.taken_days
+            )
+            self.assertEqual(
+                annual_leave.get_earned_leave_days(month=6), annual_leave.earned_days
+            )
+            self.assertEqual(
+                annual_leave.get_available_leave_days(month=6),
+                annual_leave.available_days,
+            )
+
+        balances = AnnualLeave.objects.with_balances().filter(staff=staff)
+        # 9 days in June and 3 days in December 2017, 4 days in January 2018
+        self.assertEqual(
+            {2017: (12, 21 + 2 - 12), 2018: (4, 21 + 3 - 4)},
+            {_.year: (_.taken_days, _.available_days) for _ in balances},
+        )
+
+    def test_annual_leave_taken_days(self):
+        """Test that AnnualLeave.taken_days is kept up to date."""
+        tzinfo = pytz.timezone(settings.TIME_ZONE)
+        staff = mommy.make("small_small_hr.StaffProfile")
+        mommy.make("small_small_hr.FreeDay", date=date(2018, 1, 1))
+        annual_leave_2017 = mommy.make(
+            "small_small_hr.AnnualLeave",
+            staff=staff,
+            year=2017,
+            leave_type=Leave.REGULAR,
+        )
+        leave_obj = mommy.make(
+            "small_small_hr.Leave",
+            staff=staff,
+            start=tzinfo.localize(datetime(2017, 6, 5, 7)),
+            end=tzinfo.localize(datetime(2017, 6, 9, 7)),
+            leave_type=Leave.REGULAR,
+            review_status=Leave.PENDING,
+        )
+        annual_leave_2017.refresh_from_db()
+        self.assertEqual(0, annual_leave_2017.taken_days)
+
+        # approving leave adds its days
+        review = ModelReview.objects.get(
+            content_type=ContentType.objects.get_for_model(leave_obj),
+            object_id=leave_obj.pk,
+        )
+        review.review_status = ModelReview.APPROVED
+        review.save()
+        leave_obj.refresh_from_db()
+        annual_leave_2017.refresh_from_db()
+        self.assertEqual(5, annual_leave_2017.taken_days)
+
+        # leave that spans two years is split between them
+        leave_obj.start = tzinfo.localize(datetime(2017, 12, 27, 7))
+        leave_obj.end = tzinfo.localize(datetime(2018, 1, 3, 7))
+        leave_obj.save()
+        annual_leave_2017.refresh_from_db()
+        self.assertEqual(3, annual_leave_2017.taken_days)
+        # the counter starts from the leave history
+        annual_leave_2018 = mommy.make(
+            "small_small_hr.AnnualLeave",
+            staff=staff,
+            year=2018,
+            leave_type=Leave.REGULAR,
+        )
+        self.assertEqual(2, annual_leave_2018.taken_days)
+        self.assertEqual(21 - 2, annual_leave_2018.get_available_leave_days())
+
+        # leave that is no longer approved or is deleted is removed
+        leave_obj.review_status = Leave.REJECTED
+        leave_obj.save()
+        annual_leave_2017.refresh_from_db()
+        self.assertEqual(0, annual_leave_2017.taken_days)
+        leave_obj.review_status = Leave.APPROVED
+        leave_obj.save()
+        leave_obj.delete()
+        annual_leave_2018.refresh_from_db()
+        self.assertEqual(0, annual_leave_2018.taken_days)
+
+    def test_annual_leave_save_keeps_taken_days(self):
+        """Test that saving AnnualLeave does not overwrite taken_days."""
+        staff = mommy.make("small_small_hr.StaffProfile")
+        annual_leave = mommy.make(
+            "small_small_hr.AnnualLeave",
+            staff=staff,
+            year=2017,
+            leave_type=Leave.REGULAR,
+            allowed_days=21,
+        )
+        self.assertEqual(0, annual_leave.taken_days)
+
+        # leave approved after the object was loaded is not lost
+        AnnualLeave.objects.filter(pk=annual_leave.pk).update(taken_days=5)
+        annual_leave.allowed_days = 22
+        annual_leave.save()
+        annual_leave.refresh_from_db()
+        self.assertEqual(22, annual_leave.allowed_days)
+        self.assertEqual(5, annual_leave.taken_days)
+
+        annual_leave.allowed_days = 23
+        annual_leave.save(update_fields=["allowed_days"])
+        annual_leave.refresh_from_db()
+        self.assertEqual(23, annual_leave.allowed_days)
+        self.assertEqual(5, annual_leave.taken_days)
+
+        # unless taken_days is saved on purpose
+        annual_leave.taken_days = 2
+        annual_leave.save(update_fields=["taken_days"])
+        annual_leave.refresh_from_db()
+        self.assertEqual(2, annual_leave.taken_days)
+
+    def test_reconcile_taken_days(self):
+        """Test reconcile_taken_days."""
+        tzinfo = pytz.timezone(settings.TIME_ZONE)
+        staff = mommy.make("small_small_hr.StaffProfile")
+        annual_leave = mommy.make(
+            "small_small_hr.AnnualLeave",
+            staff=staff,
+            year=2017,
+            leave_type=Leave.REGULAR,
+        )
+        mommy.make(
+            "small_small_hr.Leave",
+            staff=staff,
+            start=tzinfo.localize(datetime(2017, 6, 5, 7)),
+            end=tzinfo.localize(datetime(2017, 6, 9, 7)),
+            leave_type=Leave.REGULAR,
+            review_status=Leave.APPROVED,
+        )
+        self.assertEqual([], reconcile_taken_days())
+
+        AnnualLeave.objects.update(taken_days=1)
+        wrong = reconcile_taken_days(fix=False)
+        self.assertEqual([(annual_leave, 1)], wrong)
+        self.assertEqual(5, wrong[0][0].taken_days)
+        annual_leave.refresh_from_db()
+        self.assertEqual(1, annual_leave.taken_days)
+
+        self.assertEqual(1, len(reconcile_taken_days()))
+        annual_leave.refresh_from_db()
+        self.assertEqual(5, annual_leave.taken_days)
+
+    def test_leave_local_dates(self):
+        """Test that the local start and end dates are stored on Leave."""
+        staff = mommy.make("small_small_hr.StaffProfile")
+        # Africa/Nairobi is three hours ahead of UTC
+        leave_obj = mommy.make(
+            "small_small_hr.Leave",
+            staff=staff,
+            start=datetime(2017, 6, 4, 22, 30, tzinfo=pytz.utc),
+            end=datetime(2017, 6, 9, 21, 0, tzinfo=pytz.utc),
+        )
+        self.assertEqual(date(2017, 6, 5), leave_obj.start_date)
+        self.assertEqual(date(2017, 6, 10), leave_obj.end_date)
+
+        leave_obj.end = datetime(2017, 6, 12, 20, 0, tzinfo=pytz.utc)
+        leave_obj.save(update_fields=["end"])
+        leave_obj.refresh_from_db()
+        self.assertEqual(date(2017, 6, 12), leave_obj.end_date)
+        self.assertEqual(6, leave_obj.day_count)
+
+        # the dates do not depend on the timezone of the request
+        with timezone.override(pytz.utc):
+            leave_obj.save()
+        self.assertEqual(date(2017, 6, 5), leave_obj.start_date)
+        self.assertEqual(date(2017, 6, 12), leave_obj.end_date)
+
+    def test_leave_queryset_overlapping(self):
+        """Test the overlapping, overlapping_years and within_years querysets."""
+        staff = mommy.make("small_small_hr.StaffProfile")
+        tzinfo = pytz.timezone(settings.TIME_ZONE)
+        leave_2017 = mommy.make(
+            "small_small_hr.Leave",
+            staff=staff,
+            start=tzinfo.localize(datetime(2017, 6, 5, 7)),
+            end=tzinfo.localize(datetime(2017, 6, 16, 7)),
+        )
+        leave_2017_2018 = mommy.make(
+            "small_small_hr.Leave",
+            staff=staff,
+            start=tzinfo.localize(datetime(2017, 12, 29, 7)),
+            end=tzinfo.localize(datetime(2018, 1, 1, 0)),
+        )
+
+        self.assertEqual(
+            [leave_2017],
+            list(Leave.objects.overlapping(date(2017, 6, 16), date(2017, 6, 20))),
+        )
+        self.assertEqual(
+            [], list(Leave.objects.overlapping(date(2017, 6, 17), date(2017, 6, 20)))
+        )
+        self.assertEqual(
+            {leave_2017, leave_2017_2018},
+            set(Leave.objects.overlapping_years(2017, 2017)),
+        )
+        self.assertEqual(
+            [leave_2017_2018], list(Leave.objects.overlapping_years(2018, 2018))
+        )
+        self.assertEqual([leave_2017], list(Leave.objects.within_years(2017, 2017)))
+        self.assertEqual(
+            {leave_2017, leave_2017_2018}, set(Leave.objects.within_years(2017, 2018))
+        )
+
+    def test_approved_requests_start_before_end(self):
+        """Test that approved Leave and OverTime cannot end before they start."""
+        staff = mommy.make("small_small_hr.StaffProfile")
+        tzinfo = pytz.timezone(settings.TIME_ZONE)
+        leave_obj = mommy.make(
+            "small_small_hr.Leave",
+            staff=staff,
+            start=tzinfo.localize(datetime(2017, 6, 9, 7)),
+            end=tzinfo.localize(datetime(2017, 6, 5, 7)),
+            review_status=Leave.PENDING,
+        )
+        overtime = mommy.make(
+            "small_small_hr.OverTime",
+            staff=staff,
+            date=date(2017, 6, 5),
+            start=datetime(2017, 6, 5, 21, 0).time(),
+            end=datetime(2017, 6, 5, 19, 0).time(),
+            review_status=OverTime.PENDING,
+        )
+
+        # the overlap constraints never see them
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            Leave.objects.filter(pk=leave_obj.pk).update(review_status=Leave.APPROVED)
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            OverTime.objects.filter(pk=overtime.pk).update(
+                review_status=OverTime.APPROVED
+            )
+
+    @override_settings(
+        SSHR_DAY_LEAVE_VALUES={
+            1: 1,  # Monday
+            2: 1,  # Tuesday
+            3: 1,  # Wednesday
+            4: 1,  # Thursday
+            5: 1,  # Friday
+            6: 0,  # Saturday
+            7: 0,  # Sunday
+        }
+    )
+    def test_monthly_leave_balances(self):
+        """Test that MonthlyLeaveBalance records are kept up to date."""
+        tzinfo = pytz.timezone(settings.TIME_ZONE)
+        staff = mommy.make("small_small_hr.StaffProfile")
+        annual_leave = mommy.make(
+            "small_small_hr.AnnualLeave",
+            staff=staff,
+            year=2017,
+            leave_type=Leave.REGULAR,
+            allowed_days=12,
+            carried_over_days=2,
+        )
+        leave_obj = mommy.make(
+            "small_small_hr.Leave",
+            staff=staff,
+            start=tzinfo.localize(datetime(2017, 6, 26, 7)),
+            end=tzinfo.localize(datetime(2017, 7, 7, 7)),
+            leave_type=Leave.REGULAR,
+            review_status=Leave.APPROVED,
+        )
+
+        def get_balances():
+            return [
+                (_.opening_days, _.accrued_days, _.taken_days, _.closing_days)
+                for _ in MonthlyLeaveBalance.objects.filter(
+                    staff=staff, year=2017, leave_type=Leave.REGULAR
+                ).order_by("month")
+            ]
+
+        # the records are only kept up to date once they exist
+        self.assertEqual([], get_balances())
+        self.assertEqual(
+            12, save_monthly_leave_balances([(staff.id, 2017, Leave.REGULAR)])
+        )
+        balances = get_balances()
+        self.assertEqual((2, 1, 0, 3), balances[0])
+        self.assertEqual((7, 1, 5, 3), balances[5])
+        self.assertEqual((3, 1, 5, -1), balances[6])
+        self.assertEqual((3, 1, 0, 4), balances[11])
+        annual_leave.refresh_from_db()
+        self.assertEqual(annual_leave.get_available_leave_days(), balances[11][3])
+        self.assertEqual(
+            f"2017-07: {staff.get_name()} Regular Leave",
+            str(MonthlyLeaveBalance.objects.get(staff=staff, month=7)),
+        )
+
+        leave_obj.end = tzinfo.localize(datetime(2017, 6, 30, 7))
+        leave_obj.save()
+        balances = get_balances()
+        self.assertEqual((7, 1, 5, 3), balances[5])
+        self.assertEqual((3, 1, 0, 4), balances[6])
+
+        # free days change the leave days taken
+        mommy.make("small_small_hr.FreeDay", date=date(2017, 6, 30))
+        self.assertEqual((7, 1, 4, 4), get_balances()[5])
+
+        annual_leave.carried_over_days = 0
+        annual_leave.save()
+        self.assertEqual((5, 1, 4, 2), get_balances()[5])
+
+        leave_obj.delete()
+        self.assertEqual((5, 1, 0, 6), get_balances()[5])
+
+        annual_leave.delete()
+        self.assertEqual([], get_balances())
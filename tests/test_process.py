@@ -55,6 +55,12 @@ class TestProcess(TestCase):  # pylint: disable=too-many-public-methods
         staffprofile.leave_days = 21
         staffprofile.sick_days = 10
         staffprofile.save()
+        annual_leave = mommy.make(
+            "small_small_hr.AnnualLeave",
+            staff=staffprofile,
+            year=2017,
+            leave_type=Leave.REGULAR,
+        )
 
         # apply for leave
         start = datetime(2017, 6, 5, 7, 0, 0, tzinfo=pytz.timezone(settings.TIME_ZONE))
@@ -124,6 +130,10 @@ class TestProcess(TestCase):  # pylint: disable=too-many-public-methods
         self.assertEqual(ModelReview.APPROVED, review.review_status)
         self.assertEqual(Leave.APPROVED, leave.review_status)
 
+        # the approved leave days are counted as taken
+        annual_leave.refresh_from_db()
+        self.assertEqual(5, annual_leave.taken_days)
+
         expected_calls.append(
             call(
                 name="Bob Ndoe",
@@ -1,14 +1,45 @@
 """Module to test small_small_hr Signals."""
-from datetime import datetime
+from datetime import date, datetime
+from decimal import Decimal
+from unittest.mock import patch
 
 from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.db import connection
+from django.db.models import QuerySet
 from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
 
 import pytz
 from model_mommy import mommy
 
-from small_small_hr.models import FreeDay, Leave, StaffProfile
-from small_small_hr.utils import create_annual_leave, create_free_days, get_carry_over
+from small_small_hr.calendars import free_day_calendar
+from small_small_hr.models import (
+    AnnualLeave,
+    FreeDay,
+    Leave,
+    MonthlyLeaveBalance,
+    StaffProfile,
+)
+from small_small_hr.utils import (
+    approve_leave,
+    create_annual_leave,
+    create_annual_leaves,
+    create_free_days,
+    create_monthly_leave_balances,
+    get_balance_as_of,
+    get_balances_as_of,
+    get_carry_over,
+    get_carry_over_chain,
+    get_easter,
+    get_free_day_rule_date,
+    get_free_days,
+    get_leave_balances,
+    limit_carry_over,
+    recompute_carry_over,
+    rollover_annual_leave,
+    validate_leave_applications,
+)
 
 
 class TestUtils(TestCase):
@@ -60,6 +91,11 @@ class TestUtils(TestCase):
 
         self.assertEqual(0, get_carry_over(staffprofile, 2018, Leave.SICK))
 
+        # carried over days are rounded half up to one decimal place
+        self.assertEqual(Decimal("2.3"), limit_carry_over(Decimal("2.25")))
+        self.assertEqual(Decimal("2.2"), limit_carry_over(Decimal("2.249")))
+        self.assertEqual(Decimal("10.0"), limit_carry_over(Decimal("12.25")))
+
     @override_settings(
         SSHR_DAY_LEAVE_VALUES={
             1: 1,  # Monday
@@ -112,6 +148,52 @@ class TestUtils(TestCase):
         self.assertEqual(10, obj3.allowed_days)
         self.assertEqual(Leave.SICK, obj3.leave_type)
 
+        # existing records are returned
+        self.assertEqual(obj2, create_annual_leave(staffprofile, 2017, Leave.REGULAR))
+
+        # as are records created by another request in the meantime
+        original_get = QuerySet.get
+        raised = []
+
+        def get(queryset, *args, **kwargs):
+            if queryset.model is AnnualLeave and not raised:
+                raised.append(True)
+                raise AnnualLeave.DoesNotExist
+            return original_get(queryset, *args, **kwargs)
+
+        with patch.object(QuerySet, "get", get):
+            self.assertEqual(
+                obj3, create_annual_leave(staffprofile, 2018, Leave.SICK)
+            )
+        self.assertEqual([True], raised)
+        self.assertEqual(3, AnnualLeave.objects.filter(staff=staffprofile).count())
+
+    def test_create_annual_leaves(self):
+        """Test create_annual_leaves."""
+        users = mommy.make("auth.User", _quantity=3)
+        StaffProfile.objects.all().delete()
+        staff1, staff2, staff3 = [
+            mommy.make("small_small_hr.StaffProfile", user=user, sick_days=7)
+            for user in users
+        ]
+        existing = mommy.make(
+            "small_small_hr.AnnualLeave",
+            staff=staff1,
+            year=2017,
+            leave_type=Leave.SICK,
+            allowed_days=5,
+        )
+
+        annual_leaves = create_annual_leaves(
+            StaffProfile.objects.exclude(pk=staff3.pk), 2017, Leave.SICK
+        )
+        self.assertEqual({staff1.id, staff2.id}, set(annual_leaves))
+        self.assertEqual(existing, annual_leaves[staff1.id])
+        self.assertEqual(5, annual_leaves[staff1.id].allowed_days)
+        self.assertEqual(7, annual_leaves[staff2.id].allowed_days)
+        self.assertEqual(Leave.SICK, annual_leaves[staff2.id].leave_type)
+        self.assertEqual(2, AnnualLeave.objects.count())
+
     @override_settings(
         SSHR_FREE_DAYS=[
             {"day": 1, "month": 1},  # New year
@@ -186,3 +268,801 @@ class TestUtils(TestCase):
                 date__year=2015, date__day=26, date__month=12
             ).exists()
         )
+
+        # existing free days are left alone
+        FreeDay.objects.filter(date__year=2015, date__month=12).delete()
+        self.assertEqual(3, create_free_days(start_year=2014, number_of_years=2))
+        self.assertEqual(14, FreeDay.objects.count())
+
+        # including those observed in the year after the last one
+        FreeDay.objects.all().delete()
+        rules = [{"day": 31, "month": 12, "name": "New Year's Eve", "observed": True}]
+        self.assertEqual(4, create_free_days(2022, 2, rules=rules))
+        self.assertTrue(FreeDay.objects.filter(date=date(2024, 1, 1)).exists())
+        self.assertEqual(0, create_free_days(2022, 2, rules=rules))
+
+    def test_get_free_days(self):
+        """Test get_free_days and get_easter."""
+        self.assertEqual(date(2017, 4, 16), get_easter(2017))
+        self.assertEqual(date(2024, 3, 31), get_easter(2024))
+        self.assertEqual(date(2038, 4, 25), get_easter(2038))
+
+        rules = [
+            {"day": 25, "month": 12, "name": "Christmas", "observed": True},
+            {"day": 26, "month": 12, "name": "Boxing Day", "observed": True},
+            {"easter": -2, "name": "Good Friday"},
+            {"easter": 1, "name": "Easter Monday"},
+            {"month": 5, "weekday": 1, "nth": -1, "name": "Spring Bank Holiday"},
+            {"month": 9, "weekday": 1, "nth": 1},
+        ]
+        self.assertEqual(
+            [
+                (date(2021, 4, 2), "Good Friday"),
+                (date(2021, 4, 5), "Easter Monday"),
+                (date(2021, 5, 31), "Spring Bank Holiday"),
+                (date(2021, 9, 6), "Monday 06 September 2021"),
+                (date(2021, 12, 25), "Christmas"),
+                (date(2021, 12, 26), "Boxing Day"),
+                (date(2021, 12, 27), "Christmas (observed)"),
+                (date(2021, 12, 28), "Boxing Day (observed)"),
+            ],
+            [(_.date, _.name) for _ in get_free_days(2021, rules=rules)],
+        )
+        # weekday free days are not observed again
+        self.assertEqual(
+            [date(2017, 12, 25), date(2017, 12, 26)],
+            [_.date for _ in get_free_days(2017, rules=rules[:2])],
+        )
+        # days off are the days that are worth no leave
+        with override_settings(
+            SSHR_DAY_LEAVE_VALUES={1: 0, 2: 1, 3: 1, 4: 1, 5: 1, 6: 1, 7: 0}
+        ):
+            # Saturday is a working day, and the Sunday is observed on Tuesday
+            self.assertEqual(
+                [date(2021, 12, 25), date(2021, 12, 26), date(2021, 12, 28)],
+                [_.date for _ in get_free_days(2021, rules=rules[:2])],
+            )
+            # a Sunday and a Monday are observed on Tuesday and Wednesday
+            self.assertEqual(
+                [
+                    date(2022, 12, 25),
+                    date(2022, 12, 26),
+                    date(2022, 12, 27),
+                    date(2022, 12, 28),
+                ],
+                [_.date for _ in get_free_days(2022, rules=rules[:2])],
+            )
+
+        # rules that have no date in a year are skipped
+        fifth_monday = {"month": 2, "weekday": 1, "nth": 5}
+        with self.assertRaises(ValueError):
+            get_free_day_rule_date(fifth_monday, 2021)
+        with self.assertRaises(ValueError):
+            get_free_day_rule_date({"month": 2, "weekday": 1, "nth": -5}, 2021)
+        self.assertEqual(date(2016, 2, 29), get_free_day_rule_date(fifth_monday, 2016))
+        self.assertEqual([], get_free_days(2021, rules=[fifth_monday]))
+
+        # free days observed across the end of a year skip the next year's free
+        # days, and the next year does not observe its free days on them again
+        new_year_rules = [
+            {"day": 1, "month": 1, "name": "New Year's Day", "observed": True},
+            {"day": 31, "month": 12, "name": "New Year's Eve", "observed": True},
+        ]
+        self.assertEqual(
+            [
+                (date(2022, 1, 1), "New Year's Day"),
+                (date(2022, 1, 3), "New Year's Day (observed)"),
+                (date(2022, 12, 31), "New Year's Eve"),
+                (date(2023, 1, 2), "New Year's Eve (observed)"),
+            ],
+            [(_.date, _.name) for _ in get_free_days(2022, rules=new_year_rules)],
+        )
+        self.assertEqual(
+            [date(2023, 1, 1), date(2023, 1, 3), date(2023, 12, 31), date(2024, 1, 2)],
+            [_.date for _ in get_free_days(2023, rules=new_year_rules)],
+        )
+
+    @override_settings(
+        SSHR_DAY_LEAVE_VALUES={
+            1: 1,  # Monday
+            2: 1,  # Tuesday
+            3: 1,  # Wednesday
+            4: 1,  # Thursday
+            5: 1,  # Friday
+            6: 0,  # Saturday
+            7: 0,  # Sunday
+        },
+    )
+    def test_create_free_days_leave(self):
+        """Test that create_free_days updates the leave it affects."""
+        FreeDay.objects.all().delete()
+        user = mommy.make("auth.User")
+        StaffProfile.objects.all().delete()
+        staff = mommy.make("small_small_hr.StaffProfile", user=user)
+        annual_leave = mommy.make(
+            "small_small_hr.AnnualLeave",
+            staff=staff,
+            year=2017,
+            leave_type=Leave.REGULAR,
+            allowed_days=21,
+            carried_over_days=0,
+        )
+        tzinfo = pytz.timezone(settings.TIME_ZONE)
+        leave_obj = mommy.make(
+            "small_small_hr.Leave",
+            staff=staff,
+            start=tzinfo.localize(datetime(2017, 4, 10, 7)),
+            end=tzinfo.localize(datetime(2017, 4, 21, 7)),
+            leave_type=Leave.REGULAR,
+            review_status=Leave.APPROVED,
+        )
+        self.assertEqual(21 - 10, staff.get_available_leave_days(year=2017))
+
+        rules = [{"easter": -2}, {"easter": 1}]
+        self.assertEqual(2, create_free_days(2017, number_of_years=1, rules=rules))
+        leave_obj.refresh_from_db()
+        annual_leave.refresh_from_db()
+        self.assertEqual(8, leave_obj.day_count)
+        self.assertEqual(8, annual_leave.taken_days)
+        self.assertEqual(21 - 8, staff.get_available_leave_days(year=2017))
+
+    def test_create_free_days_calendar(self):
+        """Test create_free_days with a HolidayCalendar."""
+        FreeDay.objects.all().delete()
+        kenya = mommy.make("small_small_hr.HolidayCalendar", name="Kenya")
+        users = mommy.make("auth.User", _quantity=2)
+        StaffProfile.objects.all().delete()
+        staff1 = mommy.make("small_small_hr.StaffProfile", user=users[0])
+        staff2 = mommy.make(
+            "small_small_hr.StaffProfile", user=users[1], calendar=kenya
+        )
+        tzinfo = pytz.timezone(settings.TIME_ZONE)
+        leave_objs = [
+            mommy.make(
+                "small_small_hr.Leave",
+                staff=staff,
+                start=tzinfo.localize(datetime(2017, 4, 10, 7)),
+                end=tzinfo.localize(datetime(2017, 4, 21, 7)),
+                leave_type=Leave.REGULAR,
+                review_status=Leave.APPROVED,
+            )
+            for staff in [staff1, staff2]
+        ]
+
+        rules = [{"easter": -2}, {"easter": 1}]
+        self.assertEqual(
+            2, create_free_days(2017, number_of_years=1, rules=rules, calendar=kenya)
+        )
+        self.assertEqual(0, create_free_days(2017, 1, rules=rules, calendar=kenya))
+        self.assertEqual(2, FreeDay.objects.filter(calendar=kenya).count())
+        for leave_obj in leave_objs:
+            leave_obj.refresh_from_db()
+        self.assertEqual(10, leave_objs[0].day_count)
+        self.assertEqual(8, leave_objs[1].day_count)
+
+        # the same dates in the default calendar
+        self.assertEqual(2, create_free_days(2017, number_of_years=1, rules=rules))
+        leave_objs[0].refresh_from_db()
+        self.assertEqual(8, leave_objs[0].day_count)
+
+    @override_settings(
+        SSHR_DAY_LEAVE_VALUES={
+            1: 1,  # Monday
+            2: 1,  # Tuesday
+            3: 1,  # Wednesday
+            4: 1,  # Thursday
+            5: 1,  # Friday
+            6: 0.5,  # Saturday
+            7: 0,  # Sunday
+        }
+    )
+    def test_get_leave_balances(self):
+        """Test get_leave_balances."""
+        users = mommy.make("auth.User", _quantity=3)
+        StaffProfile.objects.all().delete()
+        staff1, staff2, staff3 = [
+            mommy.make("small_small_hr.StaffProfile", user=user) for user in users
+        ]
+        mommy.make("small_small_hr.FreeDay", date=date(2017, 6, 15))
+        mommy.make(
+            "small_small_hr.AnnualLeave",
+            staff=staff1,
+            year=2017,
+            leave_type=Leave.REGULAR,
+            allowed_days=21,
+            carried_over_days=0,
+        )
+        mommy.make(
+            "small_small_hr.AnnualLeave",
+            staff=staff2,
+            year=2017,
+            leave_type=Leave.REGULAR,
+            allowed_days=18,
+            carried_over_days=5,
+        )
+        mommy.make(
+            "small_small_hr.AnnualLeave",
+            staff=staff2,
+            year=2017,
+            leave_type=Leave.SICK,
+            allowed_days=10,
+        )
+        tzinfo = pytz.timezone(settings.TIME_ZONE)
+        for staff, start, end, leave_type in [
+            (staff1, datetime(2017, 6, 5, 7), datetime(2017, 6, 16, 7), Leave.REGULAR),
+            (staff1, datetime(2017, 12, 29, 7), datetime(2018, 1, 6, 7), Leave.REGULAR),
+            (staff2, datetime(2017, 3, 1, 7), datetime(2017, 3, 3, 7), Leave.SICK),
+            (staff3, datetime(2017, 2, 6, 7), datetime(2017, 2, 7, 7), Leave.REGULAR),
+        ]:
+            mommy.make(
+                "small_small_hr.Leave",
+                staff=staff,
+                start=tzinfo.localize(start),
+                end=tzinfo.localize(end),
+                leave_type=leave_type,
+                review_status=Leave.APPROVED,
+            )
+
+        # the free days are already cached
+        with self.assertNumQueries(3):
+            balances = get_leave_balances(
+                StaffProfile.objects.all(), year=2017, leave_type=Leave.REGULAR
+            )
+
+        self.assertEqual(
+            {
+                "earned": Decimal(21),
+                "carried_over": Decimal(0),
+                "taken": Decimal(11),
+                "available": Decimal(10),
+            },
+            balances[staff1.id],
+        )
+        self.assertEqual(
+            {
+                "earned": Decimal(18),
+                "carried_over": Decimal(5),
+                "taken": Decimal(0),
+                "available": Decimal(23),
+            },
+            balances[staff2.id],
+        )
+        self.assertEqual(
+            {
+                "earned": Decimal(0),
+                "carried_over": Decimal(0),
+                "taken": Decimal(2),
+                "available": Decimal(0),
+            },
+            balances[staff3.id],
+        )
+        for staff in [staff1, staff2, staff3]:
+            self.assertEqual(
+                staff.get_available_leave_days(year=2017),
+                balances[staff.id]["available"],
+            )
+            self.assertEqual(
+                staff.get_approved_leave_days(year=2017), balances[staff.id]["taken"]
+            )
+
+    def test_get_leave_balances_calendars(self):
+        """Test get_leave_balances with staff members in many HolidayCalendars."""
+        calendars = [
+            None,
+            mommy.make("small_small_hr.HolidayCalendar", name="Kenya"),
+            mommy.make("small_small_hr.HolidayCalendar", name="Uganda"),
+        ]
+        mommy.make("small_small_hr.FreeDay", date=date(2017, 12, 26))
+        mommy.make(
+            "small_small_hr.FreeDay", date=date(2017, 12, 27), calendar=calendars[2]
+        )
+        mommy.make(
+            "small_small_hr.FreeDay", date=date(2017, 12, 28), calendar=calendars[2]
+        )
+        users = mommy.make("auth.User", _quantity=6)
+        StaffProfile.objects.all().delete()
+        tzinfo = pytz.timezone(settings.TIME_ZONE)
+        staff_calendars = {}
+        for index, user in enumerate(users):
+            staff = mommy.make(
+                "small_small_hr.StaffProfile", user=user, calendar=calendars[index % 3]
+            )
+            staff_calendars[staff.id] = calendars[index % 3]
+            # clipped to the year, so counted from the calendar
+            mommy.make(
+                "small_small_hr.Leave",
+                staff=staff,
+                start=tzinfo.localize(datetime(2017, 12, 25, 7)),
+                end=tzinfo.localize(datetime(2018, 1, 5, 7)),
+                leave_type=Leave.REGULAR,
+                review_status=Leave.APPROVED,
+            )
+
+        free_day_calendar.invalidate()
+        # the free days of the three calendars are loaded in one query
+        with self.assertNumQueries(4):
+            balances = get_leave_balances(
+                StaffProfile.objects.all(), year=2017, leave_type=Leave.REGULAR
+            )
+        # 25 to 29 December 2017 are weekdays
+        expected = {None: 4, calendars[1]: 5, calendars[2]: 3}
+        self.assertEqual(
+            {staff_id: expected[_] for staff_id, _ in staff_calendars.items()},
+            {staff_id: _["taken"] for staff_id, _ in balances.items()},
+        )
+        for staff in StaffProfile.objects.all():
+            self.assertEqual(
+                staff.get_approved_leave_days(year=2017), balances[staff.id]["taken"]
+            )
+
+    @override_settings(
+        SSHR_DAY_LEAVE_VALUES={
+            1: 1,  # Monday
+            2: 1,  # Tuesday
+            3: 1,  # Wednesday
+            4: 1,  # Thursday
+            5: 1,  # Friday
+            6: 0,  # Saturday
+            7: 0,  # Sunday
+        }
+    )
+    def test_get_balances_as_of(self):
+        """Test get_balances_as_of and get_balance_as_of."""
+        users = mommy.make("auth.User", _quantity=2)
+        StaffProfile.objects.all().delete()
+        staff1, staff2 = [
+            mommy.make("small_small_hr.StaffProfile", user=user) for user in users
+        ]
+        mommy.make(
+            "small_small_hr.AnnualLeave",
+            staff=staff1,
+            year=2017,
+            leave_type=Leave.REGULAR,
+            allowed_days=Decimal("36.5"),
+            carried_over_days=2,
+        )
+        tzinfo = pytz.timezone(settings.TIME_ZONE)
+        for staff, start, end in [
+            # 2 days in 2017
+            (staff1, datetime(2016, 12, 28, 7), datetime(2017, 1, 3, 7)),
+            (staff1, datetime(2017, 1, 9, 7), datetime(2017, 1, 13, 7)),
+            # 6 days up to 12/6/2017
+            (staff1, datetime(2017, 6, 5, 7), datetime(2017, 6, 16, 7)),
+            (staff2, datetime(2017, 2, 6, 7), datetime(2017, 2, 7, 7)),
+        ]:
+            mommy.make(
+                "small_small_hr.Leave",
+                staff=staff,
+                start=tzinfo.localize(start),
+                end=tzinfo.localize(end),
+                leave_type=Leave.REGULAR,
+                review_status=Leave.APPROVED,
+            )
+        # load the free days
+        get_balance_as_of(staff1, date(2017, 1, 1), Leave.REGULAR)
+
+        with self.assertNumQueries(3):
+            balances = get_balances_as_of(
+                StaffProfile.objects.all(), date(2017, 6, 12), Leave.REGULAR
+            )
+        # 163 of 365 days earned, 13 days taken
+        self.assertEqual(
+            {staff1.id: Decimal("16.3") + 2 - 13, staff2.id: Decimal(0)}, balances
+        )
+        self.assertEqual(
+            Decimal("0.1") + 2,
+            get_balance_as_of(staff1, date(2017, 1, 1), Leave.REGULAR),
+        )
+        self.assertEqual(
+            staff1.get_available_leave_days(year=2017),
+            get_balance_as_of(staff1, date(2017, 12, 31), Leave.REGULAR),
+        )
+        self.assertEqual(0, get_balance_as_of(staff1, date(2017, 6, 12), Leave.SICK))
+
+    @override_settings(
+        SSHR_MAX_CARRY_OVER=10,
+        SSHR_DAY_LEAVE_VALUES={
+            1: 1,  # Monday
+            2: 1,  # Tuesday
+            3: 1,  # Wednesday
+            4: 1,  # Thursday
+            5: 1,  # Friday
+            6: 0,  # Saturday
+            7: 0,  # Sunday
+        },
+    )
+    def test_rollover_annual_leave(self):
+        """Test rollover_annual_leave."""
+        users = mommy.make("auth.User", is_active=True, _quantity=3)
+        inactive_user = mommy.make("auth.User", is_active=False)
+        StaffProfile.objects.all().delete()
+        staff1, staff2, staff3 = [
+            mommy.make(
+                "small_small_hr.StaffProfile", user=user, leave_days=21, sick_days=10
+            )
+            for user in users
+        ]
+        mommy.make("small_small_hr.StaffProfile", user=inactive_user)
+        staff3.end_date = date(2017, 12, 31)
+        staff3.save()
+        for staff in [staff1, staff2, staff3]:
+            create_annual_leave(staff, 2017, Leave.REGULAR)
+        mommy.make(
+            "small_small_hr.AnnualLeave",
+            staff=staff2,
+            year=2018,
+            leave_type=Leave.REGULAR,
+            allowed_days=15,
+        )
+        tzinfo = pytz.timezone(settings.TIME_ZONE)
+        for staff, start, end in [
+            # 12 days of leave in 2017
+            (staff1, datetime(2017, 6, 5, 7), datetime(2017, 6, 20, 7)),
+            # 2 days of leave in 2018
+            (staff1, datetime(2018, 2, 5, 7), datetime(2018, 2, 6, 7)),
+        ]:
+            mommy.make(
+                "small_small_hr.Leave",
+                staff=staff,
+                start=tzinfo.localize(start),
+                end=tzinfo.localize(end),
+                leave_type=Leave.REGULAR,
+                review_status=Leave.APPROVED,
+            )
+
+        calls = []
+        created = rollover_annual_leave(
+            2018, batch_size=1, progress=lambda *args: calls.append(args)
+        )
+        self.assertEqual(3, created)
+        self.assertEqual([(1, 2), (2, 2)], calls)
+
+        def get_annual_leave_2018():
+            """Get the 2018 AnnualLeave records."""
+            return {
+                (staff_id, leave_type): (allowed, carried_over, taken)
+                for staff_id, leave_type, allowed, carried_over, taken in (
+                    AnnualLeave.objects.filter(year=2018).values_list(
+                        "staff_id",
+                        "leave_type",
+                        "allowed_days",
+                        "carried_over_days",
+                        "taken_days",
+                    )
+                )
+            }
+
+        rolled_over = get_annual_leave_2018()
+        self.assertEqual(
+            {
+                (staff1.id, Leave.REGULAR): (21, 9, 2),
+                (staff1.id, Leave.SICK): (10, 0, 0),
+                (staff2.id, Leave.REGULAR): (15, 0, 0),
+                (staff2.id, Leave.SICK): (10, 0, 0),
+            },
+            rolled_over,
+        )
+        self.assertEqual(21 + 9 - 2, staff1.get_available_leave_days(year=2018))
+
+        # existing records are left alone
+        self.assertEqual(0, rollover_annual_leave(2018))
+
+        # the records are the same as those made by create_annual_leave
+        AnnualLeave.objects.filter(year=2018, staff=staff1).delete()
+        create_annual_leave(staff1, 2018, Leave.REGULAR)
+        create_annual_leave(staff1, 2018, Leave.SICK)
+        self.assertEqual(rolled_over, get_annual_leave_2018())
+
+    @override_settings(
+        SSHR_MAX_CARRY_OVER=10,
+        SSHR_DAY_LEAVE_VALUES={
+            1: 1,  # Monday
+            2: 1,  # Tuesday
+            3: 1,  # Wednesday
+            4: 1,  # Thursday
+            5: 1,  # Friday
+            6: 0,  # Saturday
+            7: 0,  # Sunday
+        },
+    )
+    def test_recompute_carry_over(self):
+        """Test get_carry_over_chain and recompute_carry_over."""
+        users = mommy.make("auth.User", _quantity=2)
+        StaffProfile.objects.all().delete()
+        staff, other = [
+            mommy.make("small_small_hr.StaffProfile", user=user) for user in users
+        ]
+        for year, carried_over_days in [(2016, 0), (2017, 10), (2018, 10), (2020, 3)]:
+            for the_staff in [staff, other]:
+                mommy.make(
+                    "small_small_hr.AnnualLeave",
+                    staff=the_staff,
+                    year=year,
+                    leave_type=Leave.REGULAR,
+                    allowed_days=21,
+                    carried_over_days=carried_over_days,
+                )
+        tzinfo = pytz.timezone(settings.TIME_ZONE)
+        for start, end in [
+            # 15 days of leave in 2016
+            (datetime(2016, 6, 6, 7), datetime(2016, 6, 24, 7)),
+            # 20 days of leave in 2017
+            (datetime(2017, 6, 5, 7), datetime(2017, 6, 30, 7)),
+        ]:
+            mommy.make(
+                "small_small_hr.Leave",
+                staff=staff,
+                start=tzinfo.localize(start),
+                end=tzinfo.localize(end),
+                leave_type=Leave.REGULAR,
+                review_status=Leave.APPROVED,
+            )
+
+        annual_leaves = list(
+            AnnualLeave.objects.filter(staff=staff, leave_type=Leave.REGULAR)
+        )
+        with self.assertNumQueries(0):
+            chain = get_carry_over_chain(annual_leaves)
+        self.assertEqual(
+            {2016: (0, 6), 2017: (6, 7), 2018: (7, 21 + 7), 2020: (3, 21 + 3)}, chain,
+        )
+
+        # earlier years are left alone
+        self.assertEqual(0, recompute_carry_over(from_year=2018))
+
+        self.assertEqual(2, recompute_carry_over())
+        self.assertEqual(
+            [(2016, 0), (2017, 6), (2018, 7), (2020, 3)],
+            list(
+                AnnualLeave.objects.filter(staff=staff)
+                .order_by("year")
+                .values_list("year", "carried_over_days")
+            ),
+        )
+        self.assertEqual(21 + 7, staff.get_available_leave_days(year=2018))
+        self.assertEqual(0, recompute_carry_over())
+
+    @override_settings(
+        SSHR_MAX_CARRY_OVER=10,
+        SSHR_DAY_LEAVE_VALUES={
+            1: 1,  # Monday
+            2: 1,  # Tuesday
+            3: 1,  # Wednesday
+            4: 1,  # Thursday
+            5: 1,  # Friday
+            6: 0,  # Saturday
+            7: 0,  # Sunday
+        },
+    )
+    def test_create_monthly_leave_balances(self):
+        """Test create_monthly_leave_balances."""
+        users = mommy.make("auth.User", _quantity=3)
+        StaffProfile.objects.all().delete()
+        staff, other, former = [
+            mommy.make("small_small_hr.StaffProfile", user=user) for user in users
+        ]
+        for the_staff, year, leave_type in [
+            (staff, 2016, Leave.REGULAR),
+            (staff, 2017, Leave.REGULAR),
+            (staff, 2017, Leave.SICK),
+            (other, 2017, Leave.REGULAR),
+        ]:
+            mommy.make(
+                "small_small_hr.AnnualLeave",
+                staff=the_staff,
+                year=year,
+                leave_type=leave_type,
+                allowed_days=12,
+            )
+        tzinfo = pytz.timezone(settings.TIME_ZONE)
+        mommy.make(
+            "small_small_hr.Leave",
+            staff=staff,
+            start=tzinfo.localize(datetime(2016, 12, 26, 7)),
+            end=tzinfo.localize(datetime(2017, 1, 6, 7)),
+            leave_type=Leave.REGULAR,
+            review_status=Leave.APPROVED,
+        )
+        # records without an AnnualLeave record are removed
+        mommy.make(
+            "small_small_hr.MonthlyLeaveBalance",
+            staff=former,
+            year=2017,
+            month=1,
+            leave_type=Leave.REGULAR,
+        )
+
+        progress = []
+        self.assertEqual(
+            36,
+            create_monthly_leave_balances(
+                2017, batch_size=2, progress=lambda *_: progress.append(_)
+            ),
+        )
+        self.assertEqual([(2, 3), (3, 3)], progress)
+        fields = ["opening_days", "accrued_days", "taken_days", "closing_days"]
+        self.assertEqual(0, MonthlyLeaveBalance.objects.filter(staff=former).count())
+        self.assertEqual(0, MonthlyLeaveBalance.objects.filter(year=2016).count())
+        self.assertEqual(
+            (0, 1, 5, -4),
+            MonthlyLeaveBalance.objects.filter(
+                staff=staff, year=2017, month=1, leave_type=Leave.REGULAR
+            ).values_list(*fields)[0],
+        )
+
+        # carried over days are followed
+        self.assertEqual(1, recompute_carry_over())
+        self.assertEqual(
+            (7, 1, 5, 3),
+            MonthlyLeaveBalance.objects.filter(
+                staff=staff, year=2017, month=1, leave_type=Leave.REGULAR
+            ).values_list(*fields)[0],
+        )
+        self.assertEqual(
+            staff.get_available_leave_days(year=2017),
+            MonthlyLeaveBalance.objects.get(
+                staff=staff, year=2017, month=12, leave_type=Leave.REGULAR
+            ).closing_days,
+        )
+
+    @override_settings(
+        SSHR_ALLOW_OVERSUBSCRIBE=False,
+        SSHR_DAY_LEAVE_VALUES={
+            1: 1,  # Monday
+            2: 1,  # Tuesday
+            3: 1,  # Wednesday
+            4: 1,  # Thursday
+            5: 1,  # Friday
+            6: 0,  # Saturday
+            7: 0,  # Sunday
+        },
+    )
+    def test_approve_leave(self):
+        """Test approve_leave."""
+        tzinfo = pytz.timezone(settings.TIME_ZONE)
+        user = mommy.make("auth.User")
+        StaffProfile.objects.all().delete()
+        staff = mommy.make("small_small_hr.StaffProfile", user=user)
+        annual_leave = mommy.make(
+            "small_small_hr.AnnualLeave",
+            staff=staff,
+            year=2017,
+            leave_type=Leave.REGULAR,
+            allowed_days=12,
+            carried_over_days=0,
+        )
+        june, july, sick = [
+            mommy.make(
+                "small_small_hr.Leave",
+                staff=staff,
+                start=tzinfo.localize(start),
+                end=tzinfo.localize(end),
+                leave_type=leave_type,
+                review_status=Leave.PENDING,
+            )
+            for start, end, leave_type in [
+                # 10 days each
+                (datetime(2017, 6, 5, 7), datetime(2017, 6, 16, 7), Leave.REGULAR),
+                (datetime(2017, 7, 3, 7), datetime(2017, 7, 14, 7), Leave.REGULAR),
+                (datetime(2017, 3, 1, 7), datetime(2017, 3, 1, 7), Leave.SICK),
+            ]
+        ]
+
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(Leave.APPROVED, approve_leave(june).review_status)
+        # the leave and the AnnualLeave record are locked
+        self.assertEqual(
+            2, len([_ for _ in queries.captured_queries if "FOR UPDATE" in _["sql"]])
+        )
+        annual_leave.refresh_from_db()
+        self.assertEqual(10, annual_leave.taken_days)
+        # approving again changes nothing
+        self.assertEqual(Leave.APPROVED, approve_leave(june).review_status)
+
+        with self.assertRaises(ValidationError) as context:
+            approve_leave(july)
+        self.assertEqual(
+            ["Not enough leave days. Available leave days are 2.00"],
+            context.exception.messages,
+        )
+        july.refresh_from_db()
+        self.assertEqual(Leave.PENDING, july.review_status)
+
+        # there is no AnnualLeave record for sick leave
+        with self.assertRaises(ValidationError) as context:
+            approve_leave(sick)
+        self.assertEqual(
+            ["Not enough sick days. Available sick days are 0.00"],
+            context.exception.messages,
+        )
+
+        with override_settings(SSHR_ALLOW_OVERSUBSCRIBE=True):
+            self.assertEqual(Leave.APPROVED, approve_leave(july).review_status)
+        annual_leave.refresh_from_db()
+        self.assertEqual(20, annual_leave.taken_days)
+
+    @override_settings(SSHR_ALLOW_OVERSUBSCRIBE=False)
+    def test_validate_leave_applications(self):
+        """Test validate_leave_applications."""
+        tzinfo = pytz.timezone(settings.TIME_ZONE)
+        kenya = mommy.make("small_small_hr.HolidayCalendar", name="Kenya")
+        mommy.make("small_small_hr.FreeDay", date=date(2017, 6, 1), calendar=kenya)
+        users = mommy.make("auth.User", _quantity=2)
+        StaffProfile.objects.all().delete()
+        staff1 = mommy.make("small_small_hr.StaffProfile", user=users[0])
+        staff2 = mommy.make(
+            "small_small_hr.StaffProfile", user=users[1], calendar=kenya
+        )
+        for staff in [staff1, staff2]:
+            mommy.make(
+                "small_small_hr.AnnualLeave",
+                staff=staff,
+                year=2017,
+                leave_type=Leave.REGULAR,
+                allowed_days=6,
+                carried_over_days=0,
+            )
+        approved = mommy.make(
+            "small_small_hr.Leave",
+            staff=staff1,
+            start=tzinfo.localize(datetime(2017, 5, 1, 7)),
+            end=tzinfo.localize(datetime(2017, 5, 2, 7)),
+            leave_type=Leave.REGULAR,
+            review_status=Leave.APPROVED,
+        )
+
+        def make_leave(staff, start, end, **kwargs):
+            return Leave(
+                staff=staff,
+                start=tzinfo.localize(start),
+                end=tzinfo.localize(end),
+                leave_type=Leave.REGULAR,
+                **kwargs,
+            )
+
+        leave_objs = [
+            # Monday to Friday, 5 of the 4 days left
+            make_leave(staff1, datetime(2017, 5, 29, 7), datetime(2017, 6, 2, 7)),
+            # Monday to Friday with a free day, 4 of the 6 days left
+            make_leave(staff2, datetime(2017, 5, 29, 7), datetime(2017, 6, 2, 7)),
+            # Friday to Monday, 2 of the 2 days left
+            make_leave(staff2, datetime(2017, 6, 9, 7), datetime(2017, 6, 12, 7)),
+            # 1 of the 0 days left
+            make_leave(staff2, datetime(2017, 6, 13, 7), datetime(2017, 6, 13, 7)),
+            # overlaps approved leave
+            make_leave(staff1, datetime(2017, 5, 2, 7), datetime(2017, 5, 2, 7)),
+        ]
+        with self.assertNumQueries(3):
+            errors = validate_leave_applications(leave_objs)
+        self.assertEqual(
+            [
+                ["Not enough leave days. Available leave days are 4.00"],
+                [],
+                [],
+                ["Not enough leave days. Available leave days are 0.00"],
+                ["you cannot have overlapping leave days"],
+            ],
+            errors,
+        )
+
+        # the days that saved leave already takes are available to it again
+        approved.end = tzinfo.localize(datetime(2017, 5, 5, 7))
+        self.assertEqual([[]], validate_leave_applications([approved]))
+        approved.end = tzinfo.localize(datetime(2017, 5, 9, 7))
+        self.assertEqual(
+            [["Not enough leave days. Available leave days are 6.00"]],
+            validate_leave_applications([approved]),
+        )
+        # and does not overlap itself
+        approved.review_status = Leave.PENDING
+        approved.end = tzinfo.localize(datetime(2017, 5, 2, 7))
+        self.assertEqual([[]], validate_leave_applications([approved]))
+
+        # rejected leave is not checked
+        leave_objs[0].review_status = Leave.REJECTED
+        leave_objs[4].review_status = Leave.REJECTED
+        with self.assertNumQueries(0):
+            self.assertEqual(
+                [[], []],
+                validate_leave_applications([leave_objs[0], leave_objs[4]]),
+            )